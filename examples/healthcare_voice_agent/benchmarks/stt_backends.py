@@ -0,0 +1,210 @@
+"""Compare the accuracy and latency of speech recognition engines.
+
+Transcribes a set of WAV fixtures with every combination of the given
+engines, CPU thread counts and beam sizes (see ``stt_agent.py``), and
+reports per configuration the word error rate against the reference
+transcripts, the latency percentiles, the real-time factor (processing time
+over audio length) and the model load time.
+
+The fixtures are listed in a JSONL manifest, one
+``{"audio": "<path>", "text": "<reference transcript>"}`` per line, with
+paths relative to the manifest. The default manifest holds a single
+fixture, the example input of the agent (``../input_audio.wav``, recorded at
+22 kHz and resampled on load), so its word error rates say little; add
+recordings of your own users to it.
+
+Usage (from the healthcare_voice_agent directory):
+    python benchmarks/stt_backends.py \\
+        --engine whisper:base --engine faster-whisper:base:int8 \\
+        --threads 2,4 --beam-size 1,5 [--repeat 3] [--output out.json]
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from typing import Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import stt_agent  # noqa: E402
+
+DEFAULT_MANIFEST = os.path.join(ROOT, "benchmarks", "stt_fixtures.jsonl")
+
+
+def _percentiles(values: list[float]) -> dict[str, float]:
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return round(values[min(len(values) - 1, int(len(values) * q))], 1)
+
+    return {"p50": at(0.5), "p95": at(0.95), "max": round(values[-1], 1)}
+
+
+def load_fixtures(manifest: str) -> list[dict[str, Any]]:
+    """Decoded audio and reference transcript of each fixture"""
+    base = os.path.dirname(os.path.abspath(manifest))
+    fixtures = []
+    with open(manifest) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            path = os.path.join(base, entry["audio"])
+            fixtures.append({
+                "audio": entry["audio"],
+                "samples": stt_agent.load_audio(path),
+                "text": entry["text"]
+            })
+    return fixtures
+
+
+def word_errors(reference: str, hypothesis: str) -> tuple[int, int]:
+    """Word-level edit distance between the transcripts, and the number of
+    reference words
+    """
+    ref = [word for word in stt_agent._words(reference) if word]
+    hyp = [word for word in stt_agent._words(hypothesis) if word]
+    # One row of the Levenshtein matrix at a time
+    row = list(range(len(hyp) + 1))
+    for i, word in enumerate(ref, 1):
+        previous, row[0] = row[0], i
+        for j, other in enumerate(hyp, 1):
+            previous, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1,
+                                           previous + (word != other))
+    return row[-1], len(ref)
+
+
+def create_model(engine: str, device: str | None, threads: int,
+                 beam_size: int) -> stt_agent.SpeechModel:
+    """Model of an engine spec ``backend:model[:compute_type]``"""
+    backend, name, *rest = engine.split(":")
+    if backend not in stt_agent.BACKENDS:
+        raise ValueError(f"Unknown STT backend: {backend}")
+    options: dict[str, Any] = {"cpu_threads": threads, "beam_size": beam_size}
+    if rest:
+        options["compute_type"] = rest[0]
+    return stt_agent.BACKENDS[backend](name, device, **options)
+
+
+def _torch_threads() -> int | None:
+    """Current PyTorch thread count, None without PyTorch"""
+    try:
+        import torch
+    except ImportError:
+        return None
+    return torch.get_num_threads()
+
+
+def run(engine: str, threads: int, beam_size: int,
+        fixtures: list[dict[str, Any]], args: argparse.Namespace) -> dict:
+    # The whisper backend sets the process-wide PyTorch thread count, which
+    # must not carry over to the configurations run after this one
+    torch_threads = _torch_threads()
+    try:
+        return _run(engine, threads, beam_size, fixtures, args)
+    finally:
+        if torch_threads is not None:
+            import torch
+            torch.set_num_threads(torch_threads)
+
+
+def _run(engine: str, threads: int, beam_size: int,
+         fixtures: list[dict[str, Any]], args: argparse.Namespace) -> dict:
+    started = time.perf_counter()
+    model = create_model(engine, args.device, threads, beam_size)
+    model.warm_up()
+    load_seconds = time.perf_counter() - started
+
+    latencies, errors, words = [], 0, 0
+    processing, audio_seconds = 0.0, 0.0
+    for fixture in fixtures:
+        for attempt in range(args.repeat):
+            started = time.perf_counter()
+            text = model.transcribe(fixture["samples"])
+            seconds = time.perf_counter() - started
+            latencies.append(seconds * 1000)
+            processing += seconds
+            audio_seconds += (len(fixture["samples"]) /
+                              stt_agent.WHISPER_SAMPLE_RATE)
+            if attempt == 0:
+                fixture_errors, fixture_words = word_errors(
+                    fixture["text"], text)
+                errors += fixture_errors
+                words += fixture_words
+    return {
+        "engine": engine,
+        "device": model.device,
+        "threads": threads,
+        "beam_size": beam_size,
+        "load_seconds": round(load_seconds, 2),
+        "word_error_rate": round(errors / max(words, 1), 4),
+        "latency_ms": _percentiles(latencies),
+        "real_time_factor": round(processing / audio_seconds, 3)
+    }
+
+
+def _ints(value: str) -> list[int]:
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST)
+    parser.add_argument("--engine",
+                        action="append",
+                        help="backend:model[:compute_type], repeatable "
+                        "(default whisper:base and faster-whisper:base:int8)")
+    parser.add_argument("--device",
+                        default="cpu",
+                        help="device of every engine, e.g. cpu or cuda")
+    parser.add_argument("--threads",
+                        type=_ints,
+                        default=[0],
+                        help="comma-separated CPU thread counts, 0 for the "
+                        "engine's default")
+    parser.add_argument("--beam-size",
+                        type=_ints,
+                        default=[0],
+                        help="comma-separated beam sizes, 0 for the "
+                        "engine's default")
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=3,
+                        help="timed transcriptions of each fixture")
+    parser.add_argument("--output", help="write the results to this file")
+    args = parser.parse_args()
+    engines = args.engine or ["whisper:base", "faster-whisper:base:int8"]
+
+    fixtures = load_fixtures(args.manifest)
+    results = []
+    for engine, threads, beam_size in itertools.product(
+            engines, args.threads, args.beam_size):
+        result = run(engine, threads, beam_size, fixtures, args)
+        results.append(result)
+        latency = result["latency_ms"]
+        print(
+            f"{engine} threads {threads or 'default'} "
+            f"beam {beam_size or 'default'}: "
+            f"WER {result['word_error_rate']:.1%}, "
+            f"p50 {latency['p50']} ms, p95 {latency['p95']} ms, "
+            f"RTF {result['real_time_factor']}, "
+            f"load {result['load_seconds']} s",
+            file=sys.stderr)
+
+    config = dict(vars(args), engine=engines, fixtures=len(fixtures))
+    config.pop("output")
+    report = json.dumps({"config": config, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""Cached, offline rendering of workflow graphs.
+
+Rendering with ``draw_mermaid_png`` calls the remote mermaid.ink service,
+which adds seconds to every start or fails without a network.
+:func:`render_graph` instead keys the rendered file by a hash of the graph
+topology and only renders again when the topology changes. Rendering is
+local: Graphviz when ``pygraphviz`` is installed, otherwise a built-in SVG
+renderer. The remote Mermaid renderer is only used when
+``GRAPH_RENDER_REMOTE=1`` is set.
+"""
+import hashlib
+import json
+import os
+from html import escape
+from typing import Any
+
+import traceroot
+
+logger = traceroot.get_logger()
+
+REMOTE_RENDER = os.getenv("GRAPH_RENDER_REMOTE", "0") == "1"
+
+_NODE_WIDTH = 160
+_NODE_HEIGHT = 40
+_H_GAP = 40
+_V_GAP = 60
+_MARGIN = 40
+
+
+def graph_fingerprint(graph: Any) -> str:
+    """Hash the nodes and edges of a ``langchain_core`` graph"""
+    topology = {
+        "nodes":
+        sorted([node.id, node.name] for node in graph.nodes.values()),
+        "edges":
+        sorted([
+            edge.source, edge.target,
+            str(edge.data) if edge.data is not None else "", edge.conditional
+        ] for edge in graph.edges),
+    }
+    return hashlib.sha256(
+        json.dumps(topology, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def render_graph(graph: Any, output_path: str) -> str | None:
+    """Render ``graph`` to ``output_path`` unless it is already up to date.
+
+    When no PNG renderer is available, an SVG is written next to
+    ``output_path`` instead.
+
+    Returns:
+        Path of the rendered file, or None if rendering failed
+    """
+    fingerprint = graph_fingerprint(graph)
+    sidecar = f"{os.path.splitext(output_path)[0]}.graph.json"
+    try:
+        with open(sidecar, encoding="utf-8") as f:
+            cached = json.load(f)
+        # The file name is stored relative to the sidecar
+        path = os.path.join(os.path.dirname(sidecar), cached["file"])
+        if cached["fingerprint"] == fingerprint and os.path.exists(path):
+            logger.info(f"Workflow graph unchanged: {path}")
+            return path
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    try:
+        path = _render(graph, output_path)
+    except Exception as e:
+        logger.error(f"Could not render workflow graph: {str(e)}")
+        return None
+    with open(sidecar, "w", encoding="utf-8") as f:
+        json.dump({
+            "fingerprint": fingerprint,
+            "file": os.path.basename(path)
+        }, f)
+    logger.info(f"Workflow graph saved to: {path}")
+    return path
+
+
+def _render(graph: Any, output_path: str) -> str:
+    if REMOTE_RENDER:
+        with open(output_path, "wb") as f:
+            f.write(graph.draw_mermaid_png(max_retries=1))
+        return output_path
+    try:
+        import pygraphviz  # noqa: F401
+    except ImportError:
+        svg_path = f"{os.path.splitext(output_path)[0]}.svg"
+        with open(svg_path, "w", encoding="utf-8") as f:
+            f.write(draw_svg(graph))
+        return svg_path
+    graph.draw_png(output_path)
+    return output_path
+
+
+def _layers(graph: Any) -> list[list[str]]:
+    """Assign nodes to rows by longest path, ignoring back edges"""
+    successors: dict[str, list[str]] = {node: [] for node in graph.nodes}
+    for edge in graph.edges:
+        successors[edge.source].append(edge.target)
+
+    # Depth-first search from the entry point to find the back edges
+    start = graph.first_node()
+    order: list[str] = []
+    state: dict[str, str] = {}
+    back_edges: set[tuple[str, str]] = set()
+    roots = ([start.id] if start else []) + list(graph.nodes)
+    for root in roots:
+        if root in state:
+            continue
+        stack = [(root, iter(successors[root]))]
+        state[root] = "open"
+        while stack:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                state[node] = "done"
+                order.append(node)
+            elif state.get(child) == "open":
+                back_edges.add((node, child))
+            elif child not in state:
+                state[child] = "open"
+                stack.append((child, iter(successors[child])))
+
+    depth = {node: 0 for node in graph.nodes}
+    for node in reversed(order):
+        for child in successors[node]:
+            if (node, child) not in back_edges:
+                depth[child] = max(depth[child], depth[node] + 1)
+    layers: list[list[str]] = [[] for _ in range(max(depth.values()) + 1)]
+    for node in graph.nodes:
+        layers[depth[node]].append(node)
+    return layers
+
+
+def draw_svg(graph: Any) -> str:
+    """Draw ``graph`` top to bottom as a standalone SVG document"""
+    layers = _layers(graph)
+    widest = max(len(layer) for layer in layers)
+    width = 2 * _MARGIN + widest * _NODE_WIDTH + (widest - 1) * _H_GAP
+    # Back edges are routed through the right margin and edges that skip
+    # rows through the left one
+    width += 2 * _H_GAP
+    height = (2 * _MARGIN + len(layers) * _NODE_HEIGHT +
+              (len(layers) - 1) * _V_GAP)
+
+    position: dict[str, tuple[float, float]] = {}
+    for row, layer in enumerate(layers):
+        row_width = len(layer) * _NODE_WIDTH + (len(layer) - 1) * _H_GAP
+        left = (width - row_width) / 2
+        top = _MARGIN + row * (_NODE_HEIGHT + _V_GAP)
+        for column, node in enumerate(layer):
+            position[node] = (left + column * (_NODE_WIDTH + _H_GAP), top)
+
+    parts = [
+        f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" '
+        f'height="{height}" font-family="sans-serif" font-size="14">',
+        '<defs><marker id="arrow" viewBox="0 0 10 10" refX="10" refY="5" '
+        'markerWidth="8" markerHeight="8" orient="auto-start-reverse">'
+        '<path d="M 0 0 L 10 5 L 0 10 z"/></marker></defs>',
+        f'<rect width="{width}" height="{height}" fill="white"/>',
+    ]
+    for edge in graph.edges:
+        sx, sy = position[edge.source]
+        tx, ty = position[edge.target]
+        dash = ' stroke-dasharray="6 4"' if edge.conditional else ""
+        if sy < ty <= sy + _NODE_HEIGHT + _V_GAP:
+            x1, y1 = sx + _NODE_WIDTH / 2, sy + _NODE_HEIGHT
+            x2, y2 = tx + _NODE_WIDTH / 2, ty
+            path = f"M {x1} {y1} L {x2} {y2}"
+        elif ty > sy:
+            # Skips rows: go around the nodes in between on the left
+            x1, y1 = sx, sy + _NODE_HEIGHT / 2
+            x2, y2 = tx, ty + _NODE_HEIGHT / 2
+            bend = min(x1, x2) - _H_GAP
+            path = f"M {x1} {y1} C {bend} {y1}, {bend} {y2}, {x2} {y2}"
+        else:
+            # Back or same-row edge: leave and enter from the right side
+            x1, y1 = sx + _NODE_WIDTH, sy + _NODE_HEIGHT / 2
+            x2, y2 = tx + _NODE_WIDTH, ty + _NODE_HEIGHT / 2
+            bend = max(x1, x2) + _H_GAP
+            path = f"M {x1} {y1} C {bend} {y1}, {bend} {y2}, {x2} {y2}"
+        parts.append(f'<path d="{path}" fill="none" stroke="#555"{dash} '
+                     'marker-end="url(#arrow)"/>')
+        if edge.data is not None:
+            parts.append(f'<text x="{(x1 + x2) / 2 + 6}" '
+                         f'y="{(y1 + y2) / 2}" fill="#555" font-size="12">'
+                         f'{escape(str(edge.data))}</text>')
+    for node_id, node in graph.nodes.items():
+        x, y = position[node_id]
+        terminal = node_id in ("__start__", "__end__")
+        fill = "#eeeeee" if terminal else "#f2f0ff"
+        rx = _NODE_HEIGHT / 2 if terminal else 6
+        parts.append(f'<rect x="{x}" y="{y}" width="{_NODE_WIDTH}" '
+                     f'height="{_NODE_HEIGHT}" rx="{rx}" fill="{fill}" '
+                     'stroke="#333"/>')
+        parts.append(f'<text x="{x + _NODE_WIDTH / 2}" '
+                     f'y="{y + _NODE_HEIGHT / 2 + 5}" '
+                     f'text-anchor="middle">{escape(node.name)}</text>')
+    parts.append("</svg>")
+    return "\n".join(parts)
@@ -0,0 +1,517 @@
+"""Shared, pooled HTTP clients for every ChatOpenAI instance.
+
+Each ChatOpenAI creates its own connection pool by default, so a process
+with several agents pays separate TLS handshakes and keeps separate
+keep-alive connections per agent. :func:`create_chat_model` injects one
+process-wide sync client and one async client instead. Async connections
+are bound to the event loop that opened them, so the async client keeps a
+pool per running loop.
+
+Both clients cap the timeout of every request at the time left before the
+current request deadline (see ``deadline.py``), and fail it right away
+once the deadline has passed.
+
+With ``LLM_HEDGE_ENABLED=1``, a request that has not returned after the
+``LLM_HEDGE_PERCENTILE`` of recent latencies is sent a second time and the
+first response wins (see :class:`HedgePolicy`).
+
+With ``LLM_RATE_LIMIT_RPM`` or ``LLM_RATE_LIMIT_TPM`` set, every request
+first waits for its turn within the provider's rate limits (see
+``rate_limit.py``).
+
+Every request is counted and timed in the LLM metrics of the agent whose
+graph node sent it (see ``metrics.py``), when ``metrics.py`` is next to
+this module.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent import futures
+from typing import TYPE_CHECKING, Any
+
+import httpx
+from deadline import current_deadline
+from rate_limit import RateLimiter, SqliteQuotaStore
+
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+    from metrics import AgentMetrics
+
+try:
+    from metrics import current_agent
+except ImportError:
+    # Examples without metrics.py do not count their requests
+    def current_agent() -> None:
+        return None
+
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "32"))
+KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY_SECONDS", "60"))
+
+HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+# Hedges sent, as a fraction of all requests
+HEDGE_BUDGET = float(os.getenv("LLM_HEDGE_BUDGET", "0.05"))
+# Latencies the hedging delay is computed from, and how many are needed
+# before any request is hedged
+HEDGE_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+# Provider limits in requests and tokens per minute, 0 for none
+RATE_LIMIT_RPM = float(os.getenv("LLM_RATE_LIMIT_RPM", "0"))
+RATE_LIMIT_TPM = float(os.getenv("LLM_RATE_LIMIT_TPM", "0"))
+# SQLite file to share the quota with other processes, if set
+RATE_LIMIT_SHARED_PATH = os.getenv("LLM_RATE_LIMIT_SHARED_PATH", "")
+
+
+class PoolStats:
+    """Usage counters shared by the sync and async clients.
+
+    A request counts as in flight until its response headers arrive.
+    Requests started while every connection was busy had to wait for one,
+    which is what ``saturated`` counts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.saturated = 0
+        self.new_connections = 0
+
+    def started(self) -> None:
+        with self._lock:
+            if self.in_flight >= MAX_CONNECTIONS:
+                self.saturated += 1
+            self.in_flight += 1
+            self.requests += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def finished(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+
+    def trace(self, event: str, info: dict[str, Any]) -> None:
+        # httpcore trace hook; a TCP connect means the pool had no idle
+        # connection to reuse
+        if event == "connection.connect_tcp.complete":
+            with self._lock:
+                self.new_connections += 1
+
+    async def atrace(self, event: str, info: dict[str, Any]) -> None:
+        self.trace(event, info)
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            reused = self.requests - self.new_connections
+            return {
+                "max_connections": MAX_CONNECTIONS,
+                "http2": HTTP2_AVAILABLE,
+                "in_flight": self.in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "requests": self.requests,
+                "saturated": self.saturated,
+                "new_connections": self.new_connections,
+                "reuse_ratio": reused / self.requests if self.requests else 0,
+            }
+
+
+_stats = PoolStats()
+
+
+class HedgePolicy:
+    """When to send a duplicate of a slow request.
+
+    A request that has not returned after the ``percentile`` of the recent
+    latencies is sent again and the first response wins; the other one is
+    cancelled. To cap the extra traffic, at most ``budget`` times the
+    number of requests are hedged. Latency is measured as the caller sees
+    it, up to the response headers, which for a completion is most of it.
+    """
+
+    def __init__(self,
+                 enabled: bool = HEDGE_ENABLED,
+                 percentile: float = HEDGE_PERCENTILE,
+                 budget: float = HEDGE_BUDGET):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget = budget
+        self._lock = threading.Lock()
+        self._latencies: deque[float] = deque(maxlen=HEDGE_WINDOW)
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.over_budget = 0
+
+    def delay(self) -> float | None:
+        """Seconds to wait before hedging a new request, None to not hedge"""
+        with self._lock:
+            self.requests += 1
+            return self._delay() if self.enabled else None
+
+    def _delay(self) -> float | None:
+        if len(self._latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self._latencies)
+        index = int(len(latencies) * self.percentile / 100)
+        return latencies[min(index, len(latencies) - 1)]
+
+    def acquire(self) -> bool:
+        """Take a hedge out of the budget, if any is left"""
+        with self._lock:
+            if self.hedged >= self.budget * self.requests:
+                self.over_budget += 1
+                return False
+            self.hedged += 1
+            return True
+
+    def record(self, seconds: float) -> None:
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def won(self) -> None:
+        with self._lock:
+            self.hedge_wins += 1
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            delay = self._delay()
+            return {
+                "enabled": self.enabled,
+                "percentile": self.percentile,
+                "budget": self.budget,
+                "delay_ms": round(delay * 1000, 1) if delay else None,
+                "requests": self.requests,
+                "hedged": self.hedged,
+                "hedge_wins": self.hedge_wins,
+                "over_budget": self.over_budget,
+            }
+
+
+_hedging = HedgePolicy()
+
+
+def _create_rate_limiter(rpm: float, tpm: float,
+                         shared_path: str) -> RateLimiter:
+    return RateLimiter(rpm, tpm,
+                       SqliteQuotaStore(shared_path) if shared_path else None)
+
+
+_rate_limiter = _create_rate_limiter(RATE_LIMIT_RPM, RATE_LIMIT_TPM,
+                                     RATE_LIMIT_SHARED_PATH)
+
+
+def _apply_deadline(request: httpx.Request) -> None:
+    deadline = current_deadline()
+    if deadline is None:
+        return
+    seconds = deadline.timeout()
+    timeout = request.extensions.get("timeout", {})
+    request.extensions["timeout"] = {
+        key: seconds if value is None else min(value, seconds)
+        for key, value in timeout.items()
+    }
+
+
+def _estimate_tokens(request: httpx.Request) -> int:
+    try:
+        return _rate_limiter.estimate(request.content)
+    except httpx.RequestNotRead:
+        # Streaming body, nothing to estimate from
+        return 0
+
+
+def _duplicate(request: httpx.Request) -> httpx.Request:
+    return httpx.Request(request.method,
+                         request.url,
+                         headers=request.headers,
+                         stream=request.stream,
+                         extensions=dict(request.extensions))
+
+
+class _CountingTransport(httpx.HTTPTransport):
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        tokens = _estimate_tokens(request)
+        _rate_limiter.acquire(tokens)
+        # After waiting for the rate limit, which used up part of the time
+        _apply_deadline(request)
+        agent = current_agent()
+        started = time.perf_counter()
+        try:
+            response = self._hedged(request, tokens)
+        except Exception as e:
+            _count_failure(agent, e)
+            raise
+        seconds = time.perf_counter() - started
+        _hedging.record(seconds)
+        _count(agent, seconds, response.status_code)
+        _rate_limiter.observe(response.status_code, response.headers)
+        return response
+
+    def _hedged(self, request: httpx.Request, tokens: int) -> httpx.Response:
+        delay = _hedging.delay()
+        if delay is None:
+            return self._send(request)
+        # Both attempts run on the hedge threads so that the caller can
+        # stop waiting for the first one after the delay
+        attempts = [_hedge_executor().submit(self._send, request)]
+        done, _ = futures.wait(attempts, timeout=delay)
+        if not done and _can_hedge(tokens):
+            attempts.append(_hedge_executor().submit(self._send,
+                                                     _duplicate(request)))
+        return _first_response(attempts)
+
+    def _send(self, request: httpx.Request) -> httpx.Response:
+        request.extensions["trace"] = _stats.trace
+        _stats.started()
+        try:
+            return super().handle_request(request)
+        finally:
+            _stats.finished()
+
+
+class _AsyncCountingTransport(httpx.AsyncHTTPTransport):
+
+    async def handle_async_request(self,
+                                   request: httpx.Request) -> httpx.Response:
+        tokens = _estimate_tokens(request)
+        await _rate_limiter.aacquire(tokens)
+        _apply_deadline(request)
+        agent = current_agent()
+        started = time.perf_counter()
+        try:
+            response = await self._hedged(request, tokens)
+        except Exception as e:
+            _count_failure(agent, e)
+            raise
+        seconds = time.perf_counter() - started
+        _hedging.record(seconds)
+        _count(agent, seconds, response.status_code)
+        await _rate_limiter.aobserve(response.status_code, response.headers)
+        return response
+
+    async def _hedged(self, request: httpx.Request,
+                      tokens: int) -> httpx.Response:
+        delay = _hedging.delay()
+        if delay is None:
+            return await self._send(request)
+        attempts = [asyncio.ensure_future(self._send(request))]
+        try:
+            done, _ = await asyncio.wait(attempts, timeout=delay)
+            if not done and await _acan_hedge(tokens):
+                attempts.append(
+                    asyncio.ensure_future(self._send(_duplicate(request))))
+            return await _afirst_response(attempts)
+        finally:
+            # Also when the caller is cancelled
+            for attempt in attempts:
+                attempt.cancel()
+
+    async def _send(self, request: httpx.Request) -> httpx.Response:
+        request.extensions["trace"] = _stats.atrace
+        _stats.started()
+        try:
+            return await super().handle_async_request(request)
+        finally:
+            _stats.finished()
+
+
+def _count(agent: "AgentMetrics | None", seconds: float,
+           status_code: int) -> None:
+    if agent is None:
+        return
+    agent.seconds.observe(seconds)
+    (agent.ok if status_code < 400 else agent.error).inc()
+
+
+def _count_failure(agent: "AgentMetrics | None", error: Exception) -> None:
+    if agent is None:
+        return
+    if isinstance(error, httpx.TimeoutException):
+        agent.timeout.inc()
+    else:
+        agent.error.inc()
+
+
+def _can_hedge(tokens: int) -> bool:
+    # A hedge is sent only if the quota has room for it right away
+    return _hedging.acquire() and _rate_limiter.try_acquire(tokens)
+
+
+async def _acan_hedge(tokens: int) -> bool:
+    return _hedging.acquire() and await _rate_limiter.atry_acquire(tokens)
+
+
+def _first_response(attempts: list[futures.Future]) -> httpx.Response:
+    """Response of the first attempt that succeeds; the others are dropped.
+
+    A sync request cannot be interrupted, so a losing attempt that already
+    started runs to completion and its response is closed unread.
+    """
+    errors = []
+    for attempt in futures.as_completed(attempts):
+        if attempt.exception() is not None:
+            errors.append(attempt.exception())
+            continue
+        for loser in attempts:
+            if loser is not attempt:
+                loser.cancel()
+                loser.add_done_callback(_close_response)
+        if attempt is not attempts[0]:
+            _hedging.won()
+        return attempt.result()
+    raise errors[0]
+
+
+def _close_response(attempt: futures.Future) -> None:
+    if not attempt.cancelled() and attempt.exception() is None:
+        attempt.result().close()
+
+
+async def _afirst_response(attempts: list[asyncio.Future]) -> httpx.Response:
+    """Response of the first attempt that succeeds; the others are cancelled"""
+    errors = []
+    pending = set(attempts)
+    while pending:
+        done, pending = await asyncio.wait(pending,
+                                           return_when=asyncio.FIRST_COMPLETED)
+        finished = [attempt for attempt in attempts if attempt in done]
+        errors += [a.exception() for a in finished if a.exception()]
+        responses = [a for a in finished if not a.exception()]
+        if responses:
+            # Attempts finishing together: keep the first, close the rest
+            for loser in responses[1:]:
+                await loser.result().aclose()
+            if responses[0] is not attempts[0]:
+                _hedging.won()
+            return responses[0].result()
+    raise errors[0]
+
+
+class _PerLoopTransport(httpx.AsyncBaseTransport):
+    """Sends each request through a transport of the running event loop.
+
+    A process may run several loops, one after the other (every
+    ``asyncio.run``) or at once (one per thread). A connection opened on one
+    of them cannot be used from another.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._transports: dict[asyncio.AbstractEventLoop,
+                               _AsyncCountingTransport] = {}
+
+    def _transport(self) -> "_AsyncCountingTransport":
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            transport = self._transports.get(loop)
+            if transport is None:
+                # The connections of a closed loop are dead; drop them
+                self._transports = {
+                    other: pool
+                    for other, pool in self._transports.items()
+                    if not other.is_closed()
+                }
+                transport = _AsyncCountingTransport(http2=HTTP2_AVAILABLE,
+                                                    limits=_limits())
+                self._transports[loop] = transport
+            return transport
+
+    async def handle_async_request(self,
+                                   request: httpx.Request) -> httpx.Response:
+        return await self._transport().handle_async_request(request)
+
+    async def aclose(self) -> None:
+        with self._lock:
+            transport = self._transports.pop(asyncio.get_running_loop(), None)
+        if transport is not None:
+            await transport.aclose()
+
+
+_lock = threading.Lock()
+_http_client: httpx.Client | None = None
+_async_http_client: httpx.AsyncClient | None = None
+_executor: futures.ThreadPoolExecutor | None = None
+
+
+def _hedge_executor() -> futures.ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            # Two attempts per request at most
+            _executor = futures.ThreadPoolExecutor(
+                max_workers=2 * MAX_CONNECTIONS,
+                thread_name_prefix="llm-hedge")
+        return _executor
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=MAX_CONNECTIONS,
+                        max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=KEEPALIVE_EXPIRY)
+
+
+def get_http_client() -> httpx.Client:
+    global _http_client
+    with _lock:
+        if _http_client is None:
+            _http_client = httpx.Client(transport=_CountingTransport(
+                http2=HTTP2_AVAILABLE, limits=_limits()))
+        return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """Shared async client, usable from any event loop"""
+    global _async_http_client
+    with _lock:
+        if _async_http_client is None:
+            _async_http_client = httpx.AsyncClient(
+                transport=_PerLoopTransport())
+        return _async_http_client
+
+
+def create_chat_model(model: str, temperature: float) -> "ChatOpenAI":
+    """Create a ChatOpenAI that uses the shared connection pools"""
+    # langchain_openai takes over a second to import; only pay for it when
+    # the first model is created, not when a module imports this one
+    from langchain_openai import ChatOpenAI
+    return ChatOpenAI(model=model,
+                      temperature=temperature,
+                      http_client=get_http_client(),
+                      http_async_client=get_async_http_client())
+
+
+def configure_hedging(enabled: bool = True,
+                      percentile: float = HEDGE_PERCENTILE,
+                      budget: float = HEDGE_BUDGET) -> None:
+    """Replace the hedging settings read from the environment"""
+    global _hedging
+    _hedging = HedgePolicy(enabled, percentile, budget)
+
+
+def configure_rate_limit(rpm: float = RATE_LIMIT_RPM,
+                         tpm: float = RATE_LIMIT_TPM,
+                         shared_path: str = RATE_LIMIT_SHARED_PATH) -> None:
+    """Replace the rate limits read from the environment"""
+    global _rate_limiter
+    _rate_limiter = _create_rate_limiter(rpm, tpm, shared_path)
+
+
+def pool_stats() -> dict[str, Any]:
+    return {
+        **_stats.snapshot(),
+        "hedging": _hedging.snapshot(),
+        "rate_limit": _rate_limiter.snapshot(),
+    }
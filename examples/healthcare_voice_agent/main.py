@@ -1,13 +1,21 @@
+import contextvars
 import os
-from typing import Any, Dict, List, Optional, TypedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import Any, Dict, Iterable, List, Optional, TypedDict
 
 import traceroot
+from deadline import Deadline, current_deadline, deadline_scope
 from dotenv import load_dotenv
+from graph_render import render_graph
+from langchain_core.runnables import RunnableLambda
 from langgraph.graph import END, StateGraph
+from llm_client import pool_stats
 from plan_agent import create_voice_plan_agent
+from profiling import profile, should_profile
 from response_agent import create_voice_response_agent
 from scheduling_agent import create_scheduling_agent
-from stt_agent import create_stt_agent
+from stt_agent import create_stt_agent, wav_chunks
 from traceroot.tracer import TraceOptions, trace
 from tts_agent import create_tts_agent
 
@@ -15,6 +23,15 @@ load_dotenv()
 
 logger = traceroot.get_logger()
 
+# Time budget of a voice query, in seconds; 0 disables it
+DEFAULT_DEADLINE_SECONDS = float(
+    os.getenv("VOICE_AGENT_DEADLINE_SECONDS", "30"))
+# Words of final transcript after which a streamed query starts planning,
+# before the caller has finished speaking; 0 waits for the whole transcript.
+# Each later final segment plans again, and only a plan of the whole
+# transcript is used.
+EARLY_PLAN_WORDS = int(os.getenv("VOICE_AGENT_EARLY_PLAN_WORDS", "12"))
+
 
 class VoiceAgentState(TypedDict):
     """State object for the voice agent workflow"""
@@ -46,16 +63,23 @@ class VoiceAgentSystem:
         logger.info("✅ TTS Agent initialized")
         self.graph = self._build_graph()
         logger.info("✅ Workflow graph compiled successfully")
+        # Time budget of a query, see process_voice_query
+        self.deadline_seconds = DEFAULT_DEADLINE_SECONDS
 
     def _build_graph(self):
         """Build the enhanced voice processing workflow graph"""
         workflow = StateGraph(VoiceAgentState)
 
-        # Add nodes with simple Mermaid-compatible names (no spaces, no special chars)
+        # Add nodes with simple Mermaid-compatible names (no spaces, no special chars).
+        # LLM nodes have an async version used by graph.ainvoke; the others
+        # then run in a thread.
         workflow.add_node("SpeechToText", self.transcribe_node)
-        workflow.add_node("Planning", self.plan_node)
+        workflow.add_node(
+            "Planning", RunnableLambda(self.plan_node, afunc=self.aplan_node))
         workflow.add_node("DoctorSearch", self.doctor_search_node)
-        workflow.add_node("Response", self.response_node)
+        workflow.add_node(
+            "Response",
+            RunnableLambda(self.response_node, afunc=self.aresponse_node))
         workflow.add_node("TextToSpeech", self.tts_node)
         workflow.add_node("Final", self.final_node)
 
@@ -77,6 +101,9 @@ class VoiceAgentSystem:
     @trace(TraceOptions(trace_params=True, trace_return_value=True))
     def transcribe_node(self, state: VoiceAgentState) -> Dict[str, Any]:
         """Process audio input to text"""
+        if state["transcript"] is not None:
+            # Transcribed while the audio streamed in
+            return {}
         logger.info("\n🎤 Starting Speech-to-Text processing...")
         try:
             result = self.stt_agent.transcribe_audio(state["input_path"])
@@ -91,16 +118,44 @@ class VoiceAgentSystem:
     @trace(TraceOptions(trace_params=True, trace_return_value=True))
     def plan_node(self, state: VoiceAgentState) -> Dict[str, Any]:
         """Create healthcare response plan"""
+        if state["plan"] is not None:
+            # Planned while the audio streamed in
+            return {}
         logger.info("\n🧠 Starting response planning...")
+        if self._out_of_time("planning"):
+            return {}
         try:
             plan = self.plan_agent.plan_voice_response(state["transcript"])
-            logger.info("✅ Planning completed successfully")
-            logger.info(f"📋 Plan: {plan}")
-            return {"plan": plan}
+            return self._plan_update(plan)
         except Exception as e:
+            if self._out_of_time("planning"):
+                return {}
             logger.error(f"❌ Planning failed: {str(e)}")
             return {"error": f"Planning failed: {str(e)}"}
 
+    @trace(TraceOptions(trace_params=True, trace_return_value=True))
+    async def aplan_node(self, state: VoiceAgentState) -> Dict[str, Any]:
+        """Async version of plan_node"""
+        if state["plan"] is not None:
+            return {}
+        logger.info("\n🧠 Starting response planning...")
+        if self._out_of_time("planning"):
+            return {}
+        try:
+            plan = await self.plan_agent.plan_voice_response_async(
+                state["transcript"])
+            return self._plan_update(plan)
+        except Exception as e:
+            if self._out_of_time("planning"):
+                return {}
+            logger.error(f"❌ Planning failed: {str(e)}")
+            return {"error": f"Planning failed: {str(e)}"}
+
+    def _plan_update(self, plan: Dict[str, Any]) -> Dict[str, Any]:
+        logger.info("✅ Planning completed successfully")
+        logger.info(f"📋 Plan: {plan}")
+        return {"plan": plan}
+
     @trace(TraceOptions(trace_params=True, trace_return_value=True))
     def doctor_search_node(self, state: VoiceAgentState) -> Dict[str, Any]:
         """Search for appropriate doctors based on patient needs"""
@@ -133,20 +188,64 @@ class VoiceAgentSystem:
     def response_node(self, state: VoiceAgentState) -> Dict[str, Any]:
         """Generate enhanced response with doctor recommendations"""
         logger.info("\n💬 Starting response generation...")
+        if state["plan"] is None or self._out_of_time("response generation"):
+            return self._fallback_update(state)
         try:
             response = self.response_agent.generate_response(
-                transcript=state["transcript"],
-                plan=state["plan"]["plan"],
-                response_type=state["plan"]["response_type"],
-                tone=state["plan"]["tone"],
-                doctor_recommendations=state["doctor_recommendations"])
-            logger.info("✅ Response generated successfully")
-            logger.info(f"📄 Response preview: {response[:200]}...")
-            return {"response": response}
+                **self._response_args(state))
+            return self._response_update(response)
         except Exception as e:
+            if self._out_of_time("response generation"):
+                return self._fallback_update(state)
             logger.error(f"❌ Response generation failed: {str(e)}")
             return {"error": f"Response generation failed: {str(e)}"}
 
+    @trace(TraceOptions(trace_params=True, trace_return_value=True))
+    async def aresponse_node(self, state: VoiceAgentState) -> Dict[str, Any]:
+        """Async version of response_node"""
+        logger.info("\n💬 Starting response generation...")
+        if state["plan"] is None or self._out_of_time("response generation"):
+            return self._fallback_update(state)
+        try:
+            response = await self.response_agent.generate_response_async(
+                **self._response_args(state))
+            return self._response_update(response)
+        except Exception as e:
+            if self._out_of_time("response generation"):
+                return self._fallback_update(state)
+            logger.error(f"❌ Response generation failed: {str(e)}")
+            return {"error": f"Response generation failed: {str(e)}"}
+
+    def _response_args(self, state: VoiceAgentState) -> Dict[str, Any]:
+        return {
+            "transcript": state["transcript"],
+            "plan": state["plan"]["plan"],
+            "response_type": state["plan"]["response_type"],
+            "tone": state["plan"]["tone"],
+            "doctor_recommendations": state["doctor_recommendations"]
+        }
+
+    def _response_update(self, response: str) -> Dict[str, Any]:
+        logger.info("✅ Response generated successfully")
+        logger.info(f"📄 Response preview: {response[:200]}...")
+        return {"response": response}
+
+    def _fallback_update(self, state: VoiceAgentState) -> Dict[str, Any]:
+        """Best partial answer when there is no plan or no time left"""
+        response = self.response_agent.fallback_response(
+            state["doctor_recommendations"])
+        logger.warning(f"⚠️  Using fallback response: {response[:200]}...")
+        return {"response": response}
+
+    def _out_of_time(self, step: str) -> bool:
+        """Check whether the request deadline has passed before ``step``"""
+        deadline = current_deadline()
+        if deadline is None or not deadline.expired:
+            return False
+        logger.warning(f"⏰ Deadline of {deadline.seconds:g}s reached, "
+                       f"skipping {step}")
+        return True
+
     @trace(TraceOptions(trace_params=True, trace_return_value=True))
     def tts_node(self, state: VoiceAgentState) -> Dict[str, Any]:
         """Convert response to speech"""
@@ -236,10 +335,151 @@ class VoiceAgentSystem:
         return None
 
     @trace(TraceOptions(trace_params=True, trace_return_value=True))
-    def process_voice_query(self, input_path: str) -> str:
-        """Process voice query and return path to response audio"""
+    def process_voice_query(self,
+                            input_path: str,
+                            deadline_seconds: Optional[float] = None,
+                            profiled: Optional[bool] = None) -> str:
+        """Process voice query and return path to response audio
+
+        The LLM steps share a budget of ``deadline_seconds`` (default
+        ``deadline_seconds`` of the system, 0 for no limit): each call is
+        given the time left as its timeout, and once it is used up the
+        remaining LLM steps are skipped and a short fallback answer with the
+        doctor recommendations found so far is spoken instead. Speech
+        recognition and synthesis run locally and are not cut short.
+
+        With ``profiled`` (by default picked at ``PROFILE_SAMPLE_RATE``),
+        the query runs under the CPU and memory profiler of
+        ``profiling.py``, which writes its reports to ``PROFILE_DIR``.
+        """
+        logger.info(f"Processing voice query from: {input_path}")
+        with self._profiling(profiled), deadline_scope(
+                self._deadline(deadline_seconds)):
+            result = self.graph.invoke(self._initial_state(input_path))
+        return self._output_path(result)
+
+    @trace(TraceOptions(trace_params=True, trace_return_value=True))
+    async def process_voice_query_async(
+            self,
+            input_path: str,
+            deadline_seconds: Optional[float] = None,
+            profiled: Optional[bool] = None) -> str:
+        """Async version of process_voice_query"""
         logger.info(f"Processing voice query from: {input_path}")
-        initial_state = {
+        with self._profiling(profiled), deadline_scope(
+                self._deadline(deadline_seconds)):
+            result = await self.graph.ainvoke(self._initial_state(input_path))
+        return self._output_path(result)
+
+    def process_voice_stream(self,
+                             chunks: Iterable[bytes],
+                             sample_rate: int = 16000,
+                             deadline_seconds: Optional[float] = None,
+                             profiled: Optional[bool] = None) -> str:
+        """Process a voice query while its audio is still arriving
+
+        ``chunks`` is 16-bit mono PCM audio, e.g. from ``wav_chunks`` or
+        ``socket_chunks`` of ``stt_agent.py``. It is transcribed segment by
+        segment, and planning is prefetched in the background as soon as the
+        final segments hold ``EARLY_PLAN_WORDS`` words, then again on the
+        next final segment once the previous plan is done, instead of after
+        the last sample. The prefetched plan is only used if it was made on
+        the whole transcript; otherwise the graph plans as usual without
+        waiting for it. A failed transcription ends the query like in
+        process_voice_query. The deadline starts with the first chunk.
+        """
+        with self._profiling(profiled), deadline_scope(
+                self._deadline(deadline_seconds)):
+            state = self._initial_state(None)
+            executor = ThreadPoolExecutor(max_workers=1,
+                                          thread_name_prefix="early-plan")
+            try:
+                try:
+                    transcript, early_plan = self._transcribe_stream(
+                        chunks, sample_rate, executor)
+                except Exception as e:
+                    logger.error(f"❌ STT failed: {str(e)}")
+                    transcript, early_plan = "", None
+                    state["error"] = f"STT failed: {str(e)}"
+                state["transcript"] = transcript
+                if early_plan is not None:
+                    state["plan"] = self._early_plan(early_plan, transcript)
+            finally:
+                # A superseded plan still running must not hold up the graph
+                executor.shutdown(wait=False, cancel_futures=True)
+            if not transcript and not state["error"]:
+                state["error"] = "STT failed: no speech in the audio"
+            result = self.graph.invoke(state)
+        return self._output_path(result)
+
+    def process_voice_file_stream(self, input_path: str, **kwargs) -> str:
+        """Process a WAV file through process_voice_stream"""
+        sample_rate, chunks = wav_chunks(input_path)
+        return self.process_voice_stream(chunks, sample_rate, **kwargs)
+
+    def _transcribe_stream(
+        self, chunks: Iterable[bytes], sample_rate: int,
+        executor: ThreadPoolExecutor
+    ) -> tuple[str, Optional[tuple[str, Future]]]:
+        """Transcript of the stream, and the latest plan started early with
+        the text it plans on, if any
+        """
+        logger.info("\n🎤 Starting streaming Speech-to-Text processing...")
+        finals: List[str] = []
+        early_plan: Optional[tuple[str, Future]] = None
+        for segment in self.stt_agent.transcribe_stream(chunks, sample_rate):
+            if not segment.final:
+                logger.info(f"📝 Partial transcript: {segment.text}")
+                continue
+            finals.append(segment.text)
+            logger.info(f"📝 Final segment {segment.start:.1f}s-"
+                        f"{segment.end:.1f}s: {segment.text}")
+            words = sum(len(text.split()) for text in finals)
+            if EARLY_PLAN_WORDS and words >= EARLY_PLAN_WORDS:
+                if early_plan is not None and not early_plan[1].done():
+                    # Never queued behind a running plan; if speech goes on
+                    # past it, the graph plans on the whole transcript
+                    continue
+                logger.info(f"🧠 Planning on the {words} words so far")
+                text = " ".join(finals)
+                # Run in the deadline of the query
+                early_plan = text, executor.submit(
+                    contextvars.copy_context().run,
+                    self.plan_agent.plan_voice_response, text)
+        transcript = " ".join(finals)
+        logger.info(f"✅ STT completed, transcript: {transcript}")
+        return transcript, early_plan
+
+    def _early_plan(self, early_plan: tuple[str, Future],
+                    transcript: str) -> Optional[Dict[str, Any]]:
+        """Result of the plan started early if it was made on the whole
+        ``transcript``; None lets the graph plan
+        """
+        text, plan = early_plan
+        if text != transcript:
+            logger.info("🧠 Speech went on after the early plan, planning on "
+                        "the whole transcript")
+            return None
+        try:
+            return self._plan_update(plan.result())["plan"]
+        except Exception as e:
+            logger.warning(f"⚠️  Early planning failed, planning on the "
+                           f"whole transcript: {str(e)}")
+            return None
+
+    def _profiling(self, profiled: Optional[bool]) -> Any:
+        if profiled is None:
+            profiled = should_profile()
+        return profile("process_voice_query") if profiled else nullcontext()
+
+    def _deadline(self,
+                  deadline_seconds: Optional[float]) -> Optional[Deadline]:
+        if deadline_seconds is None:
+            deadline_seconds = self.deadline_seconds
+        return Deadline(deadline_seconds) if deadline_seconds else None
+
+    def _initial_state(self, input_path: Optional[str]) -> VoiceAgentState:
+        return {
             "transcript": None,
             "plan": None,
             "response": None,
@@ -250,8 +490,7 @@ class VoiceAgentSystem:
             "input_path": input_path
         }
 
-        result = self.graph.invoke(initial_state)
-
+    def _output_path(self, result: Dict[str, Any]) -> str:
         if result.get("error"):
             logger.error(f"Voice query processing failed: {result['error']}")
             raise Exception(result["error"])
@@ -259,6 +498,7 @@ class VoiceAgentSystem:
         logger.info(
             f"Voice query processed successfully, output: {result.get('output_path')}"
         )
+        logger.info(f"LLM connection pool: {pool_stats()}")
         return result.get("output_path")
 
     def draw_and_save_graph(
@@ -266,23 +506,12 @@ class VoiceAgentSystem:
         output_path:
         str = "./examples/healthcare_voice_agent/healthcare_voice_agent_graph.png",
     ) -> None:
-        """Draw the voice agent workflow graph and save it locally"""
-        try:
-            # Try to render the PNG
-            mermaid_png = self.graph.get_graph().draw_mermaid_png()
-            # if the above fails, try this:
-            # from langchain_core.runnables.graph import MermaidDrawMethod
-            # mermaid_png = self.graph.get_graph().draw_mermaid_png(
-            #   draw_method=MermaidDrawMethod.PYPPETEER)
-            with open(output_path, "wb") as f:
-                f.write(mermaid_png)
-            logger.info(f"✅ Workflow graph saved as PNG to: {output_path}")
+        """Draw the voice agent workflow graph and save it locally
 
-        except Exception as e:
-            logger.error(f"❌ Could not save workflow graph: {str(e)}")
-            logger.info(
-                "This is likely due to network connectivity issues with the Mermaid API."
-            )
+        Only renders when the graph changed since the last run, and only
+        with local renderers unless GRAPH_RENDER_REMOTE=1 is set.
+        """
+        if render_graph(self.graph.get_graph(), output_path) is None:
             logger.info(
                 "The voice agent will still work normally without the graph visualization."
             )
@@ -3,7 +3,7 @@ from typing import Any
 import traceroot
 from dotenv import load_dotenv
 from langchain.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
+from llm_client import create_chat_model
 from pydantic import BaseModel, Field
 from traceroot.tracer import TraceOptions, trace
 
@@ -30,7 +30,7 @@ class VoicePlanAgent:
     """Agent for planning responses to healthcare voice queries"""
 
     def __init__(self):
-        self.llm = ChatOpenAI(model="gpt-4", temperature=0.3)
+        self.llm = create_chat_model("gpt-4", temperature=0.3)
         self.system_prompt = (
             "You are a healthcare voice response planning agent. "
             "Your job is to analyze patient queries and create plans "
@@ -66,14 +66,27 @@ class VoicePlanAgent:
         Returns:
             Dict containing plan details for healthcare response generation
         """
+        response = self._chain().invoke(self._inputs(transcript))
+        return self._result(transcript, response)
+
+    @trace(TraceOptions(trace_params=True, trace_return_value=True))
+    async def plan_voice_response_async(self,
+                                        transcript: str) -> dict[str, Any]:
+        """Async version of :meth:`plan_voice_response`"""
+        response = await self._chain().ainvoke(self._inputs(transcript))
+        return self._result(transcript, response)
+
+    def _chain(self):
         structured_llm = self.llm.with_structured_output(VoicePlanResponse)
-        chain = self.plan_prompt | structured_llm
+        return self.plan_prompt | structured_llm
 
+    def _inputs(self, transcript: str) -> dict[str, Any]:
         formatted_prompt = self.plan_prompt.format(transcript=transcript)
         logger.info(f"HEALTHCARE PLAN AGENT prompt:\n{formatted_prompt}")
+        return {"transcript": transcript}
 
-        response = chain.invoke({"transcript": transcript})
-
+    def _result(self, transcript: str,
+                response: VoicePlanResponse) -> dict[str, Any]:
         logger.info(f"Healthcare planning for transcript: {transcript}")
         logger.info(f"Generated plan: {response.plan}")
         logger.info(f"Response type: {response.response_type}")
@@ -0,0 +1,266 @@
+"""Opt-in CPU and memory profiling of single requests.
+
+A profiled request runs under a sampling CPU profiler and ``tracemalloc``.
+When it finishes, two files named after its trace id are written to
+``PROFILE_DIR``:
+
+- ``<name>.folded``: the sampled stacks in folded format, one
+  ``frame;frame;frame count`` line per stack, which ``flamegraph.pl``,
+  speedscope and most flame graph viewers read directly.
+- ``<name>.alloc.txt``: the sites that allocated the most memory during the
+  request, and the peak of traced memory.
+
+Requests are profiled when ``PROFILE_HEADER_ENABLED=1`` and they carry the
+``X-Profile: 1`` header, or at random at ``PROFILE_SAMPLE_RATE`` (1 to
+profile every request). With neither set, :func:`install_profiling` adds
+nothing to the app and :func:`should_profile` is a constant check.
+
+The sampler runs on its own thread and reads the stacks of the thread the
+request started on. On an event loop, a sample only counts when the task
+running at that moment belongs to the request, i.e. was started by it or by
+one of its tasks. ``tracemalloc`` is process-wide, so allocations of
+concurrent requests are included in each other's reports.
+"""
+import asyncio
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+import weakref
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import Context, ContextVar
+from typing import TYPE_CHECKING, Any, Iterator, Mapping
+
+if TYPE_CHECKING:
+    from fastapi import FastAPI
+
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_HEADER_ENABLED = os.getenv("PROFILE_HEADER_ENABLED", "0") == "1"
+PROFILE_HEADER = "x-profile"
+PROFILE_DIR = os.getenv("PROFILE_DIR", ".profiles")
+# Time between two stack samples
+SAMPLE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+# Frames kept per allocation, and allocation sites reported
+TRACEMALLOC_FRAMES = 10
+TOP_ALLOCATIONS = 25
+
+
+def profiling_enabled() -> bool:
+    return PROFILE_HEADER_ENABLED or PROFILE_SAMPLE_RATE > 0
+
+
+def should_profile(headers: Mapping[str, str] | None = None) -> bool:
+    """Whether to profile a request with ``headers``"""
+    if (PROFILE_HEADER_ENABLED and headers is not None
+            and headers.get(PROFILE_HEADER) == "1"):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def _trace_id() -> str | None:
+    """Trace id of the current span, in the format of the traceroot logs"""
+    from opentelemetry.trace import get_current_span
+
+    trace_id = get_current_span().get_span_context().trace_id
+    if not trace_id:
+        return None
+    trace_hex = format(trace_id, "032x")
+    return f"1-{trace_hex[:8]}-{trace_hex[8:]}"
+
+
+def _frame_name(frame: Any) -> str:
+    code = frame.f_code
+    return (f"{code.co_name} "
+            f"({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+
+
+def _fold(frame: Any) -> str:
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class ProfileSession:
+    """Samples the stacks of one request until :meth:`stop`"""
+
+    def __init__(self, label: str, interval: float = SAMPLE_INTERVAL):
+        self.label = label
+        self.interval = interval
+        self.trace_id = _trace_id()
+        self.name = (f"{time.strftime('%Y%m%d-%H%M%S')}-"
+                     f"{self.trace_id or uuid.uuid4().hex[:12]}")
+        self.samples: Counter[str] = Counter()
+        # Tasks of the request, when it runs on an event loop
+        self.tasks: weakref.WeakSet[asyncio.Task] = weakref.WeakSet()
+        self._thread_id = threading.get_ident()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample,
+                                         name="profile-sampler",
+                                         daemon=True)
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+
+    def start(self) -> None:
+        try:
+            self._loop = asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            _track_tasks(self._loop)
+            self.tasks.add(asyncio.current_task())
+        self._sampler.start()
+
+    def stop(self) -> None:
+        self.seconds = time.perf_counter() - self.started
+        self._stopped.set()
+        self._sampler.join()
+
+    def _sample(self) -> None:
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            if self._loop is not None:
+                # Reading the loop's current task from this thread is a
+                # dict lookup; a stale answer only misattributes a sample
+                task = asyncio.current_task(self._loop)
+                if task is None or task not in self.tasks:
+                    continue
+            self.samples[_fold(frame)] += 1
+
+    def folded(self) -> str:
+        return "".join(f"{stack} {count}\n"
+                       for stack, count in self.samples.most_common())
+
+
+_session: ContextVar[ProfileSession | None] = ContextVar("profile_session",
+                                                         default=None)
+# Profiled requests in progress, which keep tracemalloc running
+_active = 0
+# Whether the tracing was started here, rather than by the application
+_started_tracing = False
+_lock = threading.Lock()
+
+
+def _track_tasks(loop: asyncio.AbstractEventLoop) -> None:
+    """Make tasks created on ``loop`` join the profile session of the
+    context they run in
+    """
+    factory = loop.get_task_factory()
+    if getattr(factory, "tracks_profiles", False):
+        return
+
+    def create_task(loop: asyncio.AbstractEventLoop,
+                    coro: Any,
+                    context: Context | None = None,
+                    **kwargs: Any) -> asyncio.Task:
+        if factory is not None:
+            task = factory(loop, coro, context=context, **kwargs)
+        else:
+            task = asyncio.Task(coro, loop=loop, context=context, **kwargs)
+        session = (context.get(_session)
+                   if context is not None else _session.get())
+        if session is not None:
+            session.tasks.add(task)
+        return task
+
+    create_task.tracks_profiles = True
+    loop.set_task_factory(create_task)
+
+
+def _start_tracemalloc() -> tracemalloc.Snapshot:
+    global _active, _started_tracing
+    with _lock:
+        _active += 1
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            _started_tracing = True
+        tracemalloc.reset_peak()
+        return tracemalloc.take_snapshot()
+
+
+def _stop_tracemalloc() -> tuple[tracemalloc.Snapshot, int]:
+    global _active, _started_tracing
+    with _lock:
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        _active -= 1
+        # Tracing slows every allocation down; stop it once no profile
+        # needs it, unless the application had turned it on
+        if _started_tracing and _active == 0:
+            tracemalloc.stop()
+            _started_tracing = False
+        return snapshot, peak
+
+
+def _allocation_report(session: ProfileSession, before: tracemalloc.Snapshot,
+                       after: tracemalloc.Snapshot, peak: int) -> str:
+    # Leave out the allocations of the profiler itself
+    ignore = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__)
+    ]
+    stats = after.filter_traces(ignore).compare_to(
+        before.filter_traces(ignore), "traceback")
+    lines = [
+        f"label: {session.label}",
+        f"trace_id: {session.trace_id or '-'}",
+        f"seconds: {session.seconds:.3f}",
+        f"cpu_samples: {sum(session.samples.values())}",
+        f"peak_traced_memory_kib: {peak / 1024:.1f}",
+        "",
+        f"Top {TOP_ALLOCATIONS} allocation sites by size:",
+    ]
+    for stat in stats[:TOP_ALLOCATIONS]:
+        lines.append(f"{stat.size_diff / 1024:+.1f} KiB, "
+                     f"{stat.count_diff:+d} blocks")
+        lines += ["    " + line for line in stat.traceback.format()]
+    return "\n".join(lines) + "\n"
+
+
+@contextmanager
+def profile(label: str,
+            directory: str = PROFILE_DIR) -> Iterator[ProfileSession]:
+    """Profile the code run in the ``with`` block and write the reports"""
+    before = _start_tracemalloc()
+    session = ProfileSession(label)
+    token = _session.set(session)
+    session.start()
+    try:
+        yield session
+    finally:
+        session.stop()
+        _session.reset(token)
+        after, peak = _stop_tracemalloc()
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, session.name)
+        with open(f"{path}.folded", "w") as f:
+            f.write(session.folded())
+        with open(f"{path}.alloc.txt", "w") as f:
+            f.write(_allocation_report(session, before, after, peak))
+
+
+def install_profiling(app: "FastAPI") -> None:
+    """Profile the requests of ``app`` selected by :func:`should_profile`.
+
+    Does nothing when profiling is disabled. The response of a profiled
+    request carries the name of its reports in an ``X-Profile-Id`` header.
+    """
+    if not profiling_enabled():
+        return
+
+    @app.middleware("http")
+    async def profile_requests(request: Any, call_next: Any) -> Any:
+        if not should_profile(request.headers):
+            return await call_next(request)
+        with profile(f"{request.method} {request.url.path}") as session:
+            response = await call_next(request)
+        response.headers["X-Profile-Id"] = session.name
+        return response
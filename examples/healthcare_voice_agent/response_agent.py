@@ -1,9 +1,9 @@
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional
 
 import traceroot
 from dotenv import load_dotenv
 from langchain.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
+from llm_client import create_chat_model
 from traceroot.tracer import TraceOptions, trace
 
 load_dotenv()
@@ -15,7 +15,7 @@ class VoiceResponseAgent:
     """Agent for generating healthcare-focused voice responses"""
 
     def __init__(self):
-        self.llm = ChatOpenAI(model="gpt-4", temperature=0.7)
+        self.llm = create_chat_model("gpt-4", temperature=0.7)
         # Maximum words for roughly 30 seconds of speech (assuming 150-200 words per minute)
         self.max_words = 85
         self.system_prompt = (
@@ -75,27 +75,46 @@ class VoiceResponseAgent:
             Generated text response optimized for medical communication
         """
         chain = self.response_prompt | self.llm
+        response = chain.invoke(
+            self._inputs(transcript, plan, response_type, tone,
+                         doctor_recommendations))
+        return self._result(transcript, response_type, tone, response)
 
+    @trace(TraceOptions(trace_params=True, trace_return_value=True))
+    async def generate_response_async(
+            self,
+            transcript: str,
+            plan: str,
+            response_type: str,
+            tone: str,
+            doctor_recommendations: Optional[List[Dict]] = None) -> str:
+        """Async version of :meth:`generate_response`"""
+        chain = self.response_prompt | self.llm
+        response = await chain.ainvoke(
+            self._inputs(transcript, plan, response_type, tone,
+                         doctor_recommendations))
+        return self._result(transcript, response_type, tone, response)
+
+    def _inputs(
+            self, transcript: str, plan: str, response_type: str, tone: str,
+            doctor_recommendations: Optional[List[Dict]]) -> Dict[str, Any]:
         # Format doctor recommendations for the prompt
         doctor_text = self._format_doctor_recommendations(
             doctor_recommendations)
 
-        formatted_prompt = self.response_prompt.format(
-            transcript=transcript,
-            plan=plan,
-            response_type=response_type,
-            tone=tone,
-            doctor_recommendations=doctor_text)
-        logger.info(f"HEALTHCARE RESPONSE AGENT prompt:\n{formatted_prompt}")
-
-        response = chain.invoke({
+        inputs = {
             "transcript": transcript,
             "plan": plan,
             "response_type": response_type,
             "tone": tone,
             "doctor_recommendations": doctor_text
-        })
+        }
+        formatted_prompt = self.response_prompt.format(**inputs)
+        logger.info(f"HEALTHCARE RESPONSE AGENT prompt:\n{formatted_prompt}")
+        return inputs
 
+    def _result(self, transcript: str, response_type: str, tone: str,
+                response) -> str:
         # Clean up the response for voice synthesis
         text_response = response.content.strip()
         text_response = self._clean_for_voice(text_response)
@@ -108,6 +127,19 @@ class VoiceResponseAgent:
 
         return text_response
 
+    def fallback_response(self,
+                          doctor_recommendations: Optional[List[Dict]] = None
+                          ) -> str:
+        """Short answer spoken when there is no time to generate one"""
+        text = ("I'm sorry, I could not prepare a full answer in time. "
+                "If your symptoms are severe or getting worse, please seek "
+                "medical care right away.")
+        if doctor_recommendations:
+            text += (
+                " These doctors may be able to help: " +
+                self._format_doctor_recommendations(doctor_recommendations))
+        return self._clean_for_voice(text)
+
     def _format_doctor_recommendations(
             self, recommendations: Optional[List[Dict]]) -> str:
         """Format doctor recommendations for natural speech"""
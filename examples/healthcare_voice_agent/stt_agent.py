@@ -1,8 +1,17 @@
 import os
-import tempfile
+import re
+import socket
+import struct
+import threading
+import time
+import wave
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Iterable, Iterator, Optional
 
+import numpy as np
 import soundfile as sf
-import speech_recognition as sr
 import traceroot
 from dotenv import load_dotenv
 from traceroot.tracer import TraceOptions, trace
@@ -11,15 +20,315 @@ load_dotenv()
 
 logger = traceroot.get_logger()
 
+# Speech recognition engine: "whisper" (PyTorch) or "faster-whisper"
+# (CTranslate2, int8-quantized by default)
+STT_BACKEND = os.getenv("STT_BACKEND", "whisper")
+# Whisper model held by the process (tiny, base, small, medium, large, ...)
+WHISPER_MODEL = os.getenv("STT_WHISPER_MODEL", "base")
+# Device of the model (cpu, cuda, cuda:1, ...); CUDA when available if unset
+WHISPER_DEVICE = os.getenv("STT_WHISPER_DEVICE") or None
+# CPU threads used by the engine, 0 for its default
+STT_CPU_THREADS = int(os.getenv("STT_CPU_THREADS", "0"))
+# Beam size of the decoder, 0 for the engine's default (greedy decoding for
+# whisper, 5 for faster-whisper)
+STT_BEAM_SIZE = int(os.getenv("STT_BEAM_SIZE", "0"))
+# faster-whisper only: precision of the weights (int8, int8_float16,
+# float16, float32) and transcriptions run in parallel
+STT_COMPUTE_TYPE = os.getenv("STT_COMPUTE_TYPE", "int8")
+STT_WORKERS = int(os.getenv("STT_WORKERS", "1"))
+# Whisper transcribes 16 kHz mono audio
+WHISPER_SAMPLE_RATE = 16000
+
+# Streaming transcription: audio is transcribed in windows of at most
+# STT_STREAM_WINDOW_SECONDS, cut early at a pause of STT_STREAM_PAUSE_SECONDS.
+# A window cut without a pause overlaps the next one by
+# STT_STREAM_OVERLAP_SECONDS so that no word is lost at the cut. While a
+# window fills up, it is transcribed every STT_STREAM_STEP_SECONDS of new
+# audio as a partial result.
+STREAM_WINDOW_SECONDS = float(os.getenv("STT_STREAM_WINDOW_SECONDS", "10"))
+STREAM_OVERLAP_SECONDS = float(os.getenv("STT_STREAM_OVERLAP_SECONDS", "1"))
+STREAM_STEP_SECONDS = float(os.getenv("STT_STREAM_STEP_SECONDS", "2"))
+STREAM_PAUSE_SECONDS = float(os.getenv("STT_STREAM_PAUSE_SECONDS", "0.5"))
+# Shortest window cut at a pause, so that short gaps between words do not
+# end a segment
+STREAM_MIN_SEGMENT_SECONDS = 1.5
+# Words compared when removing the overlap of two windows
+MAX_OVERLAP_WORDS = 8
+# Taps of the low-pass filter applied before downsampling
+LOWPASS_TAPS = 63
+
+
+@dataclass
+class TranscriptSegment:
+    """Text of the audio between ``start`` and ``end`` seconds.
+
+    A partial segment may still change; a final one will not, and the final
+    segments of a stream together make up its transcript.
+    """
+    text: str
+    start: float
+    end: float
+    final: bool
+
+
+def wav_chunks(audio_file_path: str,
+               chunk_seconds: float = 0.5) -> tuple[int, Iterator[bytes]]:
+    """Sample rate and 16-bit mono PCM chunks of a WAV file, read lazily"""
+    wav = wave.open(audio_file_path, "rb")
+    if wav.getsampwidth() != 2:
+        wav.close()
+        raise ValueError("Only 16-bit WAV files can be streamed")
+    rate, channels = wav.getframerate(), wav.getnchannels()
+
+    def chunks() -> Iterator[bytes]:
+        with wav:
+            while frames := wav.readframes(int(rate * chunk_seconds)):
+                if channels > 1:
+                    samples = np.frombuffer(frames, dtype=np.int16)
+                    frames = samples.reshape(-1, channels).mean(axis=1).astype(
+                        np.int16).tobytes()
+                yield frames
+
+    return rate, chunks()
+
+
+def socket_chunks(sock: socket.socket,
+                  chunk_bytes: int = 16000) -> Iterator[bytes]:
+    """16-bit mono PCM chunks received on ``sock`` until the peer closes it"""
+    pending = b""
+    while data := sock.recv(chunk_bytes):
+        data = pending + data
+        # Keep whole samples only
+        cut = len(data) - len(data) % 2
+        pending = data[cut:]
+        if cut:
+            yield data[:cut]
+
+
+def load_audio(audio_file_path: str) -> np.ndarray:
+    """
+    Decode an audio file in memory for Whisper
+
+    PCM WAV files are memory-mapped rather than read; other formats are
+    decoded with soundfile.
+
+    Args:
+        audio_file_path: Path to the audio file (.wav, .flac, .ogg, etc.)
+
+    Returns:
+        16 kHz mono float32 samples in [-1, 1]
+    """
+    wav = _map_wav(audio_file_path)
+    if wav is not None:
+        samples, rate = wav
+    else:
+        samples, rate = sf.read(audio_file_path,
+                                dtype="float32",
+                                always_2d=True)
+    # Downmix to mono, converting to float32 on the way
+    audio = samples.mean(axis=1, dtype=np.float32)
+    if samples.dtype == np.int16:
+        audio /= 32768
+    return resample(audio, rate)
+
+
+def resample(audio: np.ndarray,
+             rate: int,
+             target_rate: int = WHISPER_SAMPLE_RATE) -> np.ndarray:
+    """Resample float32 ``audio`` from ``rate`` to ``target_rate`` by linear
+    interpolation, low-pass filtered first when downsampling so that the
+    frequencies above the new Nyquist rate do not fold back into speech
+    """
+    if rate == target_rate or not len(audio):
+        return audio
+    if rate > target_rate:
+        # Full convolution cut back to the input: "same" would return the
+        # length of the filter for buffers shorter than it
+        filtered = np.convolve(audio, _lowpass(target_rate / rate))
+        delay = LOWPASS_TAPS // 2
+        audio = filtered[delay:delay + len(audio)]
+    positions = np.arange(int(
+        len(audio) * target_rate / rate)) * (rate / target_rate)
+    return np.interp(positions, np.arange(len(audio)),
+                     audio).astype(np.float32)
+
+
+@lru_cache(maxsize=8)
+def _lowpass(cutoff: float) -> np.ndarray:
+    """Windowed-sinc filter passing ``cutoff`` of the Nyquist rate"""
+    taps = np.arange(LOWPASS_TAPS) - LOWPASS_TAPS // 2
+    kernel = np.sinc(cutoff * taps) * np.hanning(LOWPASS_TAPS)
+    return (kernel / kernel.sum()).astype(np.float32)
+
+
+def _map_wav(audio_file_path: str) -> Optional[tuple[np.ndarray, int]]:
+    """Memory-mapped samples (frames x channels) and sample rate of a 16-bit
+    or float32 PCM WAV file; None for anything else
+    """
+    fmt = None
+    with open(audio_file_path, "rb") as f:
+        header = f.read(12)
+        if header[:4] != b"RIFF" or header[8:] != b"WAVE":
+            return None
+        while len(chunk := f.read(8)) == 8:
+            kind, size = chunk[:4], int.from_bytes(chunk[4:], "little")
+            if kind == b"data":
+                offset = f.tell()
+                break
+            if kind == b"fmt " and size >= 16:
+                fmt = struct.unpack("<HHIIHH", f.read(16))
+                size -= 16
+            # Chunks are padded to an even size
+            f.seek(size + size % 2, os.SEEK_CUR)
+        else:
+            return None
+    if fmt is None:
+        return None
+    tag, channels, rate, _, _, bits = fmt
+    dtype = {(1, 16): np.int16, (3, 32): np.float32}.get((tag, bits))
+    if dtype is None or not channels:
+        return None
+    frame_size = channels * np.dtype(dtype).itemsize
+    # The size in the header is unreliable for recordings that were cut off
+    size = min(size, os.path.getsize(audio_file_path) - offset)
+    samples = np.memmap(audio_file_path,
+                        dtype=dtype,
+                        mode="r",
+                        offset=offset,
+                        shape=(size // frame_size, channels))
+    return samples, rate
+
+
+class SpeechModel(ABC):
+    """Interface of a speech recognition engine; implementations are loaded
+    once, shared by the agents of the process and must be thread-safe
+    """
+    name: str
+    device: str
+
+    @abstractmethod
+    def transcribe(self, audio: np.ndarray, language: str = "en") -> str:
+        """Text of ``audio``, 16 kHz mono float32 samples in [-1, 1]"""
+
+    def warm_up(self) -> None:
+        """Run a second of silence through the model, so that the first
+        request does not pay for the lazy initialization of its kernels
+        """
+        self.transcribe(np.zeros(WHISPER_SAMPLE_RATE, dtype=np.float32))
+
+
+class WhisperModel(SpeechModel):
+    """OpenAI Whisper on PyTorch.
+
+    Whisper hooks its key/value cache into the model for the length of a
+    transcription, so the transcriptions of one model run one at a time.
+    """
+
+    def __init__(self,
+                 name: str,
+                 device: Optional[str] = None,
+                 cpu_threads: int = STT_CPU_THREADS,
+                 beam_size: int = STT_BEAM_SIZE):
+        import torch
+        import whisper
+
+        if cpu_threads:
+            # PyTorch only has a process-wide setting
+            torch.set_num_threads(cpu_threads)
+        self.name = name
+        self.model = whisper.load_model(name, device=device)
+        self.device = str(self.model.device)
+        # Half precision is only supported on GPUs
+        self.fp16 = self.model.device.type == "cuda"
+        self.options = {"beam_size": beam_size} if beam_size else {}
+        self._lock = threading.Lock()
+
+    def transcribe(self, audio: np.ndarray, language: str = "en") -> str:
+        with self._lock:
+            result = self.model.transcribe(audio,
+                                           language=language,
+                                           fp16=self.fp16,
+                                           **self.options)
+        return result["text"]
+
+
+class FasterWhisperModel(SpeechModel):
+    """Whisper converted to CTranslate2 by faster-whisper.
+
+    With int8 weights it runs several times faster than PyTorch Whisper on
+    CPU, for about the same accuracy. Up to ``workers`` transcriptions run in
+    parallel, each on ``cpu_threads`` threads.
+    """
+
+    def __init__(self,
+                 name: str,
+                 device: Optional[str] = None,
+                 cpu_threads: int = STT_CPU_THREADS,
+                 beam_size: int = STT_BEAM_SIZE,
+                 compute_type: str = STT_COMPUTE_TYPE,
+                 workers: int = STT_WORKERS):
+        from faster_whisper import WhisperModel as CTranslate2Whisper
+
+        self.name = name
+        self.model = CTranslate2Whisper(name,
+                                        device=device or "auto",
+                                        compute_type=compute_type,
+                                        cpu_threads=cpu_threads,
+                                        num_workers=workers)
+        self.device = self.model.model.device
+        self.beam_size = beam_size or 5
+
+    def transcribe(self, audio: np.ndarray, language: str = "en") -> str:
+        segments, _ = self.model.transcribe(audio,
+                                            language=language,
+                                            beam_size=self.beam_size)
+        # The segments are decoded as they are iterated
+        return "".join(segment.text for segment in segments)
+
+
+BACKENDS: dict[str, type[SpeechModel]] = {
+    "whisper": WhisperModel,
+    "faster-whisper": FasterWhisperModel,
+}
+
+_models: dict[tuple[str, str, Optional[str]], SpeechModel] = {}
+_models_lock = threading.Lock()
+
+
+def load_speech_model(backend: str = STT_BACKEND,
+                      name: str = WHISPER_MODEL,
+                      device: Optional[str] = WHISPER_DEVICE) -> SpeechModel:
+    """The model ``name`` of ``backend`` on ``device``, loaded and warmed up
+    by the first caller and shared with the later ones
+    """
+    key = (backend, name, device)
+    model = _models.get(key)
+    if model is not None:
+        return model
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown STT backend: {backend}")
+    with _models_lock:
+        model = _models.get(key)
+        if model is None:
+            started = time.perf_counter()
+            model = BACKENDS[backend](name, device)
+            model.warm_up()
+            logger.info(f"Loaded {backend} model {name} on {model.device} in "
+                        f"{time.perf_counter() - started:.1f}s")
+            _models[key] = model
+        return model
+
 
 class STTAgent:
     """Speech-to-Text Agent for converting audio to text"""
 
-    def __init__(self):
-        self.recognizer = sr.Recognizer()
-        # Adjust for ambient noise to improve recognition
-        self.recognizer.energy_threshold = 300
-        self.recognizer.dynamic_energy_threshold = True
+    def __init__(self, model: Optional[SpeechModel] = None):
+        # Loaded here rather than per transcription, so the first query
+        # does not pay for it either; STT_BACKEND selects the engine
+        self.model = model or load_speech_model()
+        # Level (RMS of 16-bit samples) below which streamed audio is
+        # treated as silence
+        self.energy_threshold = 300
 
     @trace(TraceOptions(trace_params=True, trace_return_value=True))
     def transcribe_audio(self, audio_file_path: str) -> dict[str, str]:
@@ -34,53 +343,40 @@ class STTAgent:
         """
         logger.info(f"Starting STT transcription for: {audio_file_path}")
         try:
-            # Convert audio to WAV format if needed
-            wav_path = self._ensure_wav_format(audio_file_path)
-            logger.info(f"Audio file prepared for transcription: {wav_path}")
-
-            # Load audio file
-            with sr.AudioFile(wav_path) as source:
-                # Adjust for ambient noise
-                self.recognizer.adjust_for_ambient_noise(source, duration=0.5)
-                # Record the audio
-                audio_data = self.recognizer.record(source)
+            # Decoded and resampled in memory, without a temporary WAV file
+            audio = load_audio(audio_file_path)
+            logger.info("Audio decoded for transcription: "
+                        f"{len(audio) / WHISPER_SAMPLE_RATE:.1f}s")
 
             # Use Whisper for transcription
             try:
-                transcript = self.recognizer.recognize_whisper(
-                    audio_data,
-                    language="en"  # Use standard language code
-                )
-
-                # Clean up temporary file if we created one
-                if wav_path != audio_file_path:
-                    os.unlink(wav_path)
-
-                logger.info(f"STT transcription successful: {transcript}")
-                return {
-                    "success": True,
-                    "transcript": transcript,
-                    "language": "en",  # Return standard language code
-                    "error": None
-                }
-
-            except sr.UnknownValueError:
-                logger.error("STT could not understand audio")
+                transcript = self._recognize(audio)
+            except Exception as e:
+                logger.error(f"STT Whisper error: {str(e)}")
                 return {
                     "success": False,
                     "transcript": "",
                     "language": None,
-                    "error": "Could not understand audio"
+                    "error": f"Whisper error: {str(e)}"
                 }
-            except sr.RequestError as e:
-                logger.error(f"STT Whisper error: {str(e)}")
+
+            if not transcript:
+                logger.error("STT could not understand audio")
                 return {
                     "success": False,
                     "transcript": "",
                     "language": None,
-                    "error": f"Whisper error: {str(e)}"
+                    "error": "Could not understand audio"
                 }
 
+            logger.info(f"STT transcription successful: {transcript}")
+            return {
+                "success": True,
+                "transcript": transcript,
+                "language": "en",  # Return standard language code
+                "error": None
+            }
+
         except Exception as e:
             logger.error(f"STT audio processing error: {str(e)}")
             return {
@@ -90,35 +386,140 @@ class STTAgent:
                 "error": f"Audio processing error: {str(e)}"
             }
 
-    def _ensure_wav_format(self, audio_file_path: str) -> str:
+    def _recognize(self, audio: np.ndarray) -> str:
+        return self.model.transcribe(
+            audio,
+            language="en"  # Use standard language code
+        ).strip()
+
+    def transcribe_stream(
+            self,
+            chunks: Iterable[bytes],
+            sample_rate: int = 16000) -> Iterator[TranscriptSegment]:
         """
-        Convert audio file to WAV format if needed
+        Transcribe audio as it arrives
 
         Args:
-            audio_file_path: Path to the input audio file
+            chunks: 16-bit mono PCM audio, in chunks of any size, e.g. from
+                :func:`wav_chunks` or :func:`socket_chunks`
+            sample_rate: Sample rate of the audio
 
-        Returns:
-            Path to the WAV file (either original or converted)
+        Yields:
+            Partial segments while a window fills up, and a final segment
+            each time a window is complete: at a pause, at the maximum
+            window length, or at the end of the audio
         """
-        if audio_file_path.lower().endswith('.wav'):
-            return audio_file_path
+        window = _StreamWindow(sample_rate, self.energy_threshold)
+        # Text of the last final segment, which the next window overlaps
+        previous = ""
+        for chunk in chunks:
+            window.append(chunk)
+            if window.complete():
+                text = _drop_overlap(previous, self._transcribe(window))
+                if text:
+                    yield window.segment(text, final=True)
+                    previous = text
+                window.advance()
+            elif window.partial_due():
+                text = _drop_overlap(previous, self._transcribe(window))
+                if text:
+                    yield window.segment(text, final=False)
+        if window.has_audio():
+            text = _drop_overlap(previous, self._transcribe(window))
+            if text:
+                yield window.segment(text, final=True)
 
-        try:
-            # Read the audio file
-            data, samplerate = sf.read(audio_file_path)
+    def _transcribe(self, window: "_StreamWindow") -> str:
+        """Text of the audio in ``window``; empty for silence"""
+        if window.silent():
+            return ""
+        return self._recognize(window.audio())
 
-            # Create temporary WAV file
-            with tempfile.NamedTemporaryFile(suffix='.wav',
-                                             delete=False) as temp_file:
-                wav_path = temp_file.name
 
-            # Write as WAV
-            sf.write(wav_path, data, samplerate)
+class _StreamWindow:
+    """Audio of the window being transcribed, as 16-bit samples"""
 
-            return wav_path
+    def __init__(self, sample_rate: int, energy_threshold: float):
+        self.rate = sample_rate
+        self.energy_threshold = energy_threshold
+        self.samples = np.zeros(0, dtype=np.int16)
+        # Stream time of the first sample, in samples
+        self.offset = 0
+        # Window length at the last transcription
+        self.transcribed = 0
+        # Samples kept for the next window when this one is cut
+        self.overlap = 0
 
-        except Exception as e:
-            raise Exception(f"Failed to convert audio to WAV format: {str(e)}")
+    def append(self, chunk: bytes) -> None:
+        self.samples = np.concatenate(
+            [self.samples, np.frombuffer(chunk, dtype=np.int16)])
+
+    def has_audio(self) -> bool:
+        """Whether there is audio that no final segment covered yet"""
+        return len(self.samples) > self.overlap
+
+    def complete(self) -> bool:
+        """Whether the window reached its maximum length or ends at a
+        pause
+        """
+        length = len(self.samples)
+        if length >= STREAM_WINDOW_SECONDS * self.rate:
+            self.overlap = int(STREAM_OVERLAP_SECONDS * self.rate)
+            return True
+        pause = int(STREAM_PAUSE_SECONDS * self.rate)
+        if (length >= STREAM_MIN_SEGMENT_SECONDS * self.rate
+                and _rms(self.samples[-pause:]) < self.energy_threshold
+                and not self.silent()):
+            # Cut in the pause, no word to lose
+            self.overlap = 0
+            return True
+        return False
+
+    def partial_due(self) -> bool:
+        return (len(self.samples) - self.transcribed
+                >= STREAM_STEP_SECONDS * self.rate)
+
+    def silent(self) -> bool:
+        return _rms(self.samples) < self.energy_threshold
+
+    def audio(self) -> np.ndarray:
+        """The window as input for Whisper"""
+        self.transcribed = len(self.samples)
+        return resample(self.samples.astype(np.float32) / 32768, self.rate)
+
+    def segment(self, text: str, final: bool) -> TranscriptSegment:
+        return TranscriptSegment(text=text,
+                                 start=self.offset / self.rate,
+                                 end=(self.offset + len(self.samples)) /
+                                 self.rate,
+                                 final=final)
+
+    def advance(self) -> None:
+        """Start the next window, with the overlap of this one"""
+        start = len(self.samples) - self.overlap
+        self.samples = self.samples[start:]
+        self.offset += start
+        self.transcribed = 0
+
+
+def _rms(samples: np.ndarray) -> float:
+    if not len(samples):
+        return 0.0
+    return float(np.sqrt(np.mean(samples.astype(np.float64)**2)))
+
+
+def _words(text: str) -> list[str]:
+    """Words of ``text`` without case and punctuation, one per token"""
+    return [re.sub(r"[^\w']", "", word.lower()) for word in text.split()]
+
+
+def _drop_overlap(previous: str, text: str) -> str:
+    """``text`` without the words it repeats from the end of ``previous``"""
+    before, after = _words(previous), _words(text)
+    for size in range(min(len(before), len(after), MAX_OVERLAP_WORDS), 0, -1):
+        if before[-size:] == after[:size]:
+            return " ".join(text.split()[size:])
+    return text
 
 
 def create_stt_agent():
@@ -0,0 +1,196 @@
+"""Compare LLM call latency with and without request hedging.
+
+Starts ``stub_openai.py`` with a long latency tail and sends the same
+sequence of completions through the shared LLM client (see
+``llm_client.py``), first without and then with hedging, reporting the
+latency percentiles and how much extra traffic hedging added.
+
+Usage (from the multi_code_agent directory):
+    python benchmarks/hedging.py --requests 400 --concurrency 8 \\
+        --tail-ms 1500 --tail-probability 0.02 [--sync] [--output out.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rest import llm_client  # noqa: E402
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentiles(values: list[float]) -> dict[str, float]:
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return round(values[min(len(values) - 1, int(len(values) * q))], 1)
+
+    return {
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": round(values[-1], 1)
+    }
+
+
+def _wait_ready(base_url: str, timeout: float = 30) -> None:
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            httpx.get(f"{base_url}/docs")
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise TimeoutError(f"Stub server not ready after {timeout}s")
+
+
+def _timed_sync(llm: Any, count: int, concurrency: int) -> list[float]:
+
+    def call(i: int) -> float:
+        started = time.perf_counter()
+        llm.invoke(f"Summarize request #{i}")
+        return (time.perf_counter() - started) * 1000
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(call, range(count)))
+
+
+async def _timed_async(llm: Any, count: int, concurrency: int) -> list[float]:
+    slots = asyncio.Semaphore(concurrency)
+
+    async def call(i: int) -> float:
+        async with slots:
+            started = time.perf_counter()
+            await llm.ainvoke(f"Summarize request #{i}")
+            return (time.perf_counter() - started) * 1000
+
+    return await asyncio.gather(*(call(i) for i in range(count)))
+
+
+def _configure(hedge: bool, args: argparse.Namespace) -> Any:
+    llm_client.configure_hedging(enabled=hedge,
+                                 percentile=args.percentile,
+                                 budget=args.budget)
+    return llm_client.create_chat_model("gpt-4o", temperature=0)
+
+
+def run_sync(hedge: bool, args: argparse.Namespace) -> dict[str, Any]:
+    """Send ``--warmup`` then ``--requests`` completions, timing the latter"""
+    llm = _configure(hedge, args)
+    _timed_sync(llm, args.warmup, args.concurrency)
+    return _result(hedge, _timed_sync(llm, args.requests, args.concurrency),
+                   args)
+
+
+async def run_async(hedge: bool, args: argparse.Namespace) -> dict[str, Any]:
+    """Async version of :func:`run_sync`"""
+    llm = _configure(hedge, args)
+    await _timed_async(llm, args.warmup, args.concurrency)
+    return _result(hedge, await _timed_async(llm, args.requests,
+                                             args.concurrency), args)
+
+
+def _result(hedge: bool, latencies: list[float],
+            args: argparse.Namespace) -> dict[str, Any]:
+    hedging = llm_client.pool_stats()["hedging"]
+    calls = args.warmup + args.requests
+    return {
+        "hedging": hedge,
+        "latency_ms": _percentiles(latencies),
+        "extra_traffic": round(hedging["hedged"] / calls, 4),
+        "stats": hedging,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--warmup",
+                        type=int,
+                        default=50,
+                        help="untimed requests sent first in each run")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--sync",
+                        action="store_true",
+                        help="use the sync client from threads")
+    parser.add_argument("--percentile",
+                        type=float,
+                        default=llm_client.HEDGE_PERCENTILE)
+    parser.add_argument("--budget",
+                        type=float,
+                        default=llm_client.HEDGE_BUDGET)
+    parser.add_argument("--latency-ms", type=float, default=100)
+    parser.add_argument("--jitter-ms", type=float, default=10)
+    parser.add_argument("--tail-ms", type=float, default=1500)
+    parser.add_argument("--tail-probability", type=float, default=0.02)
+    parser.add_argument("--output", help="write the results to this file")
+    args = parser.parse_args()
+
+    port = _free_port()
+    stub = subprocess.Popen([
+        sys.executable, "benchmarks/stub_openai.py", "--port",
+        str(port), "--latency-ms",
+        str(args.latency_ms), "--jitter-ms",
+        str(args.jitter_ms), "--tail-ms",
+        str(args.tail_ms), "--tail-probability",
+        str(args.tail_probability)
+    ],
+                            cwd=ROOT,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    os.environ.update(OPENAI_API_KEY="stub", OPENAI_BASE_URL=f"{base_url}/v1")
+    try:
+        _wait_ready(base_url)
+        if args.sync:
+            results = [run_sync(hedge, args) for hedge in (False, True)]
+        else:
+            # The shared async client is bound to one event loop
+            async def run_both() -> list[dict[str, Any]]:
+                return [
+                    await run_async(hedge, args) for hedge in (False, True)
+                ]
+
+            results = asyncio.run(run_both())
+        for result in results:
+            hedge = result["hedging"]
+            latency = result["latency_ms"]
+            print(
+                f"hedging {'on ' if hedge else 'off'}: "
+                f"p50 {latency['p50']} ms, p95 {latency['p95']} ms, "
+                f"p99 {latency['p99']} ms, "
+                f"extra traffic {result['extra_traffic']:.1%}",
+                file=sys.stderr)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+    config = dict(vars(args))
+    config.pop("output")
+    report = json.dumps({"config": config, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
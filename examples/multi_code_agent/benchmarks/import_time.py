@@ -0,0 +1,151 @@
+"""Report the cold-start import cost of each entry point.
+
+Each entry point is imported in a fresh interpreter with ``-X importtime``.
+The third-party packages it cannot start without (``FIXED_PACKAGES``:
+traceroot, whose import alone takes most of a second, and the web framework
+of the servers) are taken out of its cumulative time, and what is left, the
+cost of this code and of anything else it pulls in, is compared with its
+budget. This keeps the budgets meaningful on fast and slow machines alike,
+while an entry point that starts importing langchain or langgraph, which
+the agents only import once they are built, goes over. The best of ``--runs`` runs is reported, as the first import after a
+change also pays for writing the bytecode caches.
+
+Usage (from the multi_code_agent directory):
+    python benchmarks/import_time.py [--runs 3] [--top 5] [--json]
+
+Exits with status 1 when an entry point is over its budget.
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+from typing import Any
+
+# Milliseconds allowed for importing each entry point, not counting its
+# fixed packages. Nothing of langchain or langgraph may be on any of these
+# paths: the servers build the agents after binding, and the agents import
+# them when they are created.
+BUDGETS_MS = {
+    "simple_server": 300,
+    "simpler_server_v2": 300,
+    "simpler_server_v3": 300,
+    "rest.main": 800,
+    "main": 800,
+}
+
+_SERVER_PACKAGES = ("fastapi", "uvicorn", "traceroot")
+_SYSTEM_PACKAGES = ("traceroot", )
+# Third-party packages whose import time does not count against the budget
+FIXED_PACKAGES = {
+    "simple_server": _SERVER_PACKAGES,
+    "simpler_server_v2": _SERVER_PACKAGES,
+    "simpler_server_v3": _SERVER_PACKAGES,
+    "rest.main": _SYSTEM_PACKAGES,
+    "main": _SYSTEM_PACKAGES,
+}
+
+# import time: self [us] | cumulative | imported package
+_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _fixed_us(node: dict[str, Any], fixed: tuple[str, ...]) -> int:
+    """Time spent under ``node`` importing the ``fixed`` packages"""
+    if node["name"].split(".")[0] in fixed:
+        return node["cumulative"]
+    return sum(_fixed_us(child, fixed) for child in node["children"])
+
+
+def measure(module: str) -> dict[str, Any]:
+    """Import ``module`` in a new interpreter and parse its import times"""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr}")
+
+    # Imports are listed after the ones they trigger, indented one level
+    # deeper; rebuild the tree of the entry point from that
+    pending: dict[int, list[dict[str, Any]]] = {}
+    entry = {"name": module, "cumulative": 0, "children": []}
+    for line in proc.stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        depth = len(match.group(3)) // 2
+        node = {
+            "name": match.group(4),
+            "cumulative": int(match.group(2)),
+            "children": pending.pop(depth + 1, [])
+        }
+        if node["name"] == module and depth == 0:
+            entry = node
+        pending.setdefault(depth, []).append(node)
+    fixed_us = _fixed_us(entry, FIXED_PACKAGES.get(module, ()))
+    return {
+        "total_us":
+        entry["cumulative"],
+        "fixed_us":
+        fixed_us,
+        "own_us":
+        entry["cumulative"] - fixed_us,
+        # Modules imported directly by the entry point and their cost
+        "children":
+        [(child["name"], child["cumulative"]) for child in entry["children"]],
+    }
+
+
+def run(runs: int, top: int) -> list[dict[str, Any]]:
+    results = []
+    for module, budget_ms in BUDGETS_MS.items():
+        best = min((measure(module) for _ in range(runs)),
+                   key=lambda m: m["own_us"])
+        own_ms = best["own_us"] / 1000
+        heaviest = sorted(best["children"], key=lambda c: c[1],
+                          reverse=True)[:top]
+        result = {"entry_point": module, "budget_ms": budget_ms}
+        result["import_ms"] = round(best["total_us"] / 1000, 1)
+        result["fixed_ms"] = round(best["fixed_us"] / 1000, 1)
+        result["own_ms"] = round(own_ms, 1)
+        result["within_budget"] = own_ms <= budget_ms
+        result["heaviest"] = [{
+            "module": name,
+            "ms": round(us / 1000, 1)
+        } for name, us in heaviest]
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top",
+                        type=int,
+                        default=5,
+                        help="direct imports to list per entry point")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    results = run(args.runs, args.top)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        for result in results:
+            status = "ok" if result["within_budget"] else "OVER BUDGET"
+            print(f"{result['entry_point']:<20} {result['own_ms']:>8.1f} ms"
+                  f" / {result['budget_ms']} ms  {status}  (total "
+                  f"{result['import_ms']:.1f} ms, fixed packages "
+                  f"{result['fixed_ms']:.1f} ms)")
+            for child in result["heaviest"]:
+                print(f"    {child['module']:<36} {child['ms']:>8.1f} ms")
+    sys.exit(0 if all(r["within_budget"] for r in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
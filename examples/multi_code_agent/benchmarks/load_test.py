@@ -0,0 +1,325 @@
+"""Load test the code servers against stubbed LLMs and a stubbed sandbox.
+
+Starts ``stub_openai.py`` and then each selected server with uvicorn,
+pointing the agents at the stub and running them with
+``EXECUTION_SANDBOX=stub``. Each server is driven either in a closed loop
+(``--concurrency`` clients sending back to back) or an open loop (Poisson
+arrivals at ``--rate`` requests per second) with a weighted mix of:
+
+- ``coding``: a coding task that succeeds on the first attempt
+- ``chat``: a question answered by the planner alone
+- ``failing``: a coding task whose code always fails, using every retry
+- ``flaky``: a coding task that fails once, unless the failure memory
+  already knows the fix
+- ``duplicate``: the same coding task every time, to exercise coalescing
+
+Event-loop lag is estimated from the latency of ``GET /ready``, which does
+no work, probed every ``--probe-interval-ms`` during the run.
+
+Usage (from the multi_code_agent directory):
+    python benchmarks/load_test.py --servers simple_server \\
+        --mode closed --concurrency 16 --duration 30 --output results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = ["simple_server", "simpler_server_v2", "simpler_server_v3"]
+
+QUERIES = {
+    "coding": "Write a Python function that sorts list #{i}",
+    "chat": "[chat] What does an HTTP 503 status mean? #{i}",
+    "failing": "[fail] Write a Python script that parses file #{i}",
+    "flaky": "[flaky] Write a Python script that downloads page #{i}",
+    "duplicate": "Write a Python function that reverses a string",
+}
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {"p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return round(values[min(len(values) - 1, int(len(values) * q))], 2)
+
+    return {
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": round(values[-1], 2)
+    }
+
+
+def parse_mix(spec: str) -> dict[str, float]:
+    """Parse ``"coding=0.6,chat=0.3,failing=0.1"`` into weights"""
+    mix = {}
+    for item in spec.split(","):
+        kind, _, weight = item.partition("=")
+        if kind not in QUERIES:
+            raise ValueError(f"Unknown query kind: {kind}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+class QueryMix:
+
+    def __init__(self, mix: dict[str, float], seed: int):
+        self.kinds = list(mix)
+        self.weights = list(mix.values())
+        self.random = random.Random(seed)
+        self.count = 0
+
+    def next(self) -> tuple[str, str]:
+        kind = self.random.choices(self.kinds, self.weights)[0]
+        self.count += 1
+        return kind, QUERIES[kind].format(i=self.count)
+
+
+async def _wait_ready(client: httpx.AsyncClient, timeout: float) -> float:
+    """Wait for GET /ready to succeed and return how long that took"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            if (await client.get("/ready")).status_code == 200:
+                return time.perf_counter() - started
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.1)
+    raise TimeoutError(f"Server not ready after {timeout}s")
+
+
+async def _probe(client: httpx.AsyncClient, interval: float, lags: list[float],
+                 stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        started = time.perf_counter()
+        try:
+            await client.get("/ready")
+            lags.append((time.perf_counter() - started) * 1000)
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(interval)
+
+
+async def _send(client: httpx.AsyncClient, kind: str, query: str,
+                records: list[dict[str, Any]]) -> None:
+    started = time.perf_counter()
+    try:
+        response = await client.post("/code", json={"query": query})
+        status = str(response.status_code)
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    records.append({
+        "kind": kind,
+        "status": status,
+        "latency_ms": (time.perf_counter() - started) * 1000,
+    })
+
+
+async def drive(base_url: str, args: argparse.Namespace) -> dict[str, Any]:
+    """Run one load test against the server at ``base_url``"""
+    mix = QueryMix(parse_mix(args.mix), args.seed)
+    limits = httpx.Limits(max_connections=args.concurrency + 8)
+    timeout = httpx.Timeout(args.request_timeout)
+    records: list[dict[str, Any]] = []
+    async with httpx.AsyncClient(base_url=base_url,
+                                 limits=limits,
+                                 timeout=timeout) as client, \
+            httpx.AsyncClient(base_url=base_url, timeout=timeout) as probe:
+        ready_seconds = await _wait_ready(probe, args.ready_timeout)
+        idle_lags: list[float] = []
+        for _ in range(20):
+            started = time.perf_counter()
+            await probe.get("/ready")
+            idle_lags.append((time.perf_counter() - started) * 1000)
+
+        lags: list[float] = []
+        stop = asyncio.Event()
+        probe_task = asyncio.create_task(
+            _probe(probe, args.probe_interval_ms / 1000, lags, stop))
+        started = time.perf_counter()
+        deadline = started + args.duration
+
+        def more() -> bool:
+            return (time.perf_counter() < deadline
+                    and (not args.requests or mix.count < args.requests))
+
+        if args.mode == "closed":
+
+            async def worker() -> None:
+                while more():
+                    await _send(client, *mix.next(), records)
+
+            await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        else:
+            tasks = []
+            while more():
+                tasks.append(
+                    asyncio.create_task(_send(client, *mix.next(), records)))
+                await asyncio.sleep(mix.random.expovariate(args.rate))
+            await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+        stop.set()
+        await probe_task
+        server_stats = (await probe.get("/stats")).json()
+
+    succeeded = [r for r in records if r["status"] == "200"]
+    errors: dict[str, int] = {}
+    for record in records:
+        if record["status"] != "200":
+            errors[record["status"]] = errors.get(record["status"], 0) + 1
+    by_kind = {}
+    for kind in mix.kinds:
+        latencies = [r["latency_ms"] for r in succeeded if r["kind"] == kind]
+        by_kind[kind] = {
+            "requests": sum(1 for r in records if r["kind"] == kind),
+            "latency_ms": _percentiles(latencies),
+        }
+    error_rate = 1 - len(succeeded) / len(records) if records else 0.0
+    return {
+        "ready_seconds": round(ready_seconds, 2),
+        "elapsed_seconds": round(elapsed, 2),
+        "requests": len(records),
+        "succeeded": len(succeeded),
+        "errors": errors,
+        "error_rate": round(error_rate, 4),
+        "throughput_rps": round(len(succeeded) / elapsed, 2),
+        "latency_ms": _percentiles([r["latency_ms"] for r in succeeded]),
+        "by_kind": by_kind,
+        "event_loop_lag_ms": {
+            "idle": _percentiles(idle_lags),
+            "under_load": _percentiles(lags),
+        },
+        "server_stats": server_stats,
+    }
+
+
+def _start(command: list[str], env: dict[str, str]) -> subprocess.Popen:
+    return subprocess.Popen(command,
+                            cwd=ROOT,
+                            env=env,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+
+def _stop(proc: subprocess.Popen) -> None:
+    proc.terminate()
+    try:
+        proc.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--servers",
+                        nargs="+",
+                        choices=SERVERS,
+                        default=SERVERS)
+    parser.add_argument("--mode", choices=["closed", "open"], default="closed")
+    parser.add_argument("--concurrency",
+                        type=int,
+                        default=8,
+                        help="clients in closed-loop mode")
+    parser.add_argument("--rate",
+                        type=float,
+                        default=5,
+                        help="requests per second in open-loop mode")
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--requests",
+                        type=int,
+                        default=0,
+                        help="stop after this many requests (0: no limit)")
+    parser.add_argument("--mix",
+                        default="coding=0.6,chat=0.3,failing=0.1",
+                        help="weights of " + ", ".join(QUERIES))
+    parser.add_argument("--llm-latency-ms", type=float, default=200)
+    parser.add_argument("--llm-jitter-ms", type=float, default=50)
+    parser.add_argument("--sandbox-latency-ms", type=float, default=50)
+    parser.add_argument("--probe-interval-ms", type=float, default=100)
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--ready-timeout", type=float, default=60)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--env",
+                        action="append",
+                        default=[],
+                        metavar="KEY=VALUE",
+                        help="extra environment for the servers")
+    parser.add_argument("--output", help="write the results to this file")
+    args = parser.parse_args()
+
+    stub_port = _free_port()
+    stub = _start([
+        sys.executable, "benchmarks/stub_openai.py", "--port",
+        str(stub_port), "--latency-ms",
+        str(args.llm_latency_ms), "--jitter-ms",
+        str(args.llm_jitter_ms)
+    ], dict(os.environ))
+    sandbox_latency = args.sandbox_latency_ms / 1000
+
+    results = []
+    try:
+        for server in args.servers:
+            with tempfile.TemporaryDirectory() as tmp:
+                env = dict(os.environ,
+                           OPENAI_API_KEY="stub",
+                           OPENAI_BASE_URL=f"http://127.0.0.1:{stub_port}/v1",
+                           EXECUTION_SANDBOX="stub",
+                           EXECUTION_STUB_LATENCY_SECONDS=str(sandbox_latency),
+                           MULTI_AGENT_CHECKPOINT_PATH=os.path.join(
+                               tmp, "checkpoints.sqlite"))
+                env.update(item.split("=", 1) for item in args.env)
+                port = _free_port()
+                proc = _start([
+                    sys.executable, "-m", "uvicorn", f"{server}:app", "--port",
+                    str(port), "--log-level", "warning"
+                ], env)
+                try:
+                    print(f"Load testing {server} ...", file=sys.stderr)
+                    result = asyncio.run(
+                        drive(f"http://127.0.0.1:{port}", args))
+                finally:
+                    _stop(proc)
+            result["server"] = server
+            results.append(result)
+            print(
+                f"{server}: {result['throughput_rps']} req/s, "
+                f"p50 {result['latency_ms']['p50']} ms, "
+                f"p99 {result['latency_ms']['p99']} ms, "
+                f"errors {result['error_rate']:.1%}, loop lag p99 "
+                f"{result['event_loop_lag_ms']['under_load']['p99']} ms",
+                file=sys.stderr)
+    finally:
+        _stop(stub)
+
+    config = dict(vars(args))
+    config.pop("output")
+    report = json.dumps({"config": config, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Compare LLM call throughput with and without the rate limit scheduler.
+
+Starts ``stub_openai.py`` with a requests-per-minute and tokens-per-minute
+limit and sends a burst of completions through the shared LLM client (see
+``llm_client.py``), first relying on the SDK's retries alone and then
+through the scheduler configured with the same limits. Reports throughput,
+latency percentiles, the 429 responses the stub sent and the calls that
+failed. Each run gets a fresh stub, so both start with a full quota.
+
+Usage (from the multi_code_agent directory):
+    python benchmarks/rate_limit.py --requests 300 --concurrency 32 \\
+        --rpm 600 --tpm 200000 [--sync] [--output out.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from rest import llm_client  # noqa: E402
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _percentiles(values: list[float]) -> dict[str, float]:
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return round(values[min(len(values) - 1, int(len(values) * q))], 1)
+
+    return {
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": round(values[-1], 1)
+    }
+
+
+def _start_stub(args: argparse.Namespace) -> tuple[subprocess.Popen, str]:
+    port = _free_port()
+    stub = subprocess.Popen([
+        sys.executable, "benchmarks/stub_openai.py", "--port",
+        str(port), "--latency-ms",
+        str(args.latency_ms), "--jitter-ms", "10", "--rpm",
+        str(args.rpm), "--tpm",
+        str(args.tpm)
+    ],
+                            cwd=ROOT,
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    while time.perf_counter() - started < 30:
+        try:
+            httpx.get(f"{base_url}/stats")
+            break
+        except httpx.TransportError:
+            time.sleep(0.1)
+    os.environ.update(OPENAI_API_KEY="stub", OPENAI_BASE_URL=f"{base_url}/v1")
+    return stub, base_url
+
+
+def _configure(limited: bool, args: argparse.Namespace) -> Any:
+    if limited:
+        llm_client.configure_rate_limit(args.rpm, args.tpm)
+    else:
+        llm_client.configure_rate_limit(0, 0)
+    return llm_client.create_chat_model("gpt-4o", temperature=0)
+
+
+def _call(llm: Any, i: int) -> float | None:
+    """Latency of a call in ms, None if it failed"""
+    started = time.perf_counter()
+    try:
+        llm.invoke(f"Summarize request #{i}")
+    except Exception:
+        return None
+    return (time.perf_counter() - started) * 1000
+
+
+async def _acall(llm: Any, i: int, slots: asyncio.Semaphore) -> float | None:
+    async with slots:
+        started = time.perf_counter()
+        try:
+            await llm.ainvoke(f"Summarize request #{i}")
+        except Exception:
+            return None
+        return (time.perf_counter() - started) * 1000
+
+
+def run_sync(limited: bool, args: argparse.Namespace) -> dict[str, Any]:
+    """Send ``--requests`` completions from threads against a fresh stub"""
+    stub, base_url = _start_stub(args)
+    try:
+        llm = _configure(limited, args)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(args.concurrency) as pool:
+            latencies = list(
+                pool.map(lambda i: _call(llm, i), range(args.requests)))
+        return _result(limited, latencies,
+                       time.perf_counter() - started, base_url)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+async def run_async(limited: bool, args: argparse.Namespace) -> dict[str, Any]:
+    """Async version of :func:`run_sync`"""
+    stub, base_url = _start_stub(args)
+    try:
+        llm = _configure(limited, args)
+        slots = asyncio.Semaphore(args.concurrency)
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*(_acall(llm, i, slots)
+                                           for i in range(args.requests)))
+        return _result(limited, latencies,
+                       time.perf_counter() - started, base_url)
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+def _result(limited: bool, latencies: list[float | None], elapsed: float,
+            base_url: str) -> dict[str, Any]:
+    succeeded = [latency for latency in latencies if latency is not None]
+    stub_stats = httpx.get(f"{base_url}/stats").json()
+    return {
+        "scheduler": limited,
+        "calls_per_minute": round(len(succeeded) / elapsed * 60, 1),
+        "latency_ms": _percentiles(succeeded) if succeeded else None,
+        "failed": len(latencies) - len(succeeded),
+        "rate_limited_responses": stub_stats["rate_limited"],
+        "stats": llm_client.pool_stats()["rate_limit"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--sync",
+                        action="store_true",
+                        help="use the sync client from threads")
+    parser.add_argument("--rpm", type=float, default=600)
+    parser.add_argument("--tpm", type=float, default=200000)
+    parser.add_argument("--latency-ms", type=float, default=100)
+    parser.add_argument("--output", help="write the results to this file")
+    args = parser.parse_args()
+
+    if args.sync:
+        results = [run_sync(limited, args) for limited in (False, True)]
+    else:
+        # The shared async client is bound to one event loop
+        async def run_both() -> list[dict[str, Any]]:
+            return [
+                await run_async(limited, args) for limited in (False, True)
+            ]
+
+        results = asyncio.run(run_both())
+    for result in results:
+        print(
+            f"scheduler {'on ' if result['scheduler'] else 'off'}: "
+            f"{result['calls_per_minute']} calls/min, "
+            f"{result['rate_limited_responses']} responses 429, "
+            f"{result['failed']} failed",
+            file=sys.stderr)
+
+    config = dict(vars(args))
+    config.pop("output")
+    report = json.dumps({"config": config, "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report)
+    else:
+        print(report)
+
+
+if __name__ == "__main__":
+    main()
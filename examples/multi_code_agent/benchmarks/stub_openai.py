@@ -0,0 +1,249 @@
+"""Minimal OpenAI-compatible chat completions server for load tests.
+
+Answers the planning, coding, repair and summarization agents with canned
+responses after an injected latency, so the code servers can be driven
+without calling OpenAI. Point the agents at it with
+``OPENAI_BASE_URL=http://127.0.0.1:<port>/v1``.
+
+Queries containing ``[chat]`` are planned as non-coding questions and
+queries containing ``[fail]`` get code that fails in the stub sandbox
+(``EXECUTION_SANDBOX=stub``). Queries containing ``[flaky]`` get failing
+code that the repair agent fixes, unless the planning prompt carried
+lessons from past failures, in which case the first attempt succeeds.
+
+A fraction ``--tail-probability`` of the completions take ``--tail-ms``
+longer, to reproduce the long latency tail of a real LLM API.
+
+With ``--rpm`` or ``--tpm``, completions are rate limited like the OpenAI
+API: responses carry ``x-ratelimit-remaining-*`` headers, and a request
+over the limit gets a 429 with a ``retry-after`` header. Counters are
+served on ``GET /stats``.
+
+Usage:
+    python benchmarks/stub_openai.py [--port 8765] [--latency-ms 200]
+"""
+import argparse
+import asyncio
+import difflib
+import json
+import math
+import random
+import time
+import uuid
+from typing import Any
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+
+# Keep in sync with STUB_FAILURE_MARKER in execution_agent.py
+STUB_FAILURE_MARKER = "# stub: fail"
+
+app = FastAPI(title="Stub OpenAI")
+app.state.latency = 0.0
+app.state.jitter = 0.0
+app.state.tail = 0.0
+app.state.tail_probability = 0.0
+app.state.limits = None
+app.state.counters = {"completions": 0, "rate_limited": 0}
+
+
+class _Limits:
+    """Requests and tokens per minute, as token buckets"""
+
+    def __init__(self, rpm: float, tpm: float):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.requests = rpm
+        self.tokens = tpm
+        self.updated_at = time.monotonic()
+
+    def take(self, tokens: int) -> float:
+        """Take quota for a request; return seconds to wait if not possible"""
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        self.requests = min(self.rpm, self.requests + elapsed * self.rpm / 60)
+        self.tokens = min(self.tpm, self.tokens + elapsed * self.tpm / 60)
+        wait = 0.0
+        if self.rpm and self.requests < 1:
+            wait = (1 - self.requests) * 60 / self.rpm
+        if self.tpm and self.tokens < tokens:
+            wait = max(wait, (tokens - self.tokens) * 60 / self.tpm)
+        if wait == 0:
+            self.requests -= 1
+            self.tokens -= tokens
+        return wait
+
+    def headers(self) -> dict[str, str]:
+        headers = {}
+        if self.rpm:
+            headers["x-ratelimit-limit-requests"] = str(int(self.rpm))
+            headers["x-ratelimit-remaining-requests"] = str(
+                max(0, int(self.requests)))
+        if self.tpm:
+            headers["x-ratelimit-limit-tokens"] = str(int(self.tpm))
+            headers["x-ratelimit-remaining-tokens"] = str(
+                max(0, int(self.tokens)))
+        return headers
+
+
+def _plan(query: str) -> dict[str, Any]:
+    if "[chat]" in query:
+        return {
+            "is_coding": False,
+            "plan": None,
+            "response": "This is a stub answer."
+        }
+    plan = "1. Write a function. 2. Print its result."
+    if "Lessons from similar past requests" in query:
+        plan += " 3. Apply the lessons from past failures."
+    return {"is_coding": True, "plan": plan, "response": None}
+
+
+def _code(query: str) -> str:
+    code = "def solve():\n    return 42\n\nprint(solve())\n"
+    if "[fail]" in query or ("[flaky]" in query and "lessons" not in query):
+        code = f"{STUB_FAILURE_MARKER}\nraise SystemExit(1)\n"
+    return f"```python\n{code}```"
+
+
+def _repair(prompt: str) -> str:
+    """Diff that appends a comment to the program in a repair prompt.
+
+    For ``[flaky]`` queries the diff also removes the failure marker.
+    """
+    program = prompt.split("Program:\n", 1)[-1].split("\n\nError:\n")[0]
+    lines = program.splitlines(keepends=True)
+    if lines and not lines[-1].endswith("\n"):
+        lines[-1] += "\n"
+    fixed = lines
+    if "[flaky]" in prompt:
+        fixed = [line for line in lines if STUB_FAILURE_MARKER not in line]
+    diff = difflib.unified_diff(lines, fixed + ["# stub repair\n"])
+    return "```diff\n" + "".join(diff) + "```"
+
+
+def _message(body: dict[str, Any]) -> dict[str, Any]:
+    messages = body.get("messages", [])
+    system = next((m["content"] for m in messages if m["role"] == "system"),
+                  "")
+    query = messages[-1]["content"] if messages else ""
+
+    if system.startswith("You are a planning agent"):
+        arguments = json.dumps(_plan(query))
+        if body.get("tools"):
+            # function_calling structured output
+            call = {
+                "id": f"call_{uuid.uuid4().hex[:12]}",
+                "type": "function",
+                "function": {
+                    "name": body["tools"][0]["function"]["name"],
+                    "arguments": arguments,
+                },
+            }
+            return {"role": "assistant", "content": None, "tool_calls": [call]}
+        # json_schema or json_mode structured output
+        return {"role": "assistant", "content": arguments, "refusal": None}
+    if system.startswith("You are a Python code repair agent"):
+        return {"role": "assistant", "content": _repair(query)}
+    if system.startswith("You are a Python coding agent"):
+        return {"role": "assistant", "content": _code(query)}
+    return {"role": "assistant", "content": "Stub summary of the results."}
+
+
+@app.get("/stats")
+async def stats() -> dict:
+    return app.state.counters
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request) -> JSONResponse:
+    body = await request.json()
+    headers = {}
+    limits = app.state.limits
+    if limits is not None:
+        # Charged like OpenAI does: the prompt plus the completion budget
+        tokens = (len(json.dumps(body.get("messages", []))) // 4 +
+                  (body.get("max_tokens") or 256))
+        wait = limits.take(tokens)
+        headers = limits.headers()
+        if wait > 0:
+            app.state.counters["rate_limited"] += 1
+            error = {
+                "message": "Rate limit reached",
+                "type": "requests",
+                "code": "rate_limit_exceeded",
+            }
+            headers["retry-after"] = str(math.ceil(wait))
+            headers["retry-after-ms"] = str(math.ceil(wait * 1000))
+            return JSONResponse({"error": error},
+                                status_code=429,
+                                headers=headers)
+    app.state.counters["completions"] += 1
+    latency = random.gauss(app.state.latency, app.state.jitter)
+    if random.random() < app.state.tail_probability:
+        latency += app.state.tail
+    await asyncio.sleep(max(0.0, latency))
+    message = _message(body)
+    prompt_tokens = len(json.dumps(body.get("messages", []))) // 4
+    completion_tokens = len(json.dumps(message)) // 4
+    finish_reason = "tool_calls" if message.get("tool_calls") else "stop"
+    usage = {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+    choice = {"index": 0, "message": message, "finish_reason": finish_reason}
+    return JSONResponse(
+        {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [choice],
+            "usage": usage,
+        },
+        headers=headers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms",
+                        type=float,
+                        default=200,
+                        help="mean latency of every completion")
+    parser.add_argument("--jitter-ms",
+                        type=float,
+                        default=50,
+                        help="standard deviation of the latency")
+    parser.add_argument("--tail-ms",
+                        type=float,
+                        default=0,
+                        help="extra latency of the slow completions")
+    parser.add_argument("--tail-probability",
+                        type=float,
+                        default=0,
+                        help="fraction of the completions that are slow")
+    parser.add_argument("--rpm",
+                        type=float,
+                        default=0,
+                        help="requests per minute allowed, 0 for no limit")
+    parser.add_argument("--tpm",
+                        type=float,
+                        default=0,
+                        help="tokens per minute allowed, 0 for no limit")
+    args = parser.parse_args()
+
+    app.state.latency = args.latency_ms / 1000
+    app.state.jitter = args.jitter_ms / 1000
+    app.state.tail = args.tail_ms / 1000
+    app.state.tail_probability = args.tail_probability
+    if args.rpm or args.tpm:
+        app.state.limits = _Limits(args.rpm, args.tpm)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Run a batch of queries from a JSONL file through MultiAgentSystem.
+
+Each input line is ``{"id": ..., "query": ...}``; the id is optional and
+defaults to the line number. Results are appended to the output JSONL file
+as each query finishes, so a crashed run can simply be started again: ids
+already in the output are skipped, and queries that were in progress resume
+from their checkpoint. Checkpoints are kept per run, identified by the input
+and output paths unless ``--run-id`` is given, so other batches never pick
+up the threads of this one. A report of the whole batch (success rate,
+latency percentiles and attempts per query, including the results of
+earlier runs) and of the throughput of this run is printed at the end.
+
+Usage (from the multi_code_agent directory):
+    python bulk_runner.py queries.jsonl results.jsonl --concurrency 8 \\
+        [--deadline-seconds 120] [--retry-errors] [--run-id ID] \\
+        [--report report.json]
+"""
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import Counter
+from dataclasses import asdict
+from typing import Any
+
+from main import MultiAgentSystem, QueryResult
+
+
+def read_queries(path: str) -> dict[str, str]:
+    """Queries of a JSONL file by id, in file order"""
+    queries = {}
+    with open(path) as f:
+        for number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            queries[str(item.get("id", number))] = item["query"]
+    return queries
+
+
+def read_results(path: str) -> dict[str, dict[str, Any]]:
+    """Results already written to ``path``, the latest one per id.
+
+    A last line cut off by a crash is removed from the file, so that new
+    results are appended after a complete line.
+    """
+    if not os.path.exists(path):
+        return {}
+    results = {}
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        if line.strip():
+            result = json.loads(line)
+            results[result["id"]] = result
+    return results
+
+
+def default_run_id(input_path: str, output_path: str) -> str:
+    """Run id of the batch from ``input_path`` to ``output_path``"""
+    paths = f"{os.path.abspath(input_path)}\0{os.path.abspath(output_path)}"
+    return hashlib.sha256(paths.encode()).hexdigest()[:16]
+
+
+def _percentiles(values: list[float]) -> dict[str, float]:
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def at(q: float) -> float:
+        return round(values[min(len(values) - 1, int(len(values) * q))], 3)
+
+    return {
+        "p50": at(0.5),
+        "p95": at(0.95),
+        "p99": at(0.99),
+        "max": round(values[-1], 3)
+    }
+
+
+def build_report(results: list[QueryResult], seconds: float,
+                 ran: int) -> dict[str, Any]:
+    """Summary of the batch's ``results``, the last ``ran`` of which were
+    run in ``seconds`` by this invocation
+    """
+    count = len(results)
+    succeeded = sum(result.success for result in results)
+    attempts = [result.attempts for result in results if not result.error]
+    return {
+        "queries": count,
+        "ran": ran,
+        "skipped": count - ran,
+        "succeeded": succeeded,
+        "errors": sum(result.error is not None for result in results),
+        "success_rate": round(succeeded / count, 4) if count else 0.0,
+        "seconds": round(seconds, 1),
+        "queries_per_minute": round(ran / seconds * 60, 2) if seconds else 0.0,
+        "latency_seconds":
+        _percentiles([result.seconds for result in results]),
+        "attempts": {
+            "mean":
+            round(sum(attempts) / len(attempts), 3) if attempts else 0.0,
+            "histogram": dict(sorted(Counter(attempts).items())),
+        },
+    }
+
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+    queries = read_queries(args.input)
+    done = read_results(args.output)
+    pending = {
+        query_id: query
+        for query_id, query in queries.items() if query_id not in done or (
+            args.retry_errors and not done[query_id]["success"])
+    }
+    print(
+        f"{len(pending)} queries to run, "
+        f"{len(queries) - len(pending)} already done",
+        file=sys.stderr)
+
+    system = MultiAgentSystem()
+    started = time.perf_counter()
+    with open(args.output, "a") as out:
+
+        def write(result: QueryResult) -> None:
+            out.write(json.dumps(asdict(result)) + "\n")
+            out.flush()
+
+        results = system.process_queries(
+            pending,
+            concurrency=args.concurrency,
+            on_result=write,
+            deadline_seconds=args.deadline_seconds,
+            run_id=args.run_id or default_run_id(args.input, args.output))
+    seconds = time.perf_counter() - started
+    # Earlier results of the batch, then the ones of this run
+    earlier = [
+        QueryResult(**done[query_id]) for query_id in queries
+        if query_id in done and query_id not in pending
+    ]
+    return build_report(earlier + results, seconds, len(results))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="JSONL file of queries")
+    parser.add_argument("output", help="JSONL file the results go to")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--deadline-seconds",
+                        type=float,
+                        help="time budget per query, 0 for no limit")
+    parser.add_argument("--retry-errors",
+                        action="store_true",
+                        help="run queries again that raised or did not "
+                        "succeed, e.g. were cut off by the deadline")
+    parser.add_argument("--run-id",
+                        help="checkpoint namespace of the batch; defaults "
+                        "to a hash of the input and output paths")
+    parser.add_argument("--report", help="also write the report to this file")
+    args = parser.parse_args()
+
+    report = json.dumps(run(args), indent=2)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(report)
+    print(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,25 @@
 import traceroot
+from diff_patch import PatchError, apply_unified_diff
 from dotenv import load_dotenv
-from langchain.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
+from llm_client import create_chat_model
 
 load_dotenv()
 
 logger = traceroot.get_logger()
 
+# Tracebacks end with the relevant frames and the exception, so only the
+# tail of the error output is sent to the repair prompt
+MAX_ERROR_LINES = 20
+MAX_ERROR_CHARS = 2000
+
 
 class CodeAgent:
 
     def __init__(self):
-        self.llm = ChatOpenAI(model="gpt-4o", temperature=0)
+        # Imported with the agent, not the module, to keep startup cheap
+        from langchain_core.prompts import ChatPromptTemplate
+
+        self.llm = create_chat_model("gpt-4o", temperature=0)
         self.system_prompt = (
             "You are a Python coding agent. "
             "Your job is to write Python code based on "
@@ -35,6 +43,22 @@ class CodeAgent:
                        "Historical context: {historical_context}\n\n"
                        "Please write Python code to implement this."))
         ])
+        self.repair_system_prompt = (
+            "You are a Python code repair agent. "
+            "You are given a program that failed, the error it produced "
+            "and the plan it should follow. Fix it with the smallest "
+            "change that works.\n"
+            "Your response should be ONLY a unified diff against the given "
+            "program: one or more hunks starting with @@ -start,count "
+            "+start,count @@, with unchanged context lines prefixed by a "
+            "space, removed lines by '-' and added lines by '+'. "
+            "Copy context and removed lines exactly.")
+        self.repair_prompt = ChatPromptTemplate.from_messages([
+            ("system", self.repair_system_prompt),
+            ("human", ("{query}\n\nPlan: {plan}\n\n"
+                       "Program:\n{code}\n\nError:\n{error}\n\n"
+                       "Please return a unified diff that fixes the program."))
+        ])
 
     @traceroot.trace()
     def generate_code(
@@ -43,32 +67,112 @@ class CodeAgent:
         plan: str,
         historical_context: str = "",
     ) -> str:
+        chain = self.code_prompt | self.llm
+        response = chain.invoke(
+            self._code_inputs(query, plan, historical_context))
+        return self._code_result(response)
+
+    @traceroot.trace()
+    async def generate_code_async(
+        self,
+        query: str,
+        plan: str,
+        historical_context: str = "",
+    ) -> str:
+        """Async version of :meth:`generate_code`"""
+        chain = self.code_prompt | self.llm
+        response = await chain.ainvoke(
+            self._code_inputs(query, plan, historical_context))
+        return self._code_result(response)
+
+    @traceroot.trace()
+    def repair_code(self, query: str, plan: str, code: str,
+                    error: str) -> str | None:
+        """Fix ``code`` by asking for a patch instead of a new program.
+
+        The model only writes the changed lines, so a small fix costs few
+        output tokens. The patch is applied locally and the result must
+        compile.
+
+        Returns:
+            The repaired code, or None if the patch did not apply or the
+            repaired code does not compile
+        """
+        chain = self.repair_prompt | self.llm
+        response = chain.invoke(self._repair_inputs(query, plan, code, error))
+        return self._repair_result(code, response)
+
+    @traceroot.trace()
+    async def repair_code_async(self, query: str, plan: str, code: str,
+                                error: str) -> str | None:
+        """Async version of :meth:`repair_code`"""
+        chain = self.repair_prompt | self.llm
+        response = await chain.ainvoke(
+            self._repair_inputs(query, plan, code, error))
+        return self._repair_result(code, response)
+
+    def _code_inputs(self, query: str, plan: str,
+                     historical_context: str) -> dict[str, str]:
         formatted_prompt = self.code_prompt.format(
             query=query, plan=plan, historical_context=historical_context)
         logger.info(f"CODE AGENT prompt:\n{formatted_prompt}")
-
-        chain = self.code_prompt | self.llm
-        response = chain.invoke({
+        return {
             "query": query,
             "plan": plan,
             "historical_context": historical_context
-        })
+        }
 
+    def _code_result(self, response) -> str:
         # Clean up the response to extract just the code
-        code = response.content.strip()
+        code = _strip_code_fences(response.content)
+        logger.info(f"Generated code:\n{code}")
+        return code
 
-        # Remove markdown code blocks if present
-        if code.startswith("```python"):
-            code = code[9:]
-        elif code.startswith("```"):
-            code = code[3:]
+    def _repair_inputs(self, query: str, plan: str, code: str,
+                       error: str) -> dict[str, str]:
+        return {
+            "query": query,
+            "plan": plan,
+            "code": code,
+            "error": _compact_error(error)
+        }
 
-        if code.endswith("```"):
-            code = code[:-3]
+    def _repair_result(self, code: str, response) -> str | None:
+        diff = response.content
+        logger.info(f"Repair diff:\n{diff}")
 
-        code = code.strip()
-        logger.info(f"Generated code:\n{code}")
-        return code
+        try:
+            repaired = apply_unified_diff(code, diff)
+            compile(repaired, "<repaired>", "exec")
+        except (PatchError, SyntaxError, ValueError) as e:
+            logger.warning(f"Discarding repair: {str(e)}")
+            return None
+        if repaired.strip() == code.strip():
+            logger.warning("Discarding repair: the diff changes nothing")
+            return None
+        logger.info(f"Repaired code:\n{repaired}")
+        return repaired
+
+
+def _strip_code_fences(text: str) -> str:
+    code = text.strip()
+
+    # Remove markdown code blocks if present
+    if code.startswith("```python"):
+        code = code[9:]
+    elif code.startswith("```"):
+        code = code[3:]
+
+    if code.endswith("```"):
+        code = code[:-3]
+
+    return code.strip()
+
+
+def _compact_error(error: str) -> str:
+    """Keep the last lines of an error, where the exception is"""
+    lines = error.strip().splitlines()[-MAX_ERROR_LINES:]
+    return "\n".join(lines)[-MAX_ERROR_CHARS:]
 
 
 def create_code_agent():
@@ -0,0 +1,73 @@
+"""Per-request time budgets.
+
+A :class:`Deadline` is bound to the current context with
+:func:`deadline_scope` for the duration of a request. Graph nodes, retry
+decisions and the shared LLM transport read it with
+:func:`current_deadline` to cap the time each step may take, without the
+budget having to be threaded through every agent call.
+"""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a request has no time left for its next step"""
+
+
+class Deadline:
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self.expires_at = self.started + seconds
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def timeout(self, limit: float | None = None) -> float:
+        """Time the next step may take: the remaining budget, capped at
+        ``limit``. Raises ``DeadlineExceeded`` if nothing is left.
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(
+                f"Request deadline of {self.seconds:g}s exceeded")
+        return remaining if limit is None else min(limit, remaining)
+
+
+_current: ContextVar[Deadline | None] = ContextVar("deadline", default=None)
+
+
+@contextmanager
+def deadline_scope(deadline: Deadline | None) -> Iterator[None]:
+    """Make ``deadline`` the current one inside the ``with`` block"""
+    token = _current.set(deadline)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+def current_deadline() -> Deadline | None:
+    return _current.get()
+
+
+def time_budget(limit: float | None = None) -> float | None:
+    """Timeout for the next step under the current deadline, if any.
+
+    Returns ``limit`` when no deadline is set. Raises ``DeadlineExceeded``
+    when the current deadline has already passed.
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return limit
+    return deadline.timeout(limit)
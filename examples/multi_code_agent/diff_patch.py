@@ -0,0 +1,86 @@
+import re
+
+_HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@")
+
+
+class PatchError(ValueError):
+    """Raised when a diff cannot be parsed or does not apply"""
+
+
+def parse_hunks(diff: str) -> list[tuple[int, list[tuple[str, str]]]]:
+    """Parse a unified diff into ``(old_start, [(tag, line), ...])`` hunks.
+
+    File headers, prose and markdown fences around the diff are ignored.
+    A bare empty line inside a hunk is read as an empty context line, since
+    models often drop the leading space of those, unless it ends the hunk.
+    """
+    hunks: list[tuple[int, list[tuple[str, str]]]] = []
+    lines: list[tuple[str, str]] | None = None
+    for raw in diff.splitlines():
+        header = _HUNK_HEADER.match(raw)
+        if header:
+            lines = []
+            hunks.append((int(header.group(1)), lines))
+        elif lines is None or raw.startswith("\\"):
+            continue
+        elif raw.startswith("```"):
+            lines = None
+        elif raw == "":
+            lines.append(("=", ""))
+        elif raw[0] in " +-":
+            lines.append((raw[0], raw[1:]))
+        else:
+            # Anything else ends the hunk
+            lines = None
+    if not hunks:
+        raise PatchError("No hunks found in the diff")
+    for _, lines in hunks:
+        while lines and lines[-1][0] == "=":
+            lines.pop()
+        lines[:] = [(" " if tag == "=" else tag, text) for tag, text in lines]
+    return hunks
+
+
+def apply_unified_diff(original: str, diff: str) -> str:
+    """Apply a unified diff to ``original`` and return the patched text.
+
+    Hunk line numbers are only used as a hint: each hunk is applied where
+    its context and removed lines match, closest to the stated position,
+    ignoring trailing whitespace. Raises ``PatchError`` if a hunk does not
+    match anywhere after the previous one.
+    """
+    lines = original.splitlines()
+    # Shift of the stated positions caused by the hunks applied so far
+    delta = 0
+    # Hunks must apply in order and not overlap
+    floor = 0
+    for old_start, hunk in parse_hunks(diff):
+        old = [text for tag, text in hunk if tag in " -"]
+        new = [text for tag, text in hunk if tag in " +"]
+        expected = max(floor, old_start - 1 + delta)
+        if old:
+            position = _find(lines, old, expected, floor)
+        else:
+            # Pure insertion: a zero old_start means before the first line
+            position = min(max(floor, old_start + delta), len(lines))
+        lines[position:position + len(old)] = new
+        delta += len(new) - len(old)
+        floor = position + len(new)
+
+    patched = "\n".join(lines)
+    if original.endswith("\n") and patched:
+        patched += "\n"
+    return patched
+
+
+def _find(lines: list[str], old: list[str], expected: int, floor: int) -> int:
+    target = [line.rstrip() for line in old]
+    candidates = [
+        position for position in range(floor,
+                                       len(lines) - len(old) + 1)
+        if [line.rstrip()
+            for line in lines[position:position + len(old)]] == target
+    ]
+    if not candidates:
+        raise PatchError(f"Hunk does not apply near line {expected + 1}")
+    return min(candidates, key=lambda position: abs(position - expected))
@@ -1,18 +1,26 @@
+import asyncio
 import os
 import subprocess
 import sys
 import tempfile
+import time
 from typing import Any
 
 import traceroot
 
 logger = traceroot.get_logger()
 
+# Code containing this line fails in the stub sandbox
+STUB_FAILURE_MARKER = "# stub: fail"
+
 
 class ExecutionAgent:
 
     def __init__(self):
         self.timeout = 30  # 30 seconds timeout
+        # Keep at most this many bytes of stdout/stderr per run, so a
+        # program that prints without bound cannot blow up the request.
+        self.max_output_bytes = 20000
 
     @traceroot.trace()
     def execute_code(
@@ -21,80 +29,221 @@ class ExecutionAgent:
         plan: str,
         code: str,
         historical_context: str = "",
+        timeout: float | None = None,
     ) -> dict[str, Any]:
-        """Execute Python code safely and return results"""
+        """Execute Python code safely and return results
+
+        ``timeout`` shortens the sandbox timeout for this run, e.g. to the
+        time left before the request deadline.
+        """
+        timeout = self._timeout(timeout)
         try:
-            # Create a temporary file for the code
-            with tempfile.NamedTemporaryFile(mode='w',
-                                             suffix='.py',
-                                             delete=False) as f:
-                f.write(code)
-                temp_file = f.name
-                logger.warning(f"Created temporary file {temp_file}"
-                               f" for the code:\n{code}")
-
-            try:
-                # Execute the code using subprocess for safety
+            temp_file = self._write_code(code)
+        except Exception as e:
+            return self._failure(f"Failed to create temporary file: {str(e)}")
+
+        try:
+            # Execute the code using subprocess for safety. Output goes to
+            # temporary files instead of pipes so that only a bounded head
+            # and tail of it is ever read back into memory.
+            with tempfile.TemporaryFile() as out, \
+                    tempfile.TemporaryFile() as err:
                 result = subprocess.run([sys.executable, temp_file],
-                                        capture_output=True,
-                                        text=True,
-                                        timeout=self.timeout,
+                                        stdout=out,
+                                        stderr=err,
+                                        timeout=timeout,
                                         cwd=os.path.dirname(temp_file))
+                return self._result(result.returncode, out, err)
+        except subprocess.TimeoutExpired:
+            return self._timed_out(timeout)
+        except Exception as e:
+            return self._failure(f"Execution error:\n{str(e)}")
+        finally:
+            self._remove(temp_file)
 
-                execution_result = {
-                    "success": result.returncode == 0,
-                    "stdout": result.stdout,
-                    "stderr": result.stderr,
-                    "return_code": result.returncode,
-                }
-
-                if result.returncode != 0:
-                    execution_result["stderr"] = (
-                        f"Process exited with code {result.returncode} with "
-                        f"stdout: {result.stdout} and stderr: {result.stderr}")
-
-                if execution_result["success"]:
-                    logger.info(f"Execution result:\n{execution_result}")
-                else:
-                    logger.error(f"Execution failed:\n{execution_result}")
-                return execution_result
-
-            except subprocess.TimeoutExpired:
-                message = (f"Code execution timed out after "
-                           f"{self.timeout} seconds")
-                logger.error(message)
-                return {
-                    "success": False,
-                    "stdout": message,
-                    "stderr": message,
-                    "return_code": -1,
-                }
-            except Exception as e:
-                message = f"Execution error:\n{str(e)}"
-                logger.error(message)
-                return {
-                    "success": False,
-                    "stdout": "",
-                    "stderr": message,
-                    "return_code": -1,
-                }
-            finally:
-                # Clean up temporary file
-                try:
-                    os.unlink(temp_file)
-                except Exception:
-                    pass
+    @traceroot.trace()
+    async def execute_code_async(
+        self,
+        query: str,
+        plan: str,
+        code: str,
+        historical_context: str = "",
+        timeout: float | None = None,
+    ) -> dict[str, Any]:
+        """Async version of :meth:`execute_code`; waits without a thread"""
+        timeout = self._timeout(timeout)
+        try:
+            temp_file = self._write_code(code)
+        except Exception as e:
+            return self._failure(f"Failed to create temporary file: {str(e)}")
 
+        try:
+            with tempfile.TemporaryFile() as out, \
+                    tempfile.TemporaryFile() as err:
+                process = await asyncio.create_subprocess_exec(
+                    sys.executable,
+                    temp_file,
+                    stdout=out,
+                    stderr=err,
+                    cwd=os.path.dirname(temp_file))
+                try:
+                    return_code = await asyncio.wait_for(
+                        process.wait(), timeout)
+                finally:
+                    # Timed out or cancelled: do not leave the code running
+                    if process.returncode is None:
+                        process.kill()
+                        await process.wait()
+                return self._result(return_code, out, err)
+        except asyncio.TimeoutError:
+            return self._timed_out(timeout)
         except Exception as e:
-            message = f"Failed to create temporary file: {str(e)}"
-            logger.error(message)
+            return self._failure(f"Execution error:\n{str(e)}")
+        finally:
+            self._remove(temp_file)
+
+    def _timeout(self, timeout: float | None) -> float:
+        return self.timeout if timeout is None else min(self.timeout, timeout)
+
+    def _write_code(self, code: str) -> str:
+        # Create a temporary file for the code
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.py',
+                                         delete=False) as f:
+            f.write(code)
+            logger.warning(f"Created temporary file {f.name}"
+                           f" for the code:\n{code}")
+            return f.name
+
+    def _remove(self, temp_file: str) -> None:
+        # Clean up temporary file
+        try:
+            os.unlink(temp_file)
+        except Exception:
+            pass
+
+    def _result(self, return_code: int, out, err) -> dict[str, Any]:
+        stdout = self._read_bounded(out)
+        stderr = self._read_bounded(err)
+        execution_result = {
+            "success": return_code == 0,
+            "stdout": stdout,
+            "stderr": stderr,
+            "return_code": return_code,
+        }
+
+        if return_code != 0:
+            # Kept apart for classifying the failure
+            execution_result["program_stderr"] = stderr
+            execution_result["stderr"] = (
+                f"Process exited with code {return_code} with "
+                f"stdout: {stdout} and stderr: {stderr}")
+
+        if execution_result["success"]:
+            logger.info(f"Execution result:\n{execution_result}")
+        else:
+            logger.error(f"Execution failed:\n{execution_result}")
+        return execution_result
+
+    def _timed_out(self, timeout: float) -> dict[str, Any]:
+        message = f"Code execution timed out after {timeout:g} seconds"
+        logger.error(message)
+        return {
+            "success": False,
+            "stdout": message,
+            "stderr": message,
+            "return_code": -1,
+            # Cut short by the caller, e.g. at the request deadline
+            "timeout_shortened": timeout < self.timeout,
+        }
+
+    def _failure(self, message: str) -> dict[str, Any]:
+        logger.error(message)
+        return {
+            "success": False,
+            "stdout": "",
+            "stderr": message,
+            "return_code": -1,
+        }
+
+    def _read_bounded(self, f) -> str:
+        """Read the head and tail of a captured output file"""
+        limit = self.max_output_bytes
+        size = f.seek(0, os.SEEK_END)
+        f.seek(0)
+        if size <= limit:
+            return f.read().decode("utf-8", errors="replace")
+        head = f.read(limit // 2).decode("utf-8", errors="replace")
+        f.seek(size - limit // 2)
+        tail = f.read().decode("utf-8", errors="replace")
+        return (f"{head}\n... [{size - limit} bytes truncated] ...\n"
+                f"{tail}")
+
+
+class StubExecutionAgent:
+    """Stand-in sandbox for load tests that does not run the code.
+
+    Every run takes ``latency`` seconds and succeeds, unless the code
+    contains ``STUB_FAILURE_MARKER`` or ``latency`` exceeds its timeout.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+
+    def execute_code(
+        self,
+        query: str,
+        plan: str,
+        code: str,
+        historical_context: str = "",
+        timeout: float | None = None,
+    ) -> dict[str, Any]:
+        time.sleep(self._latency(timeout))
+        return self._result(code, timeout)
+
+    async def execute_code_async(
+        self,
+        query: str,
+        plan: str,
+        code: str,
+        historical_context: str = "",
+        timeout: float | None = None,
+    ) -> dict[str, Any]:
+        await asyncio.sleep(self._latency(timeout))
+        return self._result(code, timeout)
+
+    def _latency(self, timeout: float | None) -> float:
+        return self.latency if timeout is None else min(self.latency, timeout)
+
+    def _result(self, code: str, timeout: float | None) -> dict[str, Any]:
+        if timeout is not None and self.latency > timeout:
+            message = f"Code execution timed out after {timeout:g} seconds"
             return {
                 "success": False,
-                "stdout": "",
+                "stdout": message,
                 "stderr": message,
                 "return_code": -1,
+                # The stub has no timeout of its own
+                "timeout_shortened": True,
+            }
+        if STUB_FAILURE_MARKER in code:
+            return {
+                "success": False,
+                "stdout": "",
+                "stderr": "Stub sandbox failure",
+                "program_stderr": "Stub sandbox failure",
+                "return_code": 1,
             }
+        return {
+            "success": True,
+            "stdout": "ok",
+            "stderr": "",
+            "return_code": 0,
+        }
 
 
 def create_execution_agent():
+    # EXECUTION_SANDBOX=stub swaps in a sandbox that does not run the code
+    if os.getenv("EXECUTION_SANDBOX", "subprocess") == "stub":
+        return StubExecutionAgent(
+            float(os.getenv("EXECUTION_STUB_LATENCY_SECONDS", "0")))
     return ExecutionAgent()
@@ -1,49 +1,230 @@
+import asyncio
+import hashlib
 import os
-from typing import Any, TypedDict
+import shutil
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import (TYPE_CHECKING, Annotated, Any, Callable, Iterator, Mapping,
+                    Sequence, TypedDict)
 
 import traceroot
+from blob_store import BlobStore
 from code_agent import create_code_agent
+from deadline import (Deadline, DeadlineExceeded, current_deadline,
+                      deadline_scope, time_budget)
 from dotenv import load_dotenv
 from execution_agent import create_execution_agent
-from langgraph.graph import END, StateGraph
+from failure_memory import (LESSON_TTL_SECONDS, MAX_LESSONS, FailureMemory,
+                            error_fingerprint, format_lessons)
+from graph_render import render_graph
+from metrics import DEADLINE_EXPIRED, SANDBOX_EXECUTIONS, NodeMetrics
 from plan_agent import create_plan_agent
+from retry_policy import (REWRITE, RUNTIME, SKIP_EXECUTION, STOP,
+                          RetryDecision, RetryPolicy, classify_failure)
 from summarize_agent import create_summarize_agent
+from thread_activity import ThreadActivity
+from worker_pool import OverloadError
+
+# langchain and langgraph are imported when the graph is built, so that
+# importing this module stays cheap
+if TYPE_CHECKING:
+    from langchain_core.runnables import RunnableConfig, RunnableLambda
+    from langgraph.checkpoint.base import BaseCheckpointSaver
 
 load_dotenv()
 
 logger = traceroot.get_logger()
 
+# Keep only the most recent attempts in the graph state. Older ones are
+# never read again, and keeping all of them would grow every checkpoint and
+# every prompt with the number of retries.
+MAX_PREVIOUS_ATTEMPTS = 3
+
+
+def append_attempts(
+    left: list[dict[str, Any]],
+    right: list[dict[str, Any]],
+) -> list[dict[str, Any]]:
+    """Reducer that appends new attempts and caps the history"""
+    return (left + right)[-MAX_PREVIOUS_ATTEMPTS:]
+
 
 class AgentState(TypedDict):
     query: str
     is_coding: bool
     plan: str
-    code: str
+    # Code, stdout and stderr live in the per-request BlobStore; the state
+    # only carries their references.
+    code_ref: str
     execution_result: dict[str, Any]
-    response: str | None = None
+    response: str | None
     retry_count: int
     max_retries: int
-    previous_attempts: list[dict[str, Any]]
+    # Retry policy action the current attempt was started with, if any
+    strategy: str
+    previous_attempts: Annotated[list[dict[str, Any]], append_attempts]
+
+
+def _blobs(config: "RunnableConfig") -> BlobStore:
+    return config["configurable"]["blob_store"]
+
+
+async def _blob_io(blobs: BlobStore, fn: Callable, *args: Any) -> Any:
+    """Call ``fn``, off the event loop if ``blobs`` reads and writes files"""
+    if blobs.on_disk:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+# Graph checkpoints are written to this SQLite file unless another
+# checkpointer (or none) is passed to MultiAgentSystem.
+DEFAULT_CHECKPOINT_PATH = os.getenv("MULTI_AGENT_CHECKPOINT_PATH",
+                                    ".checkpoints/multi_agent.sqlite")
+
+# Checkpoints of a resumable thread not used for this long are deleted; 0
+# keeps them forever
+DEFAULT_CHECKPOINT_TTL_SECONDS = float(
+    os.getenv("MULTI_AGENT_CHECKPOINT_TTL_SECONDS", "86400"))
+
+# Lessons from failures that a retry got past are kept in this SQLite file;
+# unset keeps no lessons
+DEFAULT_FAILURE_MEMORY_PATH = os.getenv("MULTI_AGENT_FAILURE_MEMORY_PATH")
+FAILURE_MEMORY_MAX_LESSONS = int(
+    os.getenv("MULTI_AGENT_FAILURE_MEMORY_MAX_LESSONS", str(MAX_LESSONS)))
+FAILURE_MEMORY_TTL_SECONDS = float(
+    os.getenv("MULTI_AGENT_FAILURE_MEMORY_TTL_SECONDS",
+              str(LESSON_TTL_SECONDS)))
+
+# Time budget of a whole query, in seconds; 0 disables it
+DEFAULT_DEADLINE_SECONDS = float(
+    os.getenv("MULTI_AGENT_DEADLINE_SECONDS", "120"))
+
+TIMED_OUT_RESPONSE = ("The time limit was reached before an answer "
+                      "was ready.")
+
+SKIPPED_EXECUTION = ("Execution skipped: earlier attempts kept failing the "
+                     "same way, so this code was not run.")
+
+
+class ThreadBusyError(OverloadError):
+    """Raised when a run is started on a thread that is already running"""
+    status_code = 409
+
+    def __init__(self, thread_id: str, retry_after: int = 1):
+        super().__init__(f"Request {thread_id} is already running",
+                         retry_after)
+
+
+@dataclass
+class QueryResult:
+    """Outcome of one query run by :meth:`MultiAgentSystem.process_queries`"""
+    id: str
+    query: str
+    response: str | None = None
+    # An answer to a non-coding query, or code that ran successfully; not
+    # when every attempt failed or the deadline passed
+    success: bool = False
+    # Plan -> code -> execute attempts made, 1 for a non-coding query
+    attempts: int = 0
+    seconds: float = 0.0
+    error: str | None = None
 
 
 class MultiAgentSystem:
 
-    def __init__(self):
+    def __init__(
+        self,
+        checkpointer: "BaseCheckpointSaver | None" = None,
+        checkpoint_path: str | None = DEFAULT_CHECKPOINT_PATH,
+        failure_memory_path: str | None = DEFAULT_FAILURE_MEMORY_PATH,
+    ):
+        """Create the agents and compile the workflow graph.
+
+        Args:
+            checkpointer: Checkpointer to compile the graph with. Takes
+                precedence over ``checkpoint_path``.
+            checkpoint_path: SQLite file used for checkpoints when no
+                ``checkpointer`` is given. Pass None to disable
+                checkpointing.
+            failure_memory_path: SQLite file of the lessons learned from
+                past failures, which are added to the planning prompt.
+                None (the default unless ``MULTI_AGENT_FAILURE_MEMORY_PATH``
+                is set) disables the failure memory.
+        """
         self.plan_agent = create_plan_agent()
         self.code_agent = create_code_agent()
         self.execution_agent = create_execution_agent()
         self.summarize_agent = create_summarize_agent()
+        # Retries allowed after a failed execution, per query
+        self.max_retries = 2
+        # Decides per class of failure whether and how to retry
+        self.retry_policy = RetryPolicy()
+        # On retry, patch the failed code instead of writing it again
+        self.repair_on_retry = True
+        # Time budget of a query, see process_query
+        self.deadline_seconds = DEFAULT_DEADLINE_SECONDS
+        self.failure_memory = (FailureMemory(
+            failure_memory_path, FAILURE_MEMORY_MAX_LESSONS,
+            FAILURE_MEMORY_TTL_SECONDS) if failure_memory_path else None)
+
+        self.blob_dir = None
+        # Set when the checkpoints go to a SQLite file we opened ourselves
+        self._sqlite_path = None
+        if checkpointer is None and checkpoint_path:
+            checkpointer = self._create_sqlite_checkpointer(checkpoint_path)
+            self._sqlite_path = checkpoint_path
+        if checkpointer is not None and checkpoint_path:
+            # Blobs must outlive the process for a run to be resumable
+            self.blob_dir = os.path.join(os.path.dirname(checkpoint_path),
+                                         "blobs")
+        self.checkpointer = checkpointer
+        self.thread_activity = (ThreadActivity(self._sqlite_path,
+                                               DEFAULT_CHECKPOINT_TTL_SECONDS)
+                                if self._sqlite_path else None)
+        # Threads with a run in progress in this process
+        self._running: set[str] = set()
+        self._running_lock = threading.Lock()
+
+        self.graph = self._build_graph(checkpointer)
+        # Runs without a thread id can never be resumed, so they are not
+        # checkpointed at all
+        self._transient_graph = (self._build_graph(None)
+                                 if checkpointer is not None else self.graph)
+        self._async_graph = None
+        self._async_graph_loop = None
+
+    def _create_sqlite_checkpointer(self, path: str) -> "BaseCheckpointSaver":
+        from langgraph.checkpoint.sqlite import SqliteSaver
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        conn = sqlite3.connect(path, check_same_thread=False)
+        return SqliteSaver(conn)
+
+    def _build_graph(self, checkpointer: "BaseCheckpointSaver | None"):
+        from langgraph.graph import END, StateGraph
 
-        self.graph = self._build_graph()
-
-    def _build_graph(self):
         workflow = StateGraph(AgentState)
 
-        # Add nodes
-        workflow.add_node("planning", self.plan_node)
-        workflow.add_node("coding", self.code_node)
-        workflow.add_node("execute", self.execute_node)
-        workflow.add_node("summarize", self.summarize_node)
+        # Add nodes; graph.invoke runs the sync and graph.ainvoke the async
+        # version of each node
+        workflow.add_node(
+            "planning",
+            self._measured("planning", "plan", self.plan_node,
+                           self.aplan_node))
+        workflow.add_node(
+            "coding",
+            self._measured("coding", "code", self.code_node, self.acode_node))
+        workflow.add_node(
+            "execute",
+            self._measured("execute", "execution", self.execute_node,
+                           self.aexecute_node))
+        workflow.add_node(
+            "summarize",
+            self._measured("summarize", "summarize", self.summarize_node,
+                           self.asummarize_node))
 
         # Add edges
         workflow.set_entry_point("planning")
@@ -59,73 +240,172 @@ class MultiAgentSystem:
             "end": END
         })
 
-        return workflow.compile()
-
-    def plan_node(self, state: AgentState) -> AgentState:
+        return workflow.compile(checkpointer=checkpointer)
+
+    def _measured(self, node: str, agent: str, func: Callable,
+                  afunc: Callable) -> "RunnableLambda":
+        """Node running ``func`` or ``afunc``, timed in the node metrics and
+        with its LLM calls counted for ``agent``
+        """
+        from langchain_core.runnables import RunnableConfig, RunnableLambda
+
+        metrics = NodeMetrics(node, agent)
+
+        def run(state: AgentState, config: RunnableConfig) -> dict[str, Any]:
+            with metrics.measure():
+                return func(state, config)
+
+        async def arun(state: AgentState,
+                       config: RunnableConfig) -> dict[str, Any]:
+            with metrics.measure():
+                return await afunc(state, config)
+
+        return RunnableLambda(run, afunc=arun, name=node)
+
+    # Nodes only return the keys they change; LangGraph merges the deltas
+    # into the state, so the full state is never copied per node. Each node
+    # has an async twin that awaits the agents instead of blocking. Nodes
+    # call time_budget() first to stop the run once the deadline passed.
+    def plan_node(self, state: AgentState,
+                  config: "RunnableConfig") -> dict[str, Any]:
+        time_budget()
+        query, update = self._plan_request(state, config)
+        result = self.plan_agent.plan_query(query)
+        return {**self._plan_update(result), **update}
+
+    async def aplan_node(self, state: AgentState,
+                         config: "RunnableConfig") -> dict[str, Any]:
+        time_budget()
+        # Off the event loop: the lessons and blobs are read from disk
+        query, update = await asyncio.to_thread(self._plan_request, state,
+                                                config)
+        result = await self.plan_agent.plan_query_async(query)
+        return {**self._plan_update(result), **update}
+
+    def _plan_request(self, state: AgentState,
+                      config: "RunnableConfig") -> tuple[str, dict[str, Any]]:
+        """Build the planning query and the state changes of a new attempt"""
         # Check if we're coming from a retry (execution failure)
         is_retry = (state["retry_count"] > 0 or
                     (state.get("execution_result", {}).get("success") is False
-                     and state.get("code", "") != ""))
-
-        if is_retry:
-            # Store the previous attempt including summarization
-            previous_attempt = {
-                "plan": state.get("plan", ""),
-                "code": state.get("code", ""),
-                "execution_result": state.get("execution_result", {}),
-                "summary": state.get("response",
-                                     "")  # Include previous summary
-            }
-            previous_attempts = state.get("previous_attempts", [])
-            previous_attempts.append(previous_attempt)
-
-            # Get only the last retry's summarization
-            last_summary = previous_attempt.get("summary", "")
-            if last_summary:
-                query = (f"{state['query']}\n\n\n"
-                         f"Last attempt summary:\n{last_summary}")
-            else:
-                query = state['query']
-
-            result = self.plan_agent.plan_query(query)
-
-            return {
-                **state,
-                "is_coding": result["is_coding"],
-                "plan": result["plan"] or "",
-                "response": result["response"] or None,
-                "previous_attempts": previous_attempts,
-                "retry_count": state["retry_count"] + 1,
-                # Reset execution state for new attempt
-                "code": "",
-                "execution_result": {}
-            }
+                     and state.get("code_ref", "") != ""))
+        if not is_retry:
+            # First attempt: warn the planner about failures similar
+            # queries ran into before
+            return self._with_lessons(state["query"], state["query"]), {}
+
+        # Store the previous attempt including summarization
+        previous_attempt = {
+            "plan": state.get("plan", ""),
+            "code_ref": state.get("code_ref", ""),
+            "execution_result": state.get("execution_result", {}),
+            "summary": state.get("response") or ""
+        }
+        # Release blobs of attempts that drop out of the history
+        kept = append_attempts(state.get("previous_attempts", []),
+                               [previous_attempt])
+        _blobs(config).retain(ref for attempt in kept
+                              for ref in self._attempt_refs(attempt))
+
+        # Get only the last retry's summarization
+        last_summary = previous_attempt["summary"]
+        if last_summary:
+            query = (f"{state['query']}\n\n\n"
+                     f"Last attempt summary:\n{last_summary}")
         else:
-            # First attempt
-            result = self.plan_agent.plan_query(state["query"])
+            query = state['query']
+        # Tell the planner how the policy wants this failure handled
+        _, decision = self._retry_decision(state)
+        if decision.hint:
+            query = f"{query}\n\n\nRetry strategy:\n{decision.hint}"
+        # Add what fixed the same failure before
+        error = self._expand_result(previous_attempt["execution_result"],
+                                    _blobs(config)).get("stderr", "")
+        query = self._with_lessons(query, state["query"],
+                                   error_fingerprint(error))
+
+        return query, {
+            "previous_attempts": [previous_attempt],
+            "retry_count": state["retry_count"] + 1,
+            "strategy": decision.action,
+            # Reset execution state for new attempt
+            "code_ref": "",
+            "execution_result": {}
+        }
 
-            return {
-                **state, "is_coding": result["is_coding"],
-                "plan": result["plan"] or "",
-                "response": result["response"] or None
-            }
+    def _with_lessons(self,
+                      prompt: str,
+                      query: str,
+                      fingerprint: str | None = None) -> str:
+        """Append the lessons relevant to ``query`` to a planning prompt"""
+        if self.failure_memory is None:
+            return prompt
+        lessons = self.failure_memory.search(query, fingerprint)
+        if not lessons:
+            return prompt
+        logger.info(f"Found {len(lessons)} lessons from past failures")
+        return (f"{prompt}\n\n\nLessons from similar past requests:\n"
+                f"{format_lessons(lessons)}")
+
+    def _remember_fixes(self, state: AgentState, blobs: BlobStore) -> None:
+        """Record the failures a successful retry got past"""
+        if (self.failure_memory is None or not state["is_coding"]
+                or not state["execution_result"].get("success")):
+            return
+        for attempt in state["previous_attempts"]:
+            result = self._expand_result(attempt["execution_result"], blobs)
+            if result and not result["success"]:
+                self.failure_memory.record(state["query"], result["stderr"],
+                                           state["plan"])
+
+    def _plan_update(self, result: dict[str, Any]) -> dict[str, Any]:
+        return {
+            "is_coding": result["is_coding"],
+            "plan": result["plan"] or "",
+            "response": result["response"] or None
+        }
 
-    def _build_retry_context(self, state: AgentState) -> str:
+    def _attempt_refs(self, attempt: dict[str, Any]) -> list[str]:
+        exec_result = attempt.get("execution_result", {})
+        return [
+            attempt.get("code_ref", ""),
+            exec_result.get("stdout_ref", ""),
+            exec_result.get("stderr_ref", "")
+        ]
+
+    def _last_summary(self, state: AgentState) -> str:
+        """Get the last attempt's summary if available"""
+        if state.get("previous_attempts"):
+            return state["previous_attempts"][-1].get("summary", "")
+        return ""
+
+    def _expand_result(self, execution_result: dict[str, Any],
+                       blobs: BlobStore) -> dict[str, Any]:
+        """Resolve the blob references of a compact execution result"""
+        if not execution_result:
+            return {}
+        return {
+            "success": execution_result.get("success", False),
+            "stdout": blobs.get(execution_result.get("stdout_ref", "")),
+            "stderr": blobs.get(execution_result.get("stderr_ref", "")),
+            "return_code": execution_result.get("return_code", -1),
+        }
+
+    def _build_retry_context(self, state: AgentState, blobs: BlobStore) -> str:
         """Build context string from previous failed attempts"""
         context_parts = []
         for i, attempt in enumerate(state["previous_attempts"], 1):
             context_parts.append(f"Attempt {i}:")
             context_parts.append(f"  Plan: {attempt.get('plan', 'N/A')}")
-            context_parts.append(f"  Code: {attempt.get('code', 'N/A')}")
+            context_parts.append(
+                f"  Code: {blobs.get(attempt.get('code_ref', '')) or 'N/A'}")
             if attempt.get('execution_result'):
-                exec_result = attempt['execution_result']
+                exec_result = self._expand_result(attempt['execution_result'],
+                                                  blobs)
                 context_parts.append(
                     f"  Execution Success: {exec_result.get('success', False)}"
                 )
                 if not exec_result.get('success', False):
-                    context_parts.append(
-                        f"  Error: {exec_result.get('error', 'Unknown error')}"
-                    )
                     context_parts.append(
                         f"  Stderr: {exec_result.get('stderr', '')}")
             # Include the summary from previous attempt
@@ -135,47 +415,134 @@ class MultiAgentSystem:
             context_parts.append("")
         return "\n".join(context_parts)
 
-    def code_node(self, state: AgentState) -> AgentState:
-        # Get the last attempt's summary if available
-        last_summary = ""
-        if state.get("previous_attempts"):
-            last_attempt = state["previous_attempts"][-1]
-            last_summary = last_attempt.get("summary", "")
-
-        code = self.code_agent.generate_code(state["query"], state["plan"],
-                                             last_summary)
-
-        return {**state, "code": code}
-
-    def execute_node(self, state: AgentState) -> AgentState:
-        # Get the last attempt's summary if available
-        last_summary = ""
-        if state.get("previous_attempts"):
-            last_attempt = state["previous_attempts"][-1]
-            last_summary = last_attempt.get("summary", "")
-
+    def code_node(self, state: AgentState,
+                  config: "RunnableConfig") -> dict[str, Any]:
+        time_budget()
+        blobs = _blobs(config)
+        code = None
+        repair = self._repair_request(state, blobs)
+        if repair is not None:
+            code = self.code_agent.repair_code(*repair)
+        if code is None:
+            code = self.code_agent.generate_code(state["query"], state["plan"],
+                                                 self._last_summary(state))
+
+        return {"code_ref": blobs.put(code)}
+
+    async def acode_node(self, state: AgentState,
+                         config: "RunnableConfig") -> dict[str, Any]:
+        time_budget()
+        blobs = _blobs(config)
+        code = None
+        repair = await _blob_io(blobs, self._repair_request, state, blobs)
+        if repair is not None:
+            code = await self.code_agent.repair_code_async(*repair)
+        if code is None:
+            code = await self.code_agent.generate_code_async(
+                state["query"], state["plan"], self._last_summary(state))
+
+        return {"code_ref": await _blob_io(blobs, blobs.put, code)}
+
+    def _repair_request(self, state: AgentState,
+                        blobs: BlobStore) -> tuple[str, ...] | None:
+        """Arguments for repairing the last attempt's code, if possible"""
+        if not self.repair_on_retry or not state.get("previous_attempts"):
+            return None
+        if state.get("strategy") in (REWRITE, SKIP_EXECUTION):
+            # The policy asked for a different approach, not a patch
+            return None
+        previous = state["previous_attempts"][-1]
+        previous_code = blobs.get(previous.get("code_ref", ""))
+        if not previous_code:
+            return None
+        error = self._expand_result(previous["execution_result"],
+                                    blobs).get("stderr", "")
+        return state["query"], state["plan"], previous_code, error
+
+    def execute_node(self, state: AgentState,
+                     config: "RunnableConfig") -> dict[str, Any]:
+        blobs = _blobs(config)
+        if state.get("strategy") == SKIP_EXECUTION:
+            return self._skipped_execution(blobs)
         execution_result = self.execution_agent.execute_code(
-            state["query"], state["plan"], state["code"], last_summary)
-
-        return {**state, "execution_result": execution_result}
-
-    def summarize_node(self, state: AgentState) -> AgentState:
-        if state["is_coding"]:
-            # Get the last attempt's summary if available
-            last_summary = ""
-            if state.get("previous_attempts"):
-                last_attempt = state["previous_attempts"][-1]
-                last_summary = last_attempt.get("summary", "")
-
-            # For coding tasks, create summary from all components
-            response = self.summarize_agent.create_summary(
-                state["query"], state["plan"], state["code"],
-                state["execution_result"], state["retry_count"], last_summary)
+            state["query"],
+            state["plan"],
+            blobs.get(state["code_ref"]),
+            self._last_summary(state),
+            timeout=time_budget())
+        return self._execution_update(execution_result, blobs)
+
+    async def aexecute_node(self, state: AgentState,
+                            config: "RunnableConfig") -> dict[str, Any]:
+        blobs = _blobs(config)
+        if state.get("strategy") == SKIP_EXECUTION:
+            return await _blob_io(blobs, self._skipped_execution, blobs)
+        code = await _blob_io(blobs, blobs.get, state["code_ref"])
+        execution_result = await self.execution_agent.execute_code_async(
+            state["query"],
+            state["plan"],
+            code,
+            self._last_summary(state),
+            timeout=time_budget())
+        return await _blob_io(blobs, self._execution_update, execution_result,
+                              blobs)
+
+    def _execution_update(self, execution_result: dict[str, Any],
+                          blobs: BlobStore) -> dict[str, Any]:
+        compact = {
+            "success": execution_result["success"],
+            "return_code": execution_result["return_code"],
+            "stdout_ref": blobs.put(execution_result["stdout"]),
+            "stderr_ref": blobs.put(execution_result["stderr"]),
+        }
+        if execution_result.get("skipped"):
+            compact["skipped"] = True
+            outcome = "skipped"
+        elif not execution_result["success"]:
+            compact["error_class"] = classify_failure(execution_result)
+            outcome = compact["error_class"]
         else:
+            outcome = "success"
+        SANDBOX_EXECUTIONS.labels(outcome).inc()
+        return {"execution_result": compact}
+
+    def _skipped_execution(self, blobs: BlobStore) -> dict[str, Any]:
+        logger.warning("Skipping execution as asked by the retry policy")
+        return self._execution_update(
+            {
+                "success": False,
+                "skipped": True,
+                "stdout": "",
+                "stderr": SKIPPED_EXECUTION,
+                "return_code": -1,
+            }, blobs)
+
+    def summarize_node(self, state: AgentState,
+                       config: "RunnableConfig") -> dict[str, Any]:
+        if not state["is_coding"]:
             # For non-coding tasks, use the plan agent's response
-            response = state["response"]
-
-        return {**state, "response": response}
+            return {"response": state["response"]}
+        # For coding tasks, create summary from all components
+        time_budget()
+        response = self.summarize_agent.create_summary(
+            *self._summary_args(state, _blobs(config)))
+        return {"response": response}
+
+    async def asummarize_node(self, state: AgentState,
+                              config: "RunnableConfig") -> dict[str, Any]:
+        if not state["is_coding"]:
+            return {"response": state["response"]}
+        time_budget()
+        blobs = _blobs(config)
+        response = await self.summarize_agent.create_summary_async(
+            *await _blob_io(blobs, self._summary_args, state, blobs))
+        return {"response": response}
+
+    def _summary_args(self, state: AgentState, blobs: BlobStore) -> tuple:
+        return (state["query"], state["plan"], blobs.get(state["code_ref"]),
+                self._expand_result(state["execution_result"],
+                                    blobs), state["retry_count"],
+                self._last_summary(state))
 
     def should_code(self, state: AgentState) -> str:
         return "code" if state["is_coding"] else "end"
@@ -185,47 +552,451 @@ class MultiAgentSystem:
         """Determine if we should retry after a failed execution"""
         # Only retry if:
         # 1. This was a coding task
-        # 2. Execution failed
-        # 3. We haven't exceeded max retries
-        if (state["is_coding"]
-                and state["execution_result"].get("success") is False
-                and state["retry_count"] < state["max_retries"]):
+        # 2. Execution failed (and was not skipped on purpose)
+        # 3. The retry policy does not stop on this class of failure
+        # 4. We haven't exceeded max retries
+        # 5. Another attempt fits in the time left before the deadline
+        execution_result = state["execution_result"]
+        if (not state["is_coding"]
+                or execution_result.get("success") is not False
+                or execution_result.get("skipped")):
+            return "end"
 
+        failure_class, decision = self._retry_decision(state)
+        retries_left = state["max_retries"] - state["retry_count"]
+        if decision.action == STOP:
+            self.retry_policy.record(failure_class, STOP, retries_left)
             logger.error(f"Execution failed on attempt "
-                         f"{state['retry_count'] + 1}. Retrying...")
-            return "retry"
-        else:
+                         f"{state['retry_count'] + 1} ({failure_class}), "
+                         f"which the retry policy does not retry")
+            return "end"
+        if retries_left <= 0 or not self._retry_fits_deadline(state):
+            self.retry_policy.record(failure_class, "exhausted", 0)
             return "end"
 
+        # Skipping the execution saves one sandbox run
+        saved = 1 if decision.action == SKIP_EXECUTION else 0
+        self.retry_policy.record(failure_class, decision.action, saved)
+        logger.error(f"Execution failed on attempt "
+                     f"{state['retry_count'] + 1} ({failure_class}). "
+                     f"Retrying with action {decision.action}...")
+        return "retry"
+
+    def _retry_decision(self, state: AgentState) -> tuple[str, RetryDecision]:
+        """Retry policy decision on the failed execution in ``state``"""
+        failure_class = (state["execution_result"].get("error_class")
+                         or RUNTIME)
+        occurrence = 1 + sum(
+            1 for attempt in state.get("previous_attempts", [])
+            if attempt["execution_result"].get("error_class") == failure_class)
+        return failure_class, self.retry_policy.decide(failure_class,
+                                                       occurrence)
+
+    def _retry_fits_deadline(self, state: AgentState) -> bool:
+        deadline = current_deadline()
+        if deadline is None:
+            return True
+        # Expect the next attempt to take as long as the average one so far
+        attempt_seconds = deadline.elapsed() / (state["retry_count"] + 1)
+        if deadline.remaining() >= attempt_seconds:
+            return True
+        logger.warning(f"Not retrying: {deadline.remaining():.1f}s left "
+                       f"before the deadline, an attempt takes about "
+                       f"{attempt_seconds:.1f}s")
+        return False
+
     def draw_and_save_graph(
         self,
         output_path: str = "./examples/multi_code_agent/multi_agent_graph.png",
     ) -> None:
-        """Draw the multi-agent workflow graph and save it locally"""
-        mermaid_png = self.graph.get_graph().draw_mermaid_png()
-        with open(output_path, "wb") as f:
-            f.write(mermaid_png)
+        """Draw the multi-agent workflow graph and save it locally
+
+        Nothing is rendered when the graph has not changed since the last
+        run; see :func:`render_graph`.
+        """
+        render_graph(self.graph.get_graph(), output_path)
 
     @traceroot.trace()
-    def process_query(self, query: str) -> str:
-        """Process a user query through the multi-agent system"""
+    def process_query(
+        self,
+        query: str,
+        thread_id: str | None = None,
+        on_node: Callable[[str], None] | None = None,
+        deadline_seconds: float | None = None,
+    ) -> str:
+        """Process a user query through the multi-agent system
+
+        With a checkpointer, every finished node is persisted under
+        ``thread_id``. Calling again with the same ``thread_id`` resumes an
+        interrupted run from the last finished node, or returns the stored
+        response if the run already completed. ``on_node`` is called with
+        the name of every node as soon as it finishes.
+
+        The run gets ``deadline_seconds`` (default ``deadline_seconds`` of
+        the system, 0 for no limit) to finish. LLM calls and sandbox runs
+        are given the time left as their timeout and retries are skipped
+        when another attempt would not fit. When the deadline passes, the
+        best partial answer is returned; with a ``thread_id`` the run can
+        then be resumed like an interrupted one. Starting a second run on a
+        ``thread_id`` that is still running raises ``ThreadBusyError``.
+        """
+        with self._claim(thread_id):
+            return self._process(query, thread_id, on_node, deadline_seconds)
+
+    def _process(
+        self,
+        query: str,
+        thread_id: str | None,
+        on_node: Callable[[str], None] | None,
+        deadline_seconds: float | None,
+    ) -> str:
         logger.info(f"Processing query: {query}")
-        initial_state = {
+        resumable, config, blobs = self._new_run(thread_id)
+        graph = self.graph if resumable else self._transient_graph
+        graph_input = self._initial_state(query)
+        if graph.checkpointer is not None:
+            self._touch_thread(thread_id)
+            snapshot = graph.get_state(config)
+            # A run stopped before its input was saved starts over
+            if "query" in snapshot.values:
+                if self._completed(snapshot, query, config):
+                    return snapshot.values["response"]
+                graph_input = None
+
+        deadline = self._deadline(deadline_seconds)
+        result, expired = None, False
+        try:
+            with deadline_scope(deadline):
+                stream = graph.stream(graph_input,
+                                      config,
+                                      stream_mode=["updates", "values"])
+                for mode, chunk in stream:
+                    if mode == "values":
+                        result = chunk
+                    elif on_node is not None:
+                        for node in chunk:
+                            on_node(node)
+        except Exception as e:
+            if not self._out_of_time(e, deadline):
+                raise
+            expired = True
+            DEADLINE_EXPIRED.inc()
+
+        response = self._final_response(result, expired, blobs)
+        if not expired:
+            self._remember_fixes(result, blobs)
+        # Completed runs no longer need their blobs; runs without a
+        # caller-provided thread id can never be resumed, so drop them too.
+        if not (expired and resumable):
+            blobs.discard()
+
+        logger.info(f"Final response: {response}")
+        return response
+
+    @traceroot.trace()
+    async def process_query_async(
+        self,
+        query: str,
+        thread_id: str | None = None,
+        on_node: Callable[[str], None] | None = None,
+        deadline_seconds: float | None = None,
+    ) -> str:
+        """Async version of :meth:`process_query`.
+
+        Runs the async twin of every node, so one event loop can serve many
+        concurrent queries while they wait on the LLM or the sandbox. At the
+        deadline, the node in progress is cancelled.
+        """
+        response, _, _ = await self._arun(query, thread_id, on_node,
+                                          deadline_seconds)
+        return response
+
+    async def _arun(
+        self,
+        query: str,
+        thread_id: str | None,
+        on_node: Callable[[str], None] | None,
+        deadline_seconds: float | None,
+    ) -> tuple[str, AgentState | None, bool]:
+        """Run a query; returns the response, the final state and whether
+        the deadline passed
+        """
+        with self._claim(thread_id):
+            return await self._arun_claimed(query, thread_id, on_node,
+                                            deadline_seconds)
+
+    async def _arun_claimed(
+        self,
+        query: str,
+        thread_id: str | None,
+        on_node: Callable[[str], None] | None,
+        deadline_seconds: float | None,
+    ) -> tuple[str, AgentState | None, bool]:
+        logger.info(f"Processing query: {query}")
+        resumable, config, blobs = self._new_run(thread_id)
+        graph = (self._get_async_graph()
+                 if resumable else self._transient_graph)
+        graph_input = self._initial_state(query)
+        if graph.checkpointer is not None:
+            await asyncio.to_thread(self._touch_thread, thread_id)
+            snapshot = await graph.aget_state(config)
+            # A run stopped before its input was saved starts over
+            if "query" in snapshot.values:
+                if self._completed(snapshot, query, config):
+                    return (snapshot.values["response"], snapshot.values,
+                            False)
+                graph_input = None
+
+        deadline = self._deadline(deadline_seconds)
+        result, expired = None, False
+        try:
+            with deadline_scope(deadline):
+                async with asyncio.timeout(
+                        deadline.remaining() if deadline else None):
+                    stream = graph.astream(graph_input,
+                                           config,
+                                           stream_mode=["updates", "values"])
+                    async for mode, chunk in stream:
+                        if mode == "values":
+                            result = chunk
+                        elif on_node is not None:
+                            for node in chunk:
+                                on_node(node)
+        except Exception as e:
+            if not self._out_of_time(e, deadline):
+                raise
+            expired = True
+            DEADLINE_EXPIRED.inc()
+
+        response = await _blob_io(blobs, self._final_response, result, expired,
+                                  blobs)
+        if not expired:
+            await asyncio.to_thread(self._remember_fixes, result, blobs)
+        if not (expired and resumable):
+            await _blob_io(blobs, blobs.discard)
+
+        logger.info(f"Final response: {response}")
+        return response, result, expired
+
+    def process_queries(
+        self,
+        queries: Sequence[str] | Mapping[str, str],
+        concurrency: int = 4,
+        on_result: Callable[[QueryResult], None] | None = None,
+        deadline_seconds: float | None = None,
+        run_id: str | None = None,
+    ) -> list[QueryResult]:
+        """Process many queries, ``concurrency`` at a time.
+
+        ``queries`` is a list of queries, or a mapping of ids to queries.
+        With ids and a ``run_id``, each query runs on the thread
+        ``<run_id>/<id>``, so a batch that was interrupted can be run again
+        with the same ``run_id`` and resumes every unfinished query from
+        its last finished node. Batches with different run ids never share
+        a thread. ``on_result`` is called with the result of every query as
+        soon as it finishes. A query that raises does not stop the others;
+        its result carries the error.
+
+        Returns the results in the order of ``queries``.
+        """
+        return asyncio.run(
+            self.process_queries_async(queries, concurrency, on_result,
+                                       deadline_seconds, run_id))
+
+    async def process_queries_async(
+        self,
+        queries: Sequence[str] | Mapping[str, str],
+        concurrency: int = 4,
+        on_result: Callable[[QueryResult], None] | None = None,
+        deadline_seconds: float | None = None,
+        run_id: str | None = None,
+    ) -> list[QueryResult]:
+        """Async version of :meth:`process_queries`"""
+        resumable = isinstance(queries, Mapping) and run_id is not None
+        items = (list(queries.items()) if isinstance(queries, Mapping) else
+                 [(str(i), query) for i, query in enumerate(queries)])
+        slots = asyncio.Semaphore(concurrency)
+
+        async def run(query_id: str, query: str) -> QueryResult:
+            async with slots:
+                result = await self._query_result(
+                    query_id, query,
+                    f"{run_id}/{query_id}" if resumable else None,
+                    deadline_seconds)
+            if on_result is not None:
+                on_result(result)
+            return result
+
+        return await asyncio.gather(*(run(*item) for item in items))
+
+    async def _query_result(self, query_id: str, query: str,
+                            thread_id: str | None,
+                            deadline_seconds: float | None) -> QueryResult:
+        started = time.perf_counter()
+        result = QueryResult(query_id, query)
+        try:
+            result.response, state, expired = await self._arun(
+                query, thread_id, None, deadline_seconds)
+        except Exception as e:
+            logger.error(f"Query {query_id} failed: {str(e)}")
+            result.error = f"{type(e).__name__}: {e}"
+        else:
+            if state is not None:
+                coding = state["is_coding"]
+                result.attempts = state["retry_count"] + 1 if coding else 1
+                result.success = not expired and (
+                    not coding
+                    or state["execution_result"].get("success") is True)
+        result.seconds = time.perf_counter() - started
+        return result
+
+    def _new_run(
+            self,
+            thread_id: str | None) -> tuple[bool, dict[str, Any], BlobStore]:
+        if thread_id is None:
+            # Large blobs (code, stdout) are kept per request, outside the
+            # state; in memory only, since the run cannot be resumed
+            blobs = BlobStore()
+            return False, {"configurable": {"blob_store": blobs}}, blobs
+        blobs = BlobStore(self._blob_root(thread_id))
+        config = {
+            "configurable": {
+                "thread_id": thread_id,
+                "blob_store": blobs
+            }
+        }
+        return True, config, blobs
+
+    def _blob_root(self, thread_id: str) -> str | None:
+        if not self.blob_dir:
+            return None
+        # Thread ids come from clients; never use them as a path
+        name = hashlib.sha256(thread_id.encode()).hexdigest()[:32]
+        return os.path.join(self.blob_dir, name)
+
+    @contextmanager
+    def _claim(self, thread_id: str | None) -> Iterator[None]:
+        """Hold ``thread_id`` for one run at a time in this process"""
+        if thread_id is None:
+            yield
+            return
+        with self._running_lock:
+            if thread_id in self._running:
+                raise ThreadBusyError(thread_id)
+            self._running.add(thread_id)
+        try:
+            yield
+        finally:
+            with self._running_lock:
+                self._running.discard(thread_id)
+
+    def _touch_thread(self, thread_id: str) -> None:
+        """Mark the thread as used and delete the threads that expired"""
+        if self.thread_activity is None:
+            return
+        self.thread_activity.touch(thread_id)
+        for expired in self.thread_activity.expired():
+            if expired in self._running:
+                continue
+            logger.info(f"Deleting expired thread {expired}")
+            self.checkpointer.delete_thread(expired)
+            blob_root = self._blob_root(expired)
+            if blob_root:
+                shutil.rmtree(blob_root, ignore_errors=True)
+
+    def _deadline(self, deadline_seconds: float | None) -> Deadline | None:
+        if deadline_seconds is None:
+            deadline_seconds = self.deadline_seconds
+        return Deadline(deadline_seconds) if deadline_seconds else None
+
+    def _out_of_time(self, error: Exception,
+                     deadline: Deadline | None) -> bool:
+        """Whether ``error`` stopped the run because the deadline passed"""
+        if deadline is None or not (isinstance(error, DeadlineExceeded)
+                                    or deadline.expired):
+            return False
+        logger.warning(f"Deadline of {deadline.seconds:g}s exceeded: "
+                       f"{type(error).__name__}")
+        return True
+
+    def _final_response(self, state: AgentState | None, expired: bool,
+                        blobs: BlobStore) -> str:
+        if not expired:
+            return state["response"]
+        # Best partial answer: the latest response or summary, else the
+        # latest code and, if it ran, its output
+        if state is None:
+            return TIMED_OUT_RESPONSE
+        if state.get("response"):
+            return state["response"]
+        if self._last_summary(state):
+            return self._last_summary(state)
+        code = blobs.get(state.get("code_ref", ""))
+        if not code:
+            return TIMED_OUT_RESPONSE
+        response = f"{TIMED_OUT_RESPONSE} Latest code:\n\n{code}"
+        execution = self._expand_result(state.get("execution_result", {}),
+                                        blobs)
+        if execution.get("success"):
+            response += f"\n\nOutput:\n{execution['stdout']}"
+        return response
+
+    def _initial_state(self, query: str) -> AgentState:
+        return {
             "query": query,
             "is_coding": False,
             "plan": "",
-            "code": "",
+            "code_ref": "",
             "execution_result": {},
             "response": None,
             "retry_count": 0,
-            "max_retries": 2,
+            "max_retries": self.max_retries,
+            "strategy": "",
             "previous_attempts": []
         }
 
-        result = self.graph.invoke(initial_state)
-        response = result["response"]
-        logger.info(f"Final response: {response}")
-        return response
+    def _completed(self, snapshot: Any, query: str, config: dict[str,
+                                                                 Any]) -> bool:
+        """Check a checkpointed thread; False means it should be resumed"""
+        thread_id = config["configurable"]["thread_id"]
+        if snapshot.values["query"] != query:
+            raise ValueError(f"Thread {thread_id} belongs to a "
+                             f"different query")
+        if not snapshot.next:
+            logger.info(f"Thread {thread_id} already completed")
+            return True
+        logger.warning(f"Resuming thread {thread_id} before "
+                       f"{list(snapshot.next)}")
+        return False
+
+    def _get_async_graph(self):
+        """The graph compiled with an async checkpointer for this loop.
+
+        SqliteSaver only supports sync calls and AsyncSqliteSaver is bound
+        to the event loop it was created on, so the async graph is built
+        lazily, on the same database file, once per event loop.
+        """
+        loop = asyncio.get_running_loop()
+        if self._async_graph_loop is not loop:
+            self._async_graph = self._build_graph(
+                self._create_async_checkpointer())
+            self._async_graph_loop = loop
+        return self._async_graph
+
+    def _create_async_checkpointer(self) -> "BaseCheckpointSaver | None":
+        if self._sqlite_path is None:
+            # No checkpointer, or one given by the caller that must
+            # support async calls itself
+            return self.checkpointer
+        import aiosqlite
+        from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+        # The connection is opened on first use, by the checkpointer. It
+        # runs on its own thread, which must not keep the process alive
+        # once the loop it was opened on has finished.
+        connection = aiosqlite.connect(self._sqlite_path)
+        connection.daemon = True
+        return AsyncSqliteSaver(connection)
 
 
 def main():
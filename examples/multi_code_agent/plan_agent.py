@@ -2,8 +2,7 @@ from typing import Any, Optional
 
 import traceroot
 from dotenv import load_dotenv
-from langchain.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
+from llm_client import create_chat_model
 from pydantic import BaseModel, Field
 
 load_dotenv()
@@ -23,7 +22,10 @@ class PlanResponse(BaseModel):
 class PlanAgent:
 
     def __init__(self):
-        self.llm = ChatOpenAI(model="gpt-4o", temperature=0)
+        # Imported with the agent, not the module, to keep startup cheap
+        from langchain_core.prompts import ChatPromptTemplate
+
+        self.llm = create_chat_model("gpt-4o", temperature=0)
         self.system_prompt = (
             "You are a planning agent. "
             "Your job is to analyze user queries and create plans. "
@@ -37,6 +39,9 @@ class PlanAgent:
             "If last summary from previous attempts is provided, "
             "learn from the failures and create an improved plan that "
             "addresses the issues encountered in previous attempts.\n"
+            "If lessons from similar past requests are provided, "
+            "apply their fixes up front when the same failure could "
+            "occur.\n"
             "Be concise and innovative.\n"
             "Focus on identifying root causes and proposing different "
             "approaches to avoid repeating the same mistakes.")
@@ -47,14 +52,25 @@ class PlanAgent:
     @traceroot.trace()
     def plan_query(self, query: str) -> dict[str, Any]:
         """Process user query and determine if it's coding-related"""
+        response = self._chain().invoke(self._inputs(query))
+        return self._result(query, response)
+
+    @traceroot.trace()
+    async def plan_query_async(self, query: str) -> dict[str, Any]:
+        """Async version of :meth:`plan_query`"""
+        response = await self._chain().ainvoke(self._inputs(query))
+        return self._result(query, response)
+
+    def _chain(self):
         structured_llm = self.llm.with_structured_output(PlanResponse)
-        chain = self.plan_prompt | structured_llm
+        return self.plan_prompt | structured_llm
 
+    def _inputs(self, query: str) -> dict[str, Any]:
         formatted_prompt = self.plan_prompt.format(query=query)
         logger.info(f"PLAN AGENT prompt:\n{formatted_prompt}")
+        return {"query": query}
 
-        response = chain.invoke({"query": query})
-
+    def _result(self, query: str, response: PlanResponse) -> dict[str, Any]:
         if response.is_coding:
             logger.warning(f"Coding-related query: {query}")
             logger.warning(f"Planned response: {response.plan}")
@@ -0,0 +1,353 @@
+import asyncio
+import heapq
+import itertools
+import math
+import re
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator
+
+from rest.worker_pool import OverloadError, QueueFullError
+
+# Lower value is scheduled first
+PRIORITIES = {"interactive": 0, "batch": 1}
+
+# LLM calls plus sandbox runs made by one plan -> code -> execute ->
+# summarize attempt, used as the cost unit for coding queries
+ATTEMPT_COST = 4.0
+# Cost units a waiting request gains per second over the requests of its
+# tenant that arrive later, so cheap ones cannot starve expensive ones
+AGING_COST_PER_SECOND = 1.0
+# How often tenants with nothing queued or running are forgotten
+IDLE_SWEEP_SECONDS = 60.0
+
+_CODING_HINTS = re.compile(
+    r"\b(code|python|function|implement|algorithm|script|program|"
+    r"compute|calculate|matrix|array|list|sort|parse|regex|sql|class|"
+    r"debug|bug|complexity|return)\b", re.IGNORECASE)
+
+
+def estimate_cost(query: str,
+                  max_retries: int,
+                  cost_hint: float | None = None) -> float:
+    """Estimate the cost of a query in LLM-call units.
+
+    A non-coding question costs a single planning call. A coding task
+    costs a full attempt, plus retries, half of which are expected to be
+    used. Clients that know better can pass ``cost_hint``.
+    """
+    if cost_hint is not None:
+        return max(1.0, cost_hint)
+    if not _CODING_HINTS.search(query):
+        return 1.0
+    return ATTEMPT_COST * (1 + max_retries / 2)
+
+
+class BudgetExceededError(OverloadError):
+    """Raised when a tenant has used up its cost budget"""
+    status_code = 429
+
+    def __init__(self, tenant: str, retry_after: int):
+        super().__init__(
+            f"Tenant {tenant} is over budget, retry after {retry_after}s",
+            retry_after)
+
+
+@dataclass
+class Ticket:
+    """A request waiting for, or holding, admission"""
+    tenant: str
+    priority: str
+    cost: float
+    start_tag: float = 0.0
+    finish_tag: float = 0.0
+    enqueued_at: float = field(default_factory=time.monotonic)
+    future: asyncio.Future | None = None
+
+
+def _flow(ticket: Ticket) -> tuple[int, str]:
+    """Priority and tenant, whose waiting requests are ordered by cost"""
+    return PRIORITIES.get(ticket.priority, 0), ticket.tenant
+
+
+class _TenantBudget:
+    """Token bucket of cost units refilled at ``per_minute``"""
+
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+
+    def take(self, cost: float) -> float:
+        """Take ``cost`` units; return seconds to wait if not possible"""
+        cost = min(cost, self.per_minute)
+        self._refill()
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+        return (cost - self.tokens) * 60 / self.per_minute
+
+    def refund(self, cost: float) -> None:
+        """Give back ``cost`` units taken for a request that did not run"""
+        self._refill()
+        self.tokens = min(self.per_minute,
+                          self.tokens + min(cost, self.per_minute))
+
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.per_minute
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.per_minute,
+            self.tokens + (now - self.updated_at) * self.per_minute / 60)
+        self.updated_at = now
+
+
+class AdmissionController:
+    """Weighted-fair, priority-aware admission of requests by cost.
+
+    Admitted requests may hold at most ``capacity`` cost units and
+    ``max_concurrent`` slots in total. Waiting requests are served by
+    priority class first and, within a class, in start-time fair queueing
+    order across tenants: the next request of each tenant is tagged with a
+    virtual finish time that grows by ``cost / weight``, so a tenant
+    sending a burst of expensive queries cannot starve tenants sending
+    cheap ones. A tenant's own requests go cheapest first, aged by
+    ``AGING_COST_PER_SECOND`` so that expensive ones still get their turn.
+
+    Budget taken by a request that never ran, because it was cancelled
+    while waiting or refused downstream, is refunded. Tenants with nothing
+    queued or running are forgotten once their state no longer matters.
+    """
+
+    def __init__(
+        self,
+        capacity: float,
+        max_concurrent: int,
+        max_waiting: int,
+        tenant_budget_per_minute: float = 0.0,
+        tenant_weights: dict[str, float] | None = None,
+    ):
+        self.capacity = capacity
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.tenant_budget_per_minute = tenant_budget_per_minute
+        self.tenant_weights = tenant_weights or {}
+        # Next request of each (priority, tenant) flow, in fair order;
+        # entries of requests no longer first in their flow are skipped
+        self._queue: list[tuple[int, float, int, Ticket]] = []
+        # Waiting requests of each flow, cheapest (after aging) first
+        self._flows: dict[tuple[int, str], list[tuple[float, int,
+                                                      Ticket]]] = {}
+        self._heads: dict[tuple[int, str], Ticket] = {}
+        self._waiting = 0
+        self._sequence = itertools.count()
+        self._epoch = time.monotonic()
+        self._next_sweep = self._epoch + IDLE_SWEEP_SECONDS
+        self._virtual_time = 0.0
+        self._max_finish = 0.0
+        self._tenant_finish: dict[str, float] = defaultdict(float)
+        self._budgets: dict[str, _TenantBudget] = {}
+        self._in_flight_cost = 0.0
+        self._in_flight = 0
+        self._tenant_in_flight: dict[str, float] = defaultdict(float)
+        self.admitted = 0
+        self.rejected = 0
+        self.over_budget = 0
+        self._waits: list[float] = []
+
+    def enqueue(self, ticket: Ticket) -> Ticket:
+        """Queue ``ticket`` or fail fast when overloaded or over budget"""
+        self._evict_idle()
+        if self._waiting >= self.max_waiting:
+            self.rejected += 1
+            raise QueueFullError(self._retry_after())
+        if self.tenant_budget_per_minute > 0:
+            budget = self._budgets.setdefault(
+                ticket.tenant, _TenantBudget(self.tenant_budget_per_minute))
+            wait = budget.take(ticket.cost)
+            if wait > 0:
+                self.over_budget += 1
+                raise BudgetExceededError(ticket.tenant, math.ceil(wait))
+
+        # A request can never need more than the whole capacity
+        ticket.cost = min(ticket.cost, self.capacity)
+        ticket.future = asyncio.get_running_loop().create_future()
+        flow = _flow(ticket)
+        arrival = ticket.enqueued_at - self._epoch
+        heapq.heappush(self._flows.setdefault(flow, []),
+                       (ticket.cost + arrival * AGING_COST_PER_SECOND,
+                        next(self._sequence), ticket))
+        self._waiting += 1
+        self._schedule(flow)
+        self._dispatch()
+        return ticket
+
+    async def wait(self, ticket: Ticket) -> None:
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            # Given up while waiting: drop it, or hand back its admission
+            if ticket.future.done() and not ticket.future.cancelled():
+                self.release(ticket)
+            else:
+                self._remove(ticket)
+            self.refund(ticket)
+            raise
+
+    def refund(self, ticket: Ticket) -> None:
+        """Give the budget of a request that did not run back to its
+        tenant
+        """
+        budget = self._budgets.get(ticket.tenant)
+        if budget is not None:
+            budget.refund(ticket.cost)
+
+    def release(self, ticket: Ticket) -> None:
+        self._in_flight_cost -= ticket.cost
+        self._in_flight -= 1
+        self._tenant_in_flight[ticket.tenant] -= ticket.cost
+        if not self._in_flight and not self._waiting:
+            # Idle: virtual time catches up with the requests served
+            self._virtual_time = max(self._virtual_time, self._max_finish)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def admit(self, ticket: Ticket) -> AsyncIterator[Ticket]:
+        """Hold admission for ``ticket`` for the duration of the block"""
+        self.enqueue(ticket)
+        await self.wait(ticket)
+        try:
+            yield ticket
+        except OverloadError:
+            # Refused before doing any work
+            self.refund(ticket)
+            raise
+        finally:
+            self.release(ticket)
+
+    def _dispatch(self) -> None:
+        # Strict order: the head waits for capacity rather than being
+        # overtaken, so expensive requests are not starved either.
+        while self._queue:
+            ticket = self._queue[0][3]
+            flow = _flow(ticket)
+            if self._heads.get(flow) is not ticket:
+                # Overtaken by a cheaper request of its flow, or removed
+                heapq.heappop(self._queue)
+                continue
+            if (self._in_flight >= self.max_concurrent
+                    or self._in_flight_cost + ticket.cost > self.capacity):
+                return
+            heapq.heappop(self._queue)
+            heapq.heappop(self._flows[flow])
+            del self._heads[flow]
+            self._waiting -= 1
+            self._schedule(flow)
+            self._virtual_time = max(self._virtual_time, ticket.start_tag)
+            self._tenant_finish[ticket.tenant] = ticket.finish_tag
+            self._max_finish = max(self._max_finish, ticket.finish_tag)
+            self._in_flight_cost += ticket.cost
+            self._in_flight += 1
+            self._tenant_in_flight[ticket.tenant] += ticket.cost
+            self.admitted += 1
+            self._waits.append(time.monotonic() - ticket.enqueued_at)
+            del self._waits[:-1000]
+            ticket.future.set_result(None)
+
+    def _schedule(self, flow: tuple[int, str]) -> None:
+        """Tag the first request of ``flow`` and queue it, if not yet"""
+        waiting = self._flows.get(flow)
+        if not waiting:
+            self._flows.pop(flow, None)
+            return
+        ticket = waiting[0][2]
+        if self._heads.get(flow) is ticket:
+            return
+        # The tenant's finish tag only moves when a request is admitted, so
+        # a request overtaken by a cheaper one is tagged again from scratch
+        self._heads[flow] = ticket
+        weight = self.tenant_weights.get(ticket.tenant, 1.0)
+        ticket.start_tag = max(self._virtual_time,
+                               self._tenant_finish[ticket.tenant])
+        ticket.finish_tag = ticket.start_tag + ticket.cost / weight
+        heapq.heappush(
+            self._queue,
+            (flow[0], ticket.finish_tag, next(self._sequence), ticket))
+
+    def _remove(self, ticket: Ticket) -> None:
+        flow = _flow(ticket)
+        waiting = self._flows.get(flow, [])
+        remaining = [item for item in waiting if item[2] is not ticket]
+        if len(remaining) == len(waiting):
+            return
+        heapq.heapify(remaining)
+        self._flows[flow] = remaining
+        self._waiting -= 1
+        if self._heads.get(flow) is ticket:
+            del self._heads[flow]
+        self._schedule(flow)
+        self._dispatch()
+
+    def _evict_idle(self) -> None:
+        """Forget tenants with nothing queued or running, once their fair
+        queueing tag is caught up with and their budget has refilled
+        """
+        now = time.monotonic()
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + IDLE_SWEEP_SECONDS
+        busy = {tenant for _, tenant in self._flows}
+        busy.update(tenant for tenant, cost in self._tenant_in_flight.items()
+                    if cost > 1e-9)
+        for tenant in set(self._tenant_in_flight) - busy:
+            del self._tenant_in_flight[tenant]
+        for tenant, finish in list(self._tenant_finish.items()):
+            if tenant not in busy and finish <= self._virtual_time:
+                del self._tenant_finish[tenant]
+        for tenant, budget in list(self._budgets.items()):
+            if tenant not in busy and budget.full():
+                del self._budgets[tenant]
+
+    def _retry_after(self) -> int:
+        if not self._waits:
+            return 1
+        return max(1, math.ceil(sum(self._waits) / len(self._waits)))
+
+    def stats(self) -> dict[str, Any]:
+        waiting: dict[str, int] = defaultdict(int)
+        waiting_cost: dict[str, float] = defaultdict(float)
+        for flow in self._flows.values():
+            for _, _, ticket in flow:
+                waiting[ticket.priority] += 1
+                waiting_cost[ticket.tenant] += ticket.cost
+        waits = sorted(self._waits)
+        return {
+            "capacity": self.capacity,
+            "max_concurrent": self.max_concurrent,
+            "in_flight": self._in_flight,
+            "in_flight_cost": self._in_flight_cost,
+            "waiting_by_priority": dict(waiting),
+            "tenants": {
+                tenant: {
+                    "in_flight_cost":
+                    self._tenant_in_flight[tenant],
+                    "waiting_cost":
+                    waiting_cost[tenant],
+                    "budget_remaining": (self._budgets[tenant].tokens
+                                         if tenant in self._budgets else None),
+                }
+                for tenant in set(self._tenant_in_flight) | set(waiting_cost)
+            },
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "over_budget": self.over_budget,
+            "admission_wait_seconds": {
+                "p50": waits[len(waits) // 2] if waits else 0.0,
+                "p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            },
+        }
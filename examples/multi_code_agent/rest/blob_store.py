@@ -0,0 +1,85 @@
+import hashlib
+import os
+import shutil
+import threading
+from typing import Iterable
+
+
+class BlobStore:
+    """Per-request store that keeps large strings out of the graph state.
+
+    Blobs are content-addressed, so the graph state only carries the short
+    reference returned by :meth:`put` and identical code or output produced
+    by several attempts is stored once. When ``root`` is given, blobs are
+    also written to that directory so a checkpointed run can be resumed by
+    another process.
+    """
+
+    def __init__(self, root: str | None = None):
+        self._blobs: dict[str, str] = {}
+        self._lock = threading.Lock()
+        self._root = root
+
+    @property
+    def on_disk(self) -> bool:
+        """Whether blobs are also read from and written to files"""
+        return self._root is not None
+
+    def put(self, data: str) -> str:
+        """Store ``data`` and return its reference ("" for empty data)"""
+        if not data:
+            return ""
+        ref = hashlib.sha256(data.encode("utf-8")).hexdigest()[:16]
+        with self._lock:
+            self._blobs.setdefault(ref, data)
+        if self._root:
+            os.makedirs(self._root, exist_ok=True)
+            path = os.path.join(self._root, ref)
+            if not os.path.exists(path):
+                with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+                    f.write(data)
+                os.replace(f"{path}.tmp", path)
+        return ref
+
+    def get(self, ref: str) -> str:
+        if not ref:
+            return ""
+        with self._lock:
+            if ref in self._blobs:
+                return self._blobs[ref]
+        if self._root:
+            try:
+                with open(os.path.join(self._root, ref),
+                          encoding="utf-8") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                return ""
+            with self._lock:
+                self._blobs[ref] = data
+            return data
+        return ""
+
+    def retain(self, refs: Iterable[str]) -> None:
+        """Drop every blob that is not referenced by ``refs``"""
+        keep = set(refs)
+        with self._lock:
+            for ref in list(self._blobs):
+                if ref not in keep:
+                    del self._blobs[ref]
+        if self._root and os.path.isdir(self._root):
+            for name in os.listdir(self._root):
+                if name not in keep:
+                    try:
+                        os.unlink(os.path.join(self._root, name))
+                    except FileNotFoundError:
+                        pass
+
+    def discard(self) -> None:
+        """Drop all blobs, including the on-disk copies"""
+        with self._lock:
+            self._blobs.clear()
+        if self._root:
+            shutil.rmtree(self._root, ignore_errors=True)
+
+    def __len__(self) -> int:
+        return len(self._blobs)
@@ -0,0 +1,333 @@
+import asyncio
+import json
+import os
+import time
+from typing import TYPE_CHECKING, Any, AsyncIterator, Callable
+
+from rest.admission import (PRIORITIES, AdmissionController, Ticket,
+                            estimate_cost)
+from rest.jobs import JobManager, create_job_store
+from rest.metrics import REGISTRY, Registry
+from rest.rate_limit import priority_scope
+from rest.single_flight import SingleFlight, normalize_query
+from rest.worker_pool import BoundedWorkerPool, OverloadError
+
+import traceroot
+
+if TYPE_CHECKING:
+    from rest.main import MultiAgentSystem
+
+logger = traceroot.get_logger()
+
+# Seconds between comments sent on a quiet event stream, so that proxies do
+# not close it while a node is running
+STREAM_HEARTBEAT_SECONDS = 15
+# Response headers of an event stream; proxies must not buffer it
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+
+class ServiceStartingError(OverloadError):
+    """Raised for requests that arrive before the service is ready"""
+
+    def __init__(self, retry_after: int = 1):
+        super().__init__("Service is starting, retry shortly", retry_after)
+
+
+def _create_system() -> "MultiAgentSystem":
+    # Importing the agents pulls in langchain and langgraph, which is the
+    # bulk of the cold start, so it happens off the import path
+    from rest.main import MultiAgentSystem
+    return MultiAgentSystem()
+
+
+def _pool_stats() -> dict[str, Any]:
+    # Deferred, the pooled HTTP clients come with the system
+    from rest.llm_client import pool_stats
+    return pool_stats()
+
+
+def _event(name: str, data: dict[str, Any]) -> str:
+    """A server-sent event; JSON keeps ``data`` on a single line"""
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+class CodeService:
+    """Runs /code requests against a shared MultiAgentSystem.
+
+    Identical queries that arrive concurrently are coalesced into a single
+    pipeline run whose response is shared by all of them; requests with a
+    ``request_id`` only share the run of the same ``request_id``. Each run is
+    admitted by its estimated cost through a priority-aware, weighted-fair
+    queue and then awaited on the event loop, bounded by the worker pool.
+    Refused requests raise an ``OverloadError``. Long queries can instead
+    be submitted as background jobs through :attr:`jobs`, or followed node
+    by node through :meth:`stream`.
+
+    The system is either given or built by :meth:`start` in a background
+    thread, so a server can bind and answer readiness probes right away.
+    Requests that arrive before then raise a ``ServiceStartingError``.
+    """
+
+    def __init__(
+        self,
+        system: "MultiAgentSystem | None" = None,
+        system_factory: Callable[[], "MultiAgentSystem"] = _create_system,
+    ):
+        self.system = system
+        self.system_factory = system_factory
+        self.startup_error: str | None = None
+        self.startup_seconds: float | None = None
+        self._startup: asyncio.Task | None = None
+        self.single_flight = SingleFlight(grace_seconds=float(
+            os.getenv("CODE_SERVER_COALESCE_GRACE_SECONDS", "2")))
+        self.worker_pool = BoundedWorkerPool(
+            max_workers=int(os.getenv("CODE_SERVER_MAX_WORKERS", "32")),
+            max_queue=int(os.getenv("CODE_SERVER_MAX_QUEUE", "64")))
+        # Admission decides which waiting request gets the next worker, so
+        # it never lets more runs through than there are workers.
+        self.admission = AdmissionController(
+            capacity=float(os.getenv("CODE_SERVER_ADMISSION_CAPACITY", "256")),
+            max_concurrent=self.worker_pool.max_workers,
+            max_waiting=self.worker_pool.max_queue,
+            tenant_budget_per_minute=float(
+                os.getenv("CODE_SERVER_TENANT_BUDGET_PER_MINUTE", "0")))
+        self.jobs = JobManager(
+            system,
+            self.worker_pool,
+            self.admission,
+            lambda query: self.ticket(query, priority="batch"),
+            create_job_store(os.getenv("CODE_SERVER_JOB_STORE", "memory")),
+            ttl_seconds=float(os.getenv("CODE_SERVER_JOB_TTL_SECONDS",
+                                        "3600")))
+        self.register_metrics(REGISTRY)
+
+    def ticket(
+        self,
+        query: str,
+        tenant: str | None = None,
+        priority: str | None = None,
+        cost_hint: float | None = None,
+    ) -> Ticket:
+        """Build the admission ticket of a query from the client's hints"""
+        self._check_ready()
+        return Ticket(tenant=tenant or "default",
+                      priority=priority or "interactive",
+                      cost=estimate_cost(query, self.system.max_retries,
+                                         cost_hint))
+
+    async def process(
+        self,
+        query: str,
+        request_id: str | None = None,
+        ticket: Ticket | None = None,
+    ) -> str:
+        self._check_ready()
+        ticket = ticket or self.ticket(query)
+        key = normalize_query(query)
+        if request_id is not None:
+            # Only joins runs on the same thread, so that the request can
+            # always be resumed from its own checkpoint
+            key = f"{request_id}\0{key}"
+        return await self.single_flight.run(
+            key, lambda: self._run(query, request_id, ticket))
+
+    async def _run(self,
+                   query: str,
+                   request_id: str | None,
+                   ticket: Ticket,
+                   on_node: Callable[[str], None] | None = None) -> str:
+        # The LLM calls of the run are rate limited at its priority too
+        with priority_scope(PRIORITIES.get(ticket.priority, 0)):
+            async with self.admission.admit(ticket):
+                return await self.worker_pool.run_async(
+                    self.system.process_query_async,
+                    query,
+                    thread_id=request_id,
+                    on_node=on_node)
+
+    async def stream(
+        self,
+        query: str,
+        request_id: str | None = None,
+        ticket: Ticket | None = None,
+    ) -> AsyncIterator[str]:
+        """Run a query, yielding server-sent events as it progresses.
+
+        A ``node`` event is sent as each graph node finishes, then a
+        ``result`` event with the response, or an ``error`` event with the
+        HTTP status the request would have got. Streamed runs are not
+        coalesced, since each caller follows the progress of its own run.
+        Closing the stream cancels the run; with a ``request_id`` it can be
+        resumed from its checkpoint.
+        """
+        self._check_ready()
+        ticket = ticket or self.ticket(query)
+        nodes: asyncio.Queue[str | None] = asyncio.Queue()
+        run = asyncio.ensure_future(
+            self._run(query, request_id, ticket, on_node=nodes.put_nowait))
+        run.add_done_callback(lambda _: nodes.put_nowait(None))
+        try:
+            while True:
+                try:
+                    node = await asyncio.wait_for(nodes.get(),
+                                                  STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": heartbeat\n\n"
+                    continue
+                if node is None:
+                    break
+                yield _event("node", {"node": node})
+            yield _event("result", {
+                "status": "success",
+                "response": run.result()
+            })
+        except OverloadError as e:
+            logger.warning(f"Rejecting streamed query: {str(e)}")
+            yield _event(
+                "error", {
+                    "status_code": e.status_code,
+                    "detail": str(e),
+                    "retry_after": e.retry_after
+                })
+        except Exception as e:
+            logger.error(f"Error processing streamed query: {str(e)}")
+            yield _event("error", {
+                "status_code": 500,
+                "detail": f"Query processing failed: {str(e)}"
+            })
+        finally:
+            run.cancel()
+
+    @property
+    def ready(self) -> bool:
+        return self.system is not None
+
+    def start(self) -> None:
+        """Build the system in the background, then resume unfinished jobs
+
+        Must be called from the event loop, e.g. in the app's lifespan.
+        """
+        if self._startup is None:
+            self._startup = asyncio.ensure_future(self._start())
+
+    def stop(self) -> None:
+        """Called at shutdown, before the remaining tasks are cancelled"""
+        self.jobs.stop()
+
+    async def _start(self) -> None:
+        started = time.perf_counter()
+        if self.system is None:
+            try:
+                # Run the imports and client setup off the event loop
+                self.system = await asyncio.to_thread(self.system_factory)
+            except Exception as e:
+                logger.error(f"Failed to start the service: {str(e)}")
+                self.startup_error = str(e)
+                return
+        self.startup_seconds = time.perf_counter() - started
+        logger.info(f"Service ready in {self.startup_seconds:.2f}s")
+        self.jobs.system = self.system
+        self.jobs.start()
+        await self.jobs.recover()
+
+    def _check_ready(self) -> None:
+        if self.system is None:
+            raise ServiceStartingError()
+
+    def readiness(self) -> dict[str, Any]:
+        if self.startup_error is not None:
+            status = "failed"
+        else:
+            status = "ready" if self.ready else "starting"
+        return {
+            "status": status,
+            "startup_seconds": self.startup_seconds,
+            "error": self.startup_error,
+        }
+
+    def register_metrics(self, registry: Registry) -> None:
+        """Export the counters kept by the service's components.
+
+        They are read when the metrics are scraped, so the request path
+        pays nothing for them.
+        """
+        pool = self.worker_pool
+        registry.callback("worker_pool_running", "Pipeline runs in progress",
+                          lambda: pool.stats()["running"])
+        registry.callback("worker_pool_queued",
+                          "Pipeline runs waiting for a worker",
+                          lambda: pool.stats()["queued"])
+        registry.callback("worker_pool_rejected_total",
+                          "Runs refused because the queue was full",
+                          lambda: pool.rejected, "counter")
+        registry.callback(
+            "admission_waiting", "Requests waiting for admission",
+            lambda: self.admission.stats()["waiting_by_priority"], "gauge",
+            ("priority", ))
+        registry.callback("admission_in_flight_cost",
+                          "Estimated cost of the admitted requests",
+                          lambda: self.admission.stats()["in_flight_cost"])
+        flights = self.single_flight
+        registry.callback(
+            "coalesced_requests_total",
+            "Requests answered by another request's run", lambda: {
+                "in_flight": flights.inflight_hits,
+                "grace": flights.grace_hits
+            }, "counter", ("kind", ))
+        registry.callback("coalescing_hit_ratio",
+                          "Fraction of requests answered by another run",
+                          lambda: flights.stats()["hit_rate"])
+        registry.callback(
+            "retry_decisions_total",
+            "Retry policy decisions by class of failure and action",
+            self._retry_decisions, "counter", ("failure_class", "action"))
+        registry.callback("failure_memory_hits_total",
+                          "Lessons added to planning prompts",
+                          lambda: self._failure_memory_stats()["hits"],
+                          "counter")
+        registry.callback("llm_pool_in_flight",
+                          "LLM requests waiting for their response headers",
+                          lambda: _pool_stats()["in_flight"])
+        registry.callback("llm_connection_reuse_ratio",
+                          "Fraction of LLM requests on a reused connection",
+                          lambda: _pool_stats()["reuse_ratio"])
+        registry.callback("llm_hedged_requests_total",
+                          "Duplicate LLM requests sent by hedging",
+                          lambda: _pool_stats()["hedging"]["hedged"],
+                          "counter")
+        registry.callback("llm_rate_limit_waiting",
+                          "LLM requests waiting for room in the rate limits",
+                          lambda: _pool_stats()["rate_limit"]["waiting"])
+        registry.callback("llm_rate_limited_total",
+                          "LLM responses with status 429",
+                          lambda: _pool_stats()["rate_limit"]["throttled"],
+                          "counter")
+
+    def _retry_decisions(self) -> dict[tuple[str, str], int]:
+        if self.system is None:
+            return {}
+        return {
+            (failure_class, action): count
+            for failure_class, counts in
+            self.system.retry_policy.stats().items()
+            for action, count in counts.items()
+            if action not in ("failures", "attempts_saved")
+        }
+
+    def _failure_memory_stats(self) -> dict[str, int]:
+        if self.system is None or not self.system.failure_memory:
+            return {"lessons": 0, "hits": 0}
+        return self.system.failure_memory.stats()
+
+    def stats(self) -> dict[str, Any]:
+        stats = {
+            "single_flight": self.single_flight.stats(),
+            "admission": self.admission.stats(),
+            "worker_pool": self.worker_pool.stats(),
+            "llm_pool": _pool_stats(),
+        }
+        if self.system is not None:
+            stats["retry_policy"] = self.system.retry_policy.stats()
+            if self.system.failure_memory:
+                stats["failure_memory"] = self.system.failure_memory.stats()
+        return stats
@@ -0,0 +1,208 @@
+"""Persistent index of past failures and what fixed them.
+
+When a coding query only succeeds after a retry, the error of every failed
+attempt is stored as a lesson together with the plan that finally worked.
+Lessons are looked up by error fingerprint and by word overlap with a new
+query, so the planner can avoid a known failure on the first attempt
+instead of rediscovering the fix through the retry loop. Lessons expire
+after ``ttl_seconds``, and only the ``max_lessons`` most used are kept.
+"""
+import os
+import re
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+
+# Only the start of the plan that fixed a failure and the end of the
+# error output are kept in a lesson
+MAX_FIX_CHARS = 600
+MAX_ERROR_CHARS = 1000
+# Word overlap (Jaccard) a lesson needs with the query to be relevant
+MIN_SIMILARITY = 0.2
+# Lessons kept, and their age in seconds before they are forgotten
+MAX_LESSONS = 1000
+LESSON_TTL_SECONDS = 30 * 24 * 3600
+
+_WORD = re.compile(r"[a-z][a-z0-9_]+")
+# Words that appear in most coding queries and say nothing about them
+_STOP_WORDS = frozenset([
+    "a", "an", "and", "are", "as", "be", "by", "code", "for", "from",
+    "function", "given", "how", "in", "is", "it", "of", "on", "or", "program",
+    "python", "return", "script", "that", "the", "this", "to", "use", "using",
+    "with", "write"
+])
+# Last "SomeError: message" line of a traceback
+_EXCEPTION = re.compile(r"^(?:[\w.]+\.)?(\w+(?:Error|Exception|Exit|Warning)|"
+                        r"KeyboardInterrupt)\b:?\s*(.*)$")
+
+
+@dataclass
+class Lesson:
+    """A failure seen before and the plan that got past it"""
+    fingerprint: str
+    error: str
+    fix: str
+    # Word overlap of the query the lesson was recorded for with the
+    # query it was found for
+    similarity: float = 0.0
+
+
+def query_terms(query: str) -> set[str]:
+    return {
+        word
+        for word in _WORD.findall(query.lower()) if word not in _STOP_WORDS
+    }
+
+
+def error_fingerprint(error: str) -> str:
+    """Normalize an error output to the kind of failure it reports.
+
+    The exception type and message are kept with numbers, paths and
+    addresses masked, so the same failure matches across programs.
+    """
+    lines = [line.strip() for line in error.splitlines() if line.strip()]
+    if not lines:
+        return ""
+    if any("timed out" in line.lower() for line in lines[-3:]):
+        return "Timeout"
+    line = next((line for line in reversed(lines) if _EXCEPTION.match(line)),
+                lines[-1])
+    match = _EXCEPTION.match(line)
+    if match:
+        line = f"{match.group(1)}: {match.group(2)}".rstrip(": ")
+    line = re.sub(r"(/[\w.-]+)+", "<path>", line)
+    line = re.sub(r"0x[0-9a-fA-F]+", "<address>", line)
+    line = re.sub(r"\d+", "N", line)
+    return line[:200]
+
+
+class FailureMemory:
+    """SQLite-backed lesson index, safe to share between threads"""
+
+    def __init__(self,
+                 path: str,
+                 max_lessons: int = MAX_LESSONS,
+                 ttl_seconds: float = LESSON_TTL_SECONDS):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_lessons = max_lessons
+        self.ttl_seconds = ttl_seconds
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS lessons ("
+                               "id INTEGER PRIMARY KEY, fingerprint TEXT, "
+                               "query TEXT, term_count INTEGER, error TEXT, "
+                               "fix TEXT, created_at REAL, "
+                               "hits INTEGER DEFAULT 0, "
+                               "UNIQUE (fingerprint, query))")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS lessons_fingerprint "
+                "ON lessons (fingerprint)")
+            # Inverted index from query words to lessons
+            self._conn.execute("CREATE TABLE IF NOT EXISTS terms ("
+                               "term TEXT, lesson_id INTEGER, "
+                               "PRIMARY KEY (term, lesson_id))")
+
+    def record(self, query: str, error: str, fix: str) -> None:
+        """Remember that ``fix`` got ``query`` past ``error``"""
+        fingerprint = error_fingerprint(error)
+        if not fingerprint or not fix:
+            return
+        terms = query_terms(query)
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "INSERT INTO lessons (fingerprint, query, term_count, error, "
+                "fix, created_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (fingerprint, query) DO UPDATE SET "
+                "error = excluded.error, fix = excluded.fix, "
+                "created_at = excluded.created_at RETURNING id",
+                (fingerprint, query, len(terms), error[-MAX_ERROR_CHARS:],
+                 fix[:MAX_FIX_CHARS], time.time())).fetchone()
+            self._conn.executemany("INSERT OR IGNORE INTO terms VALUES (?, ?)",
+                                   [(term, row[0]) for term in terms])
+            self._prune()
+
+    def _prune(self) -> None:
+        """Forget expired lessons, then the least used beyond the cap"""
+        deleted = self._conn.execute(
+            "DELETE FROM lessons WHERE created_at < ?",
+            (self._oldest(), )).rowcount
+        if self.max_lessons:
+            deleted += self._conn.execute(
+                "DELETE FROM lessons WHERE id NOT IN (SELECT id FROM lessons "
+                "ORDER BY hits DESC, created_at DESC LIMIT ?)",
+                (self.max_lessons, )).rowcount
+        if deleted:
+            self._conn.execute("DELETE FROM terms WHERE lesson_id NOT IN "
+                               "(SELECT id FROM lessons)")
+
+    def _oldest(self) -> float:
+        """Creation time of the oldest lesson still valid"""
+        return time.time() - self.ttl_seconds if self.ttl_seconds else 0.0
+
+    def search(self,
+               query: str,
+               fingerprint: str | None = None,
+               limit: int = 3) -> list[Lesson]:
+        """Lessons relevant to ``query``, best first, one per failure kind.
+
+        A lesson is relevant when its query shares enough words with
+        ``query``, or when it is about the failure ``fingerprint``.
+        """
+        terms = query_terms(query)
+        with self._lock:
+            shared: dict[int, int] = {}
+            if terms:
+                marks = ", ".join("?" * len(terms))
+                shared = dict(
+                    self._conn.execute(
+                        f"SELECT lesson_id, COUNT(*) FROM terms "
+                        f"WHERE term IN ({marks}) GROUP BY lesson_id",
+                        list(terms)).fetchall())
+            ids = list(shared)
+            if fingerprint:
+                matches = self._conn.execute(
+                    "SELECT id FROM lessons WHERE fingerprint = ?",
+                    (fingerprint, )).fetchall()
+                ids += [row[0] for row in matches]
+            if not ids:
+                return []
+            marks = ", ".join("?" * len(ids))
+            rows = self._conn.execute(
+                f"SELECT id, fingerprint, term_count, error, fix, hits "
+                f"FROM lessons WHERE id IN ({marks}) AND created_at >= ?",
+                ids + [self._oldest()]).fetchall()
+
+        best: dict[str, tuple[float, int, int, Lesson]] = {}
+        for lesson_id, kind, term_count, error, fix, hits in rows:
+            common = shared.get(lesson_id, 0)
+            similarity = common / (len(terms) + term_count - common or 1)
+            if similarity < MIN_SIMILARITY and kind != fingerprint:
+                continue
+            # Matching the current failure beats any word overlap
+            score = similarity + (kind == fingerprint)
+            lesson = Lesson(kind, error, fix, round(similarity, 3))
+            if kind not in best or (score, hits) > best[kind][:2]:
+                best[kind] = (score, hits, lesson_id, lesson)
+        ranked = sorted(best.values(), key=lambda item: item[:2],
+                        reverse=True)[:limit]
+        if ranked:
+            with self._lock, self._conn:
+                self._conn.executemany(
+                    "UPDATE lessons SET hits = hits + 1 WHERE id = ?",
+                    [(item[2], ) for item in ranked])
+        return [item[3] for item in ranked]
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            lessons, hits = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(hits), 0) "
+                "FROM lessons").fetchone()
+        return {"lessons": lessons, "hits": hits}
+
+
+def format_lessons(lessons: list[Lesson]) -> str:
+    """Render lessons as a list for a planning prompt"""
+    return "\n".join(f"- Failure: {lesson.fingerprint}\n"
+                     f"  What fixed it: {lesson.fix}" for lesson in lessons)
@@ -0,0 +1,316 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from concurrent import futures
+from dataclasses import asdict, dataclass, field, replace
+from typing import TYPE_CHECKING, Any, Callable
+
+from rest.admission import PRIORITIES, AdmissionController, Ticket
+from rest.rate_limit import priority_scope
+from rest.worker_pool import BoundedWorkerPool, OverloadError
+
+import traceroot
+
+if TYPE_CHECKING:
+    from rest.main import MultiAgentSystem
+
+logger = traceroot.get_logger()
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+
+# Seconds between evictions of expired jobs; evicting is a table scan
+EVICTION_INTERVAL_SECONDS = 60
+
+
+@dataclass
+class Job:
+    """A query submitted through the asynchronous job API"""
+    id: str
+    query: str
+    status: str = QUEUED
+    # Names of the graph nodes finished so far, in order
+    progress: list[str] = field(default_factory=list)
+    result: str | None = None
+    error: str | None = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (SUCCEEDED, FAILED)
+
+    def to_dict(self) -> dict[str, Any]:
+        return asdict(self)
+
+
+class JobStore(ABC):
+    """Interface for job persistence; implementations must be thread-safe"""
+
+    @abstractmethod
+    def save(self, job: Job) -> None:
+        ...
+
+    @abstractmethod
+    def get(self, job_id: str) -> Job | None:
+        ...
+
+    @abstractmethod
+    def unfinished(self) -> list[Job]:
+        """Jobs that were queued or running, e.g. before a restart"""
+
+    @abstractmethod
+    def evict(self, finished_before: float) -> list[str]:
+        """Delete finished jobs last updated before ``finished_before``
+
+        Returns:
+            Ids of the deleted jobs
+        """
+
+
+class MemoryJobStore(JobStore):
+
+    def __init__(self):
+        self._jobs: dict[str, Job] = {}
+        self._lock = threading.Lock()
+
+    def save(self, job: Job) -> None:
+        with self._lock:
+            self._jobs[job.id] = Job(**job.to_dict())
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return Job(**job.to_dict()) if job else None
+
+    def unfinished(self) -> list[Job]:
+        with self._lock:
+            return [
+                Job(**job.to_dict()) for job in self._jobs.values()
+                if not job.finished
+            ]
+
+    def evict(self, finished_before: float) -> list[str]:
+        with self._lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job.finished and job.updated_at < finished_before
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+        return expired
+
+
+class SqliteJobStore(JobStore):
+    """Job store that survives restarts, so unfinished jobs can resume"""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS jobs ("
+                               "id TEXT PRIMARY KEY, status TEXT, "
+                               "updated_at REAL, data TEXT)")
+
+    def save(self, job: Job) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?)",
+                (job.id, job.status, job.updated_at, json.dumps(
+                    job.to_dict())))
+
+    def get(self, job_id: str) -> Job | None:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM jobs WHERE id = ?",
+                                     (job_id, )).fetchone()
+        return Job(**json.loads(row[0])) if row else None
+
+    def unfinished(self) -> list[Job]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT data FROM jobs WHERE status IN (?, ?)",
+                (QUEUED, RUNNING)).fetchall()
+        return [Job(**json.loads(row[0])) for row in rows]
+
+    def evict(self, finished_before: float) -> list[str]:
+        with self._lock, self._conn:
+            rows = self._conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ? "
+                "RETURNING id",
+                (SUCCEEDED, FAILED, finished_before)).fetchall()
+        return [row[0] for row in rows]
+
+
+def create_job_store(spec: str) -> JobStore:
+    """Create a job store from ``"memory"`` or ``"sqlite:<path>"``"""
+    if spec == "memory":
+        return MemoryJobStore()
+    if spec.startswith("sqlite:"):
+        return SqliteJobStore(spec[len("sqlite:"):])
+    raise ValueError(f"Unknown job store: {spec}")
+
+
+class JobManager:
+    """Runs submitted queries in the background and tracks their state.
+
+    Jobs go through the same admission control as /code requests, run on
+    the shared worker pool and use their id as the checkpoint thread id, so
+    a job left unfinished by a restart resumes from its last finished node
+    when :meth:`recover` is called.
+    """
+
+    def __init__(
+        self,
+        system: "MultiAgentSystem | None",
+        worker_pool: BoundedWorkerPool,
+        admission: AdmissionController,
+        ticket_factory: Callable[[str], Ticket],
+        store: JobStore,
+        ttl_seconds: float = 3600,
+    ):
+        # May be set later, once a lazily built system is ready
+        self.system = system
+        self.worker_pool = worker_pool
+        self.admission = admission
+        # Builds the admission ticket of jobs resumed by recover()
+        self.ticket_factory = ticket_factory
+        self.store = store
+        self.ttl_seconds = ttl_seconds
+        self._tasks: set[asyncio.Task] = set()
+        self._eviction: asyncio.Task | None = None
+        # The store is only used by one thread, off the event loop, so job
+        # updates are saved in order and reads see the saves before them
+        self._writer = futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="job-store")
+        # Set at shutdown, when cancelled jobs are left for recover()
+        self._stopping = False
+
+    def submit(self, query: str, ticket: Ticket) -> Job:
+        """Queue a new job; raises ``OverloadError`` when refused"""
+        job = Job(id=uuid.uuid4().hex, query=query)
+        self._start(job, ticket)
+        return job
+
+    async def get(self, job_id: str) -> Job | None:
+        return await self._in_writer(self.store.get, job_id)
+
+    def start(self) -> None:
+        """Evict expired jobs periodically; must be called from the event
+        loop
+        """
+        if self._eviction is None:
+            self._eviction = asyncio.ensure_future(self._evict_periodically())
+
+    def stop(self) -> None:
+        """Leave the jobs cancelled from now on unfinished, so that a
+        persistent store resumes them after the restart
+        """
+        self._stopping = True
+        if self._eviction is not None:
+            self._eviction.cancel()
+
+    async def recover(self) -> int:
+        """Resubmit jobs that were unfinished when the process stopped"""
+        jobs = await self._in_writer(self.store.unfinished)
+        for job in jobs:
+            logger.warning(f"Resuming job {job.id}")
+            job.status = QUEUED
+            try:
+                self._start(job, self.ticket_factory(job.query))
+            except OverloadError:
+                logger.error(f"No capacity left to resume job {job.id}")
+        return len(jobs)
+
+    def _start(self, job: Job, ticket: Ticket) -> None:
+        # Queued before the job runs, so the writer saves it before any
+        # update of the run
+        self._save(job)
+        try:
+            self.admission.enqueue(ticket)
+        except OverloadError as e:
+            self._update(job, status=FAILED, error=str(e))
+            raise
+        task = asyncio.ensure_future(self._run_admitted(job, ticket))
+        # Keep a reference, the event loop only holds weak ones
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run_admitted(self, job: Job, ticket: Ticket) -> None:
+        try:
+            await self.admission.wait(ticket)
+            try:
+                with priority_scope(PRIORITIES.get(ticket.priority, 0)):
+                    await self.worker_pool.run_async(self._run, job)
+            except OverloadError:
+                # Refused by the worker pool before the job ran
+                self.admission.refund(ticket)
+                raise
+            finally:
+                self.admission.release(ticket)
+        except asyncio.CancelledError:
+            if not self._stopping:
+                logger.error(f"Job {job.id} was cancelled")
+                self._update(job, status=FAILED, error="Job was cancelled")
+            raise
+        except Exception as e:
+            # Refused by the worker pool, or failed outside the query
+            logger.error(f"Job {job.id} failed: {str(e)}")
+            await asyncio.wrap_future(
+                self._update(job, status=FAILED, error=str(e)))
+
+    async def _run(self, job: Job) -> None:
+        self._update(job, status=RUNNING)
+        try:
+            result = await self.system.process_query_async(
+                job.query,
+                thread_id=job.id,
+                on_node=lambda node: self._update(
+                    job, progress=job.progress + [node]))
+            await asyncio.wrap_future(
+                self._update(job, status=SUCCEEDED, result=result))
+        except Exception as e:
+            logger.error(f"Job {job.id} failed: {str(e)}")
+            await asyncio.wrap_future(
+                self._update(job, status=FAILED, error=str(e)))
+
+    def _update(self, job: Job, **changes: Any) -> futures.Future:
+        """Change ``job`` and save it in the background; the returned
+        future is done once it is saved
+        """
+        for key, value in changes.items():
+            setattr(job, key, value)
+        job.updated_at = time.time()
+        return self._save(job)
+
+    def _save(self, job: Job) -> futures.Future:
+        # Save a copy: the job keeps changing while the save waits
+        return self._writer.submit(self.store.save, replace(job))
+
+    async def _in_writer(self, fn: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.wrap_future(self._writer.submit(fn, *args))
+
+    async def _evict_periodically(self) -> None:
+        while True:
+            await asyncio.sleep(EVICTION_INTERVAL_SECONDS)
+            try:
+                await self._in_writer(self._evict_expired)
+            except Exception as e:
+                logger.error(f"Failed to evict expired jobs: {str(e)}")
+
+    def _evict_expired(self) -> None:
+        """Runs in the writer thread"""
+        evicted = self.store.evict(time.time() - self.ttl_seconds)
+        # The checkpoints of finished jobs are not needed anymore either
+        if self.system is not None and self.system.checkpointer is not None:
+            for job_id in evicted:
+                self.system.checkpointer.delete_thread(job_id)
+        if evicted:
+            logger.info(f"Evicted {len(evicted)} expired jobs")
@@ -0,0 +1,359 @@
+"""Process-wide metrics in the Prometheus text format.
+
+Metrics are declared once at import time. Code on the request path binds
+the label values it needs ahead of time with ``metric.labels(...)`` and
+keeps the child, so recording a value is a lock and an addition, without
+building label dicts or formatting strings per request. Values that are
+already counted elsewhere (queue depth, cache hits, ...) are read from
+their owner only when the metrics are scraped, through
+:meth:`Registry.callback`.
+
+:func:`render` returns every metric in the text exposition format served on
+``GET /metrics``, and :func:`install_metrics` counts and times the HTTP
+requests of a FastAPI app.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Any, Callable, Iterator
+
+if TYPE_CHECKING:
+    from fastapi import FastAPI
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+PREFIX = "code_server_"
+# Upper bounds in seconds, from a fast HTTP route to a full pipeline run
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(names: tuple[str, ...],
+                   values: tuple[str, ...],
+                   extra: str = "") -> str:
+    pairs = [
+        f'{name}="{_escape(value)}"' for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return (str(value).replace("\\",
+                               "\\\\").replace("\n",
+                                               "\\n").replace('"', '\\"'))
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Value:
+    """A counter or gauge for one set of label values"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class _Histogram:
+    """Bucketed observations for one set of label values"""
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self._lock = threading.Lock()
+        self.buckets = buckets
+        # One count per bucket plus the +Inf one, not cumulative
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Metric:
+    """A metric family; :meth:`labels` returns the child of a label set"""
+
+    def __init__(self,
+                 name: str,
+                 help: str,
+                 kind: str,
+                 labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = labels
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._children: dict[tuple[str, ...], Any] = {}
+        if not labels:
+            # Reported as 0 until the first value is recorded
+            self.labels()
+
+    def labels(self, *values: str) -> Any:
+        """Child of the label ``values``; bind it once and keep it"""
+        child = self._children.get(values)
+        if child is not None:
+            return child
+        if len(values) != len(self.label_names):
+            raise ValueError(f"{self.name} takes labels {self.label_names}")
+        with self._lock:
+            if values not in self._children:
+                self._children[values] = (_Histogram(self.buckets) if self.kind
+                                          == "histogram" else _Value())
+            return self._children[values]
+
+    # Shortcuts for metrics without labels
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.labels().dec(amount)
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def samples(self) -> Iterator[str]:
+        for values, child in list(self._children.items()):
+            if self.kind != "histogram":
+                yield (f"{self.name}"
+                       f"{_format_labels(self.label_names, values)} "
+                       f"{_format_value(child.value)}")
+                continue
+            with child._lock:
+                counts, total = list(child.counts), child.sum
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"), ), counts):
+                cumulative += count
+                le = f'le="{_format_value(float(bound))}"'
+                yield (f"{self.name}_bucket"
+                       f"{_format_labels(self.label_names, values, le)} "
+                       f"{cumulative}")
+            labels = _format_labels(self.label_names, values)
+            yield f"{self.name}_sum{labels} {_format_value(total)}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class _Callback:
+    """A metric whose values are read from ``read`` at scrape time"""
+
+    def __init__(self, name: str, help: str, kind: str,
+                 labels: tuple[str, ...], read: Callable[[], Any]):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = labels
+        self.read = read
+
+    def samples(self) -> Iterator[str]:
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            if not isinstance(label_values, tuple):
+                label_values = (label_values, )
+            yield (f"{self.name}"
+                   f"{_format_labels(self.label_names, label_values)} "
+                   f"{_format_value(value)}")
+
+
+class Registry:
+    """The metrics of a process, rendered by :meth:`render`"""
+
+    def __init__(self, prefix: str = PREFIX):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._metrics: dict[str, Metric | _Callback] = {}
+
+    def _add(self, metric: Metric | _Callback) -> Any:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str,
+                                                          ...] = ()) -> Metric:
+        return self._add(Metric(self.prefix + name, help, "counter", labels))
+
+    def gauge(self, name: str, help: str, labels: tuple[str,
+                                                        ...] = ()) -> Metric:
+        return self._add(Metric(self.prefix + name, help, "gauge", labels))
+
+    def histogram(self,
+                  name: str,
+                  help: str,
+                  labels: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Metric:
+        return self._add(
+            Metric(self.prefix + name, help, "histogram", labels, buckets))
+
+    def callback(self,
+                 name: str,
+                 help: str,
+                 read: Callable[[], Any],
+                 kind: str = "gauge",
+                 labels: tuple[str, ...] = ()) -> None:
+        """Report the value returned by ``read()`` at every scrape.
+
+        ``read`` returns a number, or a dict of numbers keyed by the label
+        values (a tuple, or a string for a single label). Registering the
+        same name again replaces the callback.
+        """
+        self._add(_Callback(self.prefix + name, help, kind, labels, read))
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUESTS = REGISTRY.counter("http_requests_total",
+                                 "HTTP requests by route and status",
+                                 ("method", "route", "status"))
+HTTP_SECONDS = REGISTRY.histogram("http_request_duration_seconds",
+                                  "HTTP request latency by route",
+                                  ("method", "route"))
+HTTP_IN_FLIGHT = REGISTRY.gauge("http_requests_in_flight",
+                                "HTTP requests being served")
+NODE_SECONDS = REGISTRY.histogram("graph_node_duration_seconds",
+                                  "Time spent in each graph node", ("node", ))
+LLM_CALLS = REGISTRY.counter("llm_calls_total",
+                             "LLM calls by agent and outcome",
+                             ("agent", "outcome"))
+LLM_SECONDS = REGISTRY.histogram("llm_call_duration_seconds",
+                                 "LLM call latency by agent", ("agent", ))
+SANDBOX_EXECUTIONS = REGISTRY.counter(
+    "sandbox_executions_total",
+    "Sandbox runs by outcome: success, skipped or the class of failure",
+    ("outcome", ))
+DEADLINE_EXPIRED = REGISTRY.counter(
+    "deadline_expired_total",
+    "Queries that returned a partial answer at their deadline")
+
+
+class AgentMetrics:
+    """Pre-bound metrics of the LLM calls made by one agent"""
+
+    def __init__(self, agent: str):
+        self.agent = agent
+        self.seconds = LLM_SECONDS.labels(agent)
+        self.ok = LLM_CALLS.labels(agent, "ok")
+        self.error = LLM_CALLS.labels(agent, "error")
+        self.timeout = LLM_CALLS.labels(agent, "timeout")
+
+
+_OTHER_AGENT = AgentMetrics("other")
+# Agent of the graph node running in this context
+_agent: ContextVar[AgentMetrics] = ContextVar("metrics_agent",
+                                              default=_OTHER_AGENT)
+
+
+def current_agent() -> AgentMetrics:
+    """Metrics of the agent on whose behalf the current code runs"""
+    return _agent.get()
+
+
+class NodeMetrics:
+    """Times a graph node and attributes its LLM calls to its agent"""
+
+    def __init__(self, node: str, agent: str | None = None):
+        self.duration = NODE_SECONDS.labels(node)
+        self.agent = AgentMetrics(agent or node)
+
+    @contextmanager
+    def measure(self) -> Iterator[None]:
+        token = _agent.set(self.agent)
+        try:
+            with self.duration.time():
+                yield
+        finally:
+            _agent.reset(token)
+
+
+_IN_FLIGHT = HTTP_IN_FLIGHT.labels()
+# Other methods are counted as "other", clients choose the method freely
+_METHODS = frozenset(
+    ("GET", "HEAD", "POST", "PUT", "DELETE", "PATCH", "OPTIONS"))
+
+
+def render() -> str:
+    return REGISTRY.render()
+
+
+class _MetricsMiddleware:
+    """ASGI middleware counting and timing HTTP requests by route.
+
+    Requests are labelled with the route template (``/jobs/{job_id}``), not
+    the path, and with a known method, so the number of label sets stays
+    bounded.
+    """
+
+    def __init__(self, app: Any):
+        self.app = app
+
+    async def __call__(self, scope: dict, receive: Any, send: Any) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_with_status(message: dict) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        _IN_FLIGHT.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            seconds = time.perf_counter() - started
+            _IN_FLIGHT.dec()
+            route = scope.get("route")
+            path = route.path if route is not None else "unmatched"
+            method = scope["method"]
+            if method not in _METHODS:
+                method = "other"
+            HTTP_SECONDS.labels(method, path).observe(seconds)
+            HTTP_REQUESTS.labels(method, path, str(status)).inc()
+
+
+def install_metrics(app: "FastAPI") -> None:
+    """Count and time the HTTP requests of ``app`` by route"""
+    app.add_middleware(_MetricsMiddleware)
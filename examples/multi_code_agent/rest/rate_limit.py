@@ -0,0 +1,404 @@
+"""Rate-limit-aware scheduling of LLM calls.
+
+Providers cap requests and tokens per minute (RPM and TPM). Agents that run
+into the caps on their own get 429 responses and retry after a blind
+backoff. The shared LLM transport (see ``llm_client.py``) instead passes
+every call through one :class:`RateLimiter`: it estimates the tokens of the
+call from the request body, lets callers through in priority order while
+both token buckets have room, and lowers the buckets to the remaining quota
+the provider reports in its ``x-ratelimit-*`` headers.
+
+The buckets can be kept in a SQLite file (:class:`SqliteQuotaStore`) so
+that several processes share one quota; callers are ordered by priority
+within each process. Async callers then wait for the file in a thread, not
+on the event loop.
+"""
+import asyncio
+import itertools
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Mapping, TypeVar
+
+from rest.deadline import time_budget
+
+T = TypeVar("T")
+
+# Rough size of a token in English text and code, and the tokens each
+# message adds for its role and separators
+CHARS_PER_TOKEN = 4
+MESSAGE_TOKENS = 4
+# Completion tokens counted for a call that does not set max_tokens
+COMPLETION_TOKENS = 256
+# How often callers behind the head of the queue check their turn
+POLL_SECONDS = 0.05
+# How long the head of the queue waits before checking the quota again,
+# which headers of other responses may have changed
+MAX_WAIT_SECONDS = 1.0
+
+_priority: ContextVar[int] = ContextVar("llm_priority", default=0)
+
+
+@contextmanager
+def priority_scope(priority: int) -> Iterator[None]:
+    """Schedule LLM calls made inside the ``with`` block at ``priority``;
+    lower values go first
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def estimate_tokens(body: bytes,
+                    completion_tokens: int = COMPLETION_TOKENS) -> int:
+    """Tokens a chat completion request will use, from its JSON body.
+
+    The prompt is counted at ``CHARS_PER_TOKEN`` characters per token, and
+    the completion at its ``max_tokens`` or ``completion_tokens``.
+    """
+    try:
+        payload = json.loads(body or b"null")
+    except ValueError:
+        return 0
+    if not isinstance(payload, dict):
+        return 0
+    messages = payload.get("messages") or []
+    chars = 0
+    for message in messages:
+        content = message.get("content") or ""
+        if isinstance(content, list):
+            # Content parts; only text counts
+            content = " ".join(
+                part.get("text", "") for part in content
+                if isinstance(part, dict))
+        chars += len(content)
+    completion = (payload.get("max_completion_tokens")
+                  or payload.get("max_tokens") or completion_tokens)
+    return (math.ceil(chars / CHARS_PER_TOKEN) +
+            MESSAGE_TOKENS * len(messages) + completion)
+
+
+@dataclass
+class Quota:
+    """Levels of the request and token buckets"""
+    requests: float
+    tokens: float
+    # Wall-clock times, so they can be shared between processes
+    updated_at: float
+    paused_until: float = 0.0
+
+
+# Function of the current quota returning the new quota and a result
+QuotaUpdate = Callable[[Quota | None], tuple[Quota, T]]
+
+
+class MemoryQuotaStore:
+    """Keeps the quota of this process"""
+
+    # Updates never wait on I/O, so they can run on the event loop
+    blocking = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._quota: Quota | None = None
+
+    def update(self, fn: QuotaUpdate[T]) -> T:
+        """Replace the quota with ``fn`` of it, atomically"""
+        with self._lock:
+            self._quota, result = fn(self._quota)
+            return result
+
+
+class SqliteQuotaStore:
+    """Keeps one quota shared by every process using the same file"""
+
+    # Updates may wait up to 30 seconds for another process's transaction
+    blocking = True
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Transactions are managed explicitly, see update()
+        self._conn = sqlite3.connect(path,
+                                     timeout=30,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS quota ("
+                               "id INTEGER PRIMARY KEY CHECK (id = 0), "
+                               "requests REAL, tokens REAL, "
+                               "updated_at REAL, paused_until REAL)")
+
+    def update(self, fn: QuotaUpdate[T]) -> T:
+        with self._lock:
+            # Take the write lock up front so that no other process reads
+            # the quota between our read and write
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute(
+                    "SELECT requests, tokens, updated_at, paused_until "
+                    "FROM quota").fetchone()
+                quota, result = fn(Quota(*row) if row else None)
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO quota VALUES (0, ?, ?, ?, ?)",
+                    (quota.requests, quota.tokens, quota.updated_at,
+                     quota.paused_until))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            return result
+
+
+def _header(headers: Mapping[str, str], name: str) -> float | None:
+    try:
+        return float(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """Token buckets of ``rpm`` requests and ``tpm`` tokens per minute.
+
+    A bucket holds at most a minute of quota and refills continuously; a
+    limit of 0 disables its bucket. Callers queue by priority (see
+    :func:`priority_scope`), then by arrival, and the head of the queue
+    goes once both buckets have room for it. Waiting never outlasts the
+    current request deadline.
+    """
+
+    def __init__(self,
+                 rpm: float = 0,
+                 tpm: float = 0,
+                 store: MemoryQuotaStore | SqliteQuotaStore | None = None,
+                 completion_tokens: int = COMPLETION_TOKENS):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.completion_tokens = completion_tokens
+        self.store = store or MemoryQuotaStore()
+        self._lock = threading.Lock()
+        self._turn = threading.Condition(self._lock)
+        self._queue: list[tuple[int, int]] = []
+        self._sequence = itertools.count()
+        self.acquired = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.peak_waiting = 0
+        self.tokens_estimated = 0
+        self.throttled = 0
+        self.remaining: dict[str, float | None] = {
+            "requests": None,
+            "tokens": None
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.rpm > 0 or self.tpm > 0
+
+    def estimate(self, body: bytes) -> int:
+        return estimate_tokens(body, self.completion_tokens)
+
+    def acquire(self, tokens: int) -> None:
+        """Block until a call of ``tokens`` may be sent"""
+        if not self.enabled:
+            return
+        ticket = self._enqueue()
+        started = time.monotonic()
+        try:
+            while True:
+                wait = self._try_take(ticket, tokens)
+                if wait == 0:
+                    break
+                with self._turn:
+                    self._turn.wait(time_budget(wait))
+        finally:
+            self._dequeue(ticket)
+        self._acquired(tokens, time.monotonic() - started)
+
+    async def aacquire(self, tokens: int) -> None:
+        """Wait on the event loop until a call of ``tokens`` may be sent"""
+        if not self.enabled:
+            return
+        ticket = self._enqueue()
+        started = time.monotonic()
+        try:
+            while True:
+                wait = await self._atry_take(ticket, tokens)
+                if wait == 0:
+                    break
+                await asyncio.sleep(time_budget(wait))
+        finally:
+            self._dequeue(ticket)
+        self._acquired(tokens, time.monotonic() - started)
+
+    def try_acquire(self, tokens: int) -> bool:
+        """Take quota for a call only if nobody waits and there is room"""
+        if not self.enabled:
+            return True
+        if self._waiting():
+            return False
+        return self.store.update(lambda q: self._take(q, tokens)) == 0
+
+    async def atry_acquire(self, tokens: int) -> bool:
+        """Async version of try_acquire"""
+        if not self.enabled:
+            return True
+        if self._waiting():
+            return False
+        return await self._aupdate(lambda q: self._take(q, tokens)) == 0
+
+    def observe(self, status_code: int, headers: Mapping[str, str]) -> None:
+        """Sync the buckets with the quota reported by a response"""
+        lower = self._lowering(status_code, headers)
+        if lower is not None:
+            self.store.update(lower)
+
+    async def aobserve(self, status_code: int, headers: Mapping[str,
+                                                                str]) -> None:
+        """Async version of observe"""
+        lower = self._lowering(status_code, headers)
+        if lower is not None:
+            await self._aupdate(lower)
+
+    def _lowering(self, status_code: int,
+                  headers: Mapping[str, str]) -> QuotaUpdate[None] | None:
+        """Count the response, and the quota update it calls for if any"""
+        remaining_requests = _header(headers, "x-ratelimit-remaining-requests")
+        remaining_tokens = _header(headers, "x-ratelimit-remaining-tokens")
+        retry_after = None
+        if status_code == 429:
+            retry_after = _header(headers, "retry-after-ms")
+            if retry_after is not None:
+                retry_after /= 1000
+            else:
+                retry_after = _header(headers, "retry-after") or 1.0
+        with self._lock:
+            self.throttled += status_code == 429
+            if remaining_requests is not None:
+                self.remaining["requests"] = remaining_requests
+            if remaining_tokens is not None:
+                self.remaining["tokens"] = remaining_tokens
+        if not self.enabled or (remaining_requests is None
+                                and remaining_tokens is None
+                                and retry_after is None):
+            return None
+
+        def lower(quota: Quota | None) -> tuple[Quota, None]:
+            quota = self._refill(quota)
+            if remaining_requests is not None:
+                quota.requests = min(quota.requests, remaining_requests)
+            if remaining_tokens is not None:
+                quota.tokens = min(quota.tokens, remaining_tokens)
+            if retry_after is not None:
+                # The provider knows better; stop everyone until then
+                quota.paused_until = max(quota.paused_until,
+                                         quota.updated_at + retry_after)
+            return quota, None
+
+        return lower
+
+    async def _aupdate(self, fn: QuotaUpdate[T]) -> T:
+        """``store.update``, in a thread if the store may block"""
+        if self.store.blocking:
+            return await asyncio.to_thread(self.store.update, fn)
+        return self.store.update(fn)
+
+    def _enqueue(self) -> tuple[int, int]:
+        ticket = (_priority.get(), next(self._sequence))
+        with self._lock:
+            self._queue.append(ticket)
+            self._queue.sort()
+            self.peak_waiting = max(self.peak_waiting, len(self._queue))
+        return ticket
+
+    def _dequeue(self, ticket: tuple[int, int]) -> None:
+        with self._turn:
+            self._queue.remove(ticket)
+            self._turn.notify_all()
+
+    def _acquired(self, tokens: int, seconds: float) -> None:
+        with self._lock:
+            self.acquired += 1
+            self.tokens_estimated += tokens
+            if seconds >= POLL_SECONDS:
+                self.waited += 1
+                self.wait_seconds += seconds
+
+    def _waiting(self) -> bool:
+        with self._lock:
+            return bool(self._queue)
+
+    def _first(self, ticket: tuple[int, int]) -> bool:
+        # The store is updated outside the lock, which async callers also
+        # take on the event loop
+        with self._lock:
+            return self._queue[0] == ticket
+
+    def _try_take(self, ticket: tuple[int, int], tokens: int) -> float:
+        """Take quota if ``ticket`` is first; else seconds to wait"""
+        if not self._first(ticket):
+            return POLL_SECONDS
+        wait = self.store.update(lambda q: self._take(q, tokens))
+        return min(wait, MAX_WAIT_SECONDS)
+
+    async def _atry_take(self, ticket: tuple[int, int], tokens: int) -> float:
+        """Async version of _try_take"""
+        if not self._first(ticket):
+            return POLL_SECONDS
+        wait = await self._aupdate(lambda q: self._take(q, tokens))
+        return min(wait, MAX_WAIT_SECONDS)
+
+    def _refill(self, quota: Quota | None) -> Quota:
+        now = time.time()
+        if quota is None:
+            return Quota(self.rpm, self.tpm, now)
+        elapsed = max(0.0, now - quota.updated_at)
+        quota.requests = min(self.rpm,
+                             quota.requests + elapsed * self.rpm / 60)
+        quota.tokens = min(self.tpm, quota.tokens + elapsed * self.tpm / 60)
+        quota.updated_at = now
+        return quota
+
+    def _take(self, quota: Quota | None, tokens: int) -> tuple[Quota, float]:
+        quota = self._refill(quota)
+        if quota.paused_until > quota.updated_at:
+            return quota, quota.paused_until - quota.updated_at
+        wait = 0.0
+        if self.rpm > 0 and quota.requests < 1:
+            wait = (1 - quota.requests) * 60 / self.rpm
+        # A call can never need more than a full bucket
+        tokens = min(tokens, self.tpm)
+        if self.tpm > 0 and quota.tokens < tokens:
+            wait = max(wait, (tokens - quota.tokens) * 60 / self.tpm)
+        if wait > 0:
+            return quota, wait
+        if self.rpm > 0:
+            quota.requests -= 1
+        if self.tpm > 0:
+            quota.tokens -= tokens
+        return quota, wait
+
+    def snapshot(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "rpm": self.rpm,
+                "tpm": self.tpm,
+                "shared": isinstance(self.store, SqliteQuotaStore),
+                "waiting": len(self._queue),
+                "peak_waiting": self.peak_waiting,
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "wait_seconds": round(self.wait_seconds, 3),
+                "tokens_estimated": self.tokens_estimated,
+                "throttled": self.throttled,
+                "remaining": dict(self.remaining),
+            }
@@ -0,0 +1,152 @@
+"""Retry decisions by class of execution failure.
+
+Retrying every failure the same way wastes attempts on failures that will
+happen again: code that timed out on an intractable input times out again
+when it is only patched. :func:`classify_failure` sorts a failed execution
+into a class, and :class:`RetryPolicy` decides per class and occurrence
+whether to retry as usual, ask for a rewrite with a different algorithm,
+write code that is not executed, or stop.
+"""
+import re
+import threading
+from dataclasses import dataclass
+from typing import Any
+
+# Failure classes
+TIMEOUT = "timeout"
+# Timed out because the sandbox timeout was cut to the time left before the
+# request deadline, which has now passed
+DEADLINE = "deadline"
+MEMORY = "memory"
+SYNTAX = "syntax"
+MISSING_MODULE = "missing_module"
+ASSERTION = "assertion"
+RUNTIME = "runtime"
+
+# Actions
+RETRY = "retry"
+# Plan and write new code instead of patching the failed code
+REWRITE = "rewrite"
+# Plan and write new code, but do not execute it
+SKIP_EXECUTION = "skip_execution"
+STOP = "stop"
+
+# Checked in order against the error output
+_PATTERNS = [
+    # Message of the execution agent when it kills the code
+    (TIMEOUT, re.compile(r"^Code execution timed out", re.MULTILINE)),
+    (MEMORY,
+     re.compile(r"\bMemoryError\b|Unable to allocate|out of memory",
+                re.IGNORECASE)),
+    (SYNTAX, re.compile(r"\b(SyntaxError|IndentationError|TabError)\b")),
+    (MISSING_MODULE, re.compile(r"\b(ModuleNotFoundError|ImportError)\b")),
+    (ASSERTION, re.compile(r"\bAssertionError\b")),
+]
+# Exit codes of a process killed with SIGKILL, e.g. by the OOM killer
+_KILLED = (-9, 137)
+
+_HINTS = {
+    (TIMEOUT, REWRITE):
+    "The previous code timed out. Do not patch it: use an asymptotically "
+    "faster algorithm and never materialize huge inputs. If the input is "
+    "too large to process at all, say so and run the solution on a small "
+    "example instead.",
+    (TIMEOUT, SKIP_EXECUTION):
+    "The previous attempts timed out, so the next code will not be run. "
+    "Write an efficient solution and explain its time and memory "
+    "complexity.",
+    (MEMORY, REWRITE):
+    "The previous code ran out of memory. Do not patch it: compute the "
+    "result incrementally without building large data structures.",
+    (SYNTAX, RETRY):
+    "The previous code did not compile. Fix the syntax error.",
+    (MISSING_MODULE, RETRY):
+    "The previous code imported a module that is not installed. Use only "
+    "the Python standard library.",
+    (ASSERTION, RETRY):
+    "An assertion failed, so the previous code computed a wrong result. "
+    "Fix the logic rather than the assertion.",
+}
+
+
+def classify_failure(execution_result: dict[str, Any]) -> str:
+    """Class of a failed execution, from its error output and exit code"""
+    if execution_result.get("timeout_shortened"):
+        return DEADLINE
+    # Only what the program itself wrote to stderr; "stderr" of a failed
+    # run also holds its stdout, which may contain anything
+    stderr = execution_result.get("program_stderr",
+                                  execution_result.get("stderr", ""))
+    for failure_class, pattern in _PATTERNS:
+        if pattern.search(stderr):
+            return failure_class
+    if execution_result.get("return_code") in _KILLED:
+        return MEMORY
+    return RUNTIME
+
+
+@dataclass
+class RetryDecision:
+    action: str
+    # Instruction for the next attempt, added to its prompts
+    hint: str = ""
+
+
+# Action for the first, second, ... failure of a class within one query;
+# the last action repeats
+DEFAULT_RULES = {
+    TIMEOUT: [REWRITE, SKIP_EXECUTION],
+    # No time is left for another attempt
+    DEADLINE: [STOP],
+    MEMORY: [REWRITE, STOP],
+    SYNTAX: [RETRY],
+    MISSING_MODULE: [RETRY, STOP],
+    ASSERTION: [RETRY],
+    RUNTIME: [RETRY],
+}
+
+
+class RetryPolicy:
+    """Maps a failure class and how often it occurred to an action.
+
+    Pass other ``rules`` or override :meth:`decide` to change the policy.
+    :meth:`decide` must only depend on its arguments, since it is asked
+    again when the next attempt is planned; outcomes are counted by
+    :meth:`record`.
+    """
+
+    def __init__(self, rules: dict[str, list[str]] | None = None):
+        self.rules = {**DEFAULT_RULES, **(rules or {})}
+        self._lock = threading.Lock()
+        self._counts: dict[str, dict[str, int]] = {}
+
+    def decide(self, failure_class: str, occurrence: int) -> RetryDecision:
+        """Decide what to do after the ``occurrence``-th failure (from 1)
+        of ``failure_class`` within a query
+        """
+        actions = self.rules.get(failure_class, [RETRY])
+        action = actions[min(occurrence, len(actions)) - 1]
+        return RetryDecision(action, _HINTS.get((failure_class, action), ""))
+
+    def record(self, failure_class: str, action: str,
+               attempts_saved: int) -> None:
+        """Count a decision that was acted on.
+
+        ``attempts_saved`` is the number of attempts it avoided: the
+        retries left when stopping, or one execution when skipping it.
+        """
+        with self._lock:
+            counts = self._counts.setdefault(failure_class, {
+                "failures": 0,
+                "attempts_saved": 0
+            })
+            counts["failures"] += 1
+            counts[action] = counts.get(action, 0) + 1
+            counts["attempts_saved"] += attempts_saved
+
+    def stats(self) -> dict[str, dict[str, int]]:
+        with self._lock:
+            return {
+                name: dict(counts)
+                for name, counts in self._counts.items()
+            }
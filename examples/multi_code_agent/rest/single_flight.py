@@ -0,0 +1,60 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+
+
+def normalize_query(query: str) -> str:
+    """Key used to detect duplicate queries (case and whitespace blind)"""
+    return " ".join(query.split()).casefold()
+
+
+class SingleFlight:
+    """Coalesce concurrent calls that share a key.
+
+    The first caller for a key starts the work; callers arriving while it
+    runs, or within ``grace_seconds`` after it succeeded, await the same
+    result instead of starting their own run. Failures are not cached.
+    """
+
+    def __init__(self, grace_seconds: float = 2.0):
+        self.grace_seconds = grace_seconds
+        self._tasks: dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.inflight_hits = 0
+        self.grace_hits = 0
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._tasks.get(key)
+        if task is None:
+            self.leaders += 1
+            # Run the work in its own task so that a cancelled caller does
+            # not cancel it for the callers that joined it.
+            task = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda t: self._on_done(key, t))
+            self._tasks[key] = task
+        elif task.done():
+            self.grace_hits += 1
+        else:
+            self.inflight_hits += 1
+        return await asyncio.shield(task)
+
+    def _on_done(self, key: str, task: asyncio.Task) -> None:
+        if task.cancelled() or task.exception() is not None:
+            self._forget(key, task)
+        else:
+            asyncio.get_running_loop().call_later(self.grace_seconds,
+                                                  self._forget, key, task)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+
+    def stats(self) -> dict[str, Any]:
+        hits = self.inflight_hits + self.grace_hits
+        total = hits + self.leaders
+        return {
+            "leaders": self.leaders,
+            "inflight_hits": self.inflight_hits,
+            "grace_hits": self.grace_hits,
+            "hit_rate": hits / total if total else 0.0,
+            "in_flight": sum(not t.done() for t in self._tasks.values()),
+        }
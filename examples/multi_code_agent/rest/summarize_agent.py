@@ -1,8 +1,7 @@
 from typing import Any, Dict
 
 from dotenv import load_dotenv
-from langchain.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
+from rest.llm_client import create_chat_model
 
 import traceroot
 
@@ -14,7 +13,10 @@ logger = traceroot.get_logger()
 class SummarizeAgent:
 
     def __init__(self):
-        self.llm = ChatOpenAI(model="gpt-4o", temperature=0)
+        # Imported with the agent, not the module, to keep startup cheap
+        from langchain_core.prompts import ChatPromptTemplate
+
+        self.llm = create_chat_model("gpt-4o", temperature=0)
         self.system_prompt = (
             "You are a summarization agent. "
             "Your job is to create a comprehensive final response "
@@ -54,6 +56,38 @@ class SummarizeAgent:
         retry_count: int = 0,
         historical_context: str = "",
     ) -> str:
+        chain = self.summarize_prompt | self.llm
+        response = chain.invoke(
+            self._inputs(query, plan, code, execution_result, retry_count,
+                         historical_context))
+        return self._result(response)
+
+    @traceroot.trace()
+    async def create_summary_async(
+        self,
+        query: str,
+        plan: str,
+        code: str,
+        execution_result: Dict[str, Any],
+        retry_count: int = 0,
+        historical_context: str = "",
+    ) -> str:
+        """Async version of :meth:`create_summary`"""
+        chain = self.summarize_prompt | self.llm
+        response = await chain.ainvoke(
+            self._inputs(query, plan, code, execution_result, retry_count,
+                         historical_context))
+        return self._result(response)
+
+    def _inputs(
+        self,
+        query: str,
+        plan: str,
+        code: str,
+        execution_result: Dict[str, Any],
+        retry_count: int = 0,
+        historical_context: str = "",
+    ) -> Dict[str, Any]:
         success = execution_result.get("success", False)
         output = execution_result.get("stdout", "")
         error = execution_result.get("stderr", "")
@@ -69,39 +103,21 @@ class SummarizeAgent:
                 f"\n\nHistorical Context from Previous Attempts:\n"
                 f"{historical_context}")
 
-        chain = self.summarize_prompt | self.llm
-
-        formatted_prompt = self.summarize_prompt.format(
-            query=query,
-            plan=plan,
-            code=code,
-            success=success,
-            output=output,
-            error=error,
-            retry_count=retry_count,
-            historical_context=formatted_historical_context,
-        )
+        inputs = {
+            "query": query,
+            "plan": plan,
+            "code": code,
+            "success": success,
+            "output": output,
+            "error": error,
+            "retry_count": retry_count,
+            "historical_context": formatted_historical_context,
+        }
+        formatted_prompt = self.summarize_prompt.format(**inputs)
         logger.info(f"SUMMARIZE AGENT prompt:\n{formatted_prompt}")
+        return inputs
 
-        response = chain.invoke({
-            "query":
-            query,
-            "plan":
-            plan,
-            "code":
-            code,
-            "success":
-            success,
-            "output":
-            output,
-            "error":
-            error,
-            "retry_count":
-            retry_count,
-            "historical_context":
-            formatted_historical_context
-        })
-
+    def _result(self, response) -> str:
         logger.info(f"Summarized response: {response.content}")
 
         return response.content
@@ -0,0 +1,54 @@
+"""Last use of the resumable threads of a checkpoint database.
+
+Checkpoints of a thread are kept so that its run can be resumed, but a
+client that never comes back would keep them forever. Every run touches its
+thread here, and threads that were not used for ``ttl_seconds`` are handed
+out by :meth:`ThreadActivity.expired` to be deleted.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+
+class ThreadActivity:
+    """SQLite table of thread last-use times, safe to share between threads"""
+
+    def __init__(self,
+                 path: str,
+                 ttl_seconds: float,
+                 sweep_interval_seconds: float = 300):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.ttl_seconds = ttl_seconds
+        self.sweep_interval_seconds = sweep_interval_seconds
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._next_sweep = 0.0
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS thread_activity ("
+                               "thread_id TEXT PRIMARY KEY, used_at REAL)")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS thread_activity_used_at "
+                "ON thread_activity (used_at)")
+
+    def touch(self, thread_id: str) -> None:
+        """Record that ``thread_id`` is being used now"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO thread_activity VALUES (?, ?) "
+                "ON CONFLICT (thread_id) DO UPDATE SET "
+                "used_at = excluded.used_at", (thread_id, time.time()))
+
+    def expired(self) -> list[str]:
+        """Threads unused for ``ttl_seconds``, forgotten as they are
+        returned; checked at most once per sweep interval
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            if not self.ttl_seconds or now < self._next_sweep:
+                return []
+            self._next_sweep = now + self.sweep_interval_seconds
+            rows = self._conn.execute(
+                "DELETE FROM thread_activity WHERE used_at < ? "
+                "RETURNING thread_id", (now - self.ttl_seconds, )).fetchall()
+        return [row[0] for row in rows]
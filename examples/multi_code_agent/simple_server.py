@@ -1,10 +1,15 @@
 import os
-from typing import Dict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Literal
 
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from rest.main import MultiAgentSystem
+from rest.code_service import STREAM_HEADERS, CodeService
+from rest.metrics import CONTENT_TYPE, install_metrics, render
+from rest.profiling import install_profiling
+from rest.worker_pool import OverloadError
 
 import traceroot
 from traceroot.integrations.fastapi import connect_fastapi
@@ -12,29 +17,127 @@ from traceroot.logger import get_logger
 
 logger = get_logger()
 
-app = FastAPI(title="TraceRoot Multi-Agent Code Server")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build the agents in the background so the server binds right away"""
+    service.start()
+    yield
+    service.stop()
+
+
+app = FastAPI(title="TraceRoot Multi-Agent Code Server", lifespan=lifespan)
 connect_fastapi(app)
-system = MultiAgentSystem()
+# Profiles requests only when enabled, see rest/profiling.py
+install_profiling(app)
+# Request counts and latencies by route, served on GET /metrics
+install_metrics(app)
+# The agents are built by service.start(); poll /ready until they are
+service = CodeService()
 
 
-class CodeRequest(BaseModel):
+class AdmissionHints(BaseModel):
+    """Optional client hints used to schedule the request"""
+    tenant: str | None = None
+    priority: Literal["interactive", "batch"] | None = None
+    # Expected cost in LLM calls, if the client knows better than us
+    cost_hint: float | None = None
+
+
+class JobRequest(AdmissionHints):
     query: str
 
 
+class CodeRequest(AdmissionHints):
+    query: str
+    # Resubmitting with the same request_id resumes the checkpointed run
+    # (e.g. after a client disconnect or a worker restart). Requests with a
+    # request_id are only coalesced with requests of the same request_id.
+    request_id: str | None = None
+
+
 @app.post("/code")
 @traceroot.trace()
 async def code_endpoint(request: CodeRequest) -> Dict[str, str]:
     logger.info(f"Code endpoint called with query: {request.query}")
     try:
-        result = system.process_query(request.query)
+        ticket = service.ticket(request.query, request.tenant,
+                                request.priority, request.cost_hint)
+        # Concurrent duplicates of this query share a single pipeline run
+        result = await service.process(request.query, request.request_id,
+                                       ticket)
         logger.info("Query processing completed successfully")
         return {"status": "success", "response": result}
+    except OverloadError as e:
+        logger.warning(f"Rejecting query: {str(e)}")
+        raise HTTPException(status_code=e.status_code,
+                            detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}")
         raise HTTPException(status_code=500,
                             detail=f"Query processing failed: {str(e)}")
 
 
+@app.post("/code/stream")
+async def code_stream_endpoint(request: CodeRequest) -> StreamingResponse:
+    logger.info(f"Stream endpoint called with query: {request.query}")
+    try:
+        ticket = service.ticket(request.query, request.tenant,
+                                request.priority, request.cost_hint)
+    except OverloadError as e:
+        logger.warning(f"Rejecting query: {str(e)}")
+        raise HTTPException(status_code=e.status_code,
+                            detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
+    return StreamingResponse(service.stream(request.query, request.request_id,
+                                            ticket),
+                             media_type="text/event-stream",
+                             headers=STREAM_HEADERS)
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job_endpoint(request: JobRequest) -> Dict[str, str]:
+    logger.info(f"Job submitted with query: {request.query}")
+    try:
+        # Jobs are not interactive unless the client says otherwise
+        ticket = service.ticket(request.query, request.tenant, request.priority
+                                or "batch", request.cost_hint)
+        job = service.jobs.submit(request.query, ticket)
+    except OverloadError as e:
+        logger.warning(f"Rejecting job: {str(e)}")
+        raise HTTPException(status_code=e.status_code,
+                            detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
+    return {"job_id": job.id, "status": job.status}
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_endpoint(job_id: str) -> Dict[str, Any]:
+    job = await service.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+@app.get("/ready")
+async def ready_endpoint() -> dict:
+    readiness = service.readiness()
+    if not service.ready:
+        raise HTTPException(status_code=503, detail=readiness)
+    return readiness
+
+
+@app.get("/stats")
+async def stats_endpoint() -> dict:
+    return service.stats()
+
+
+@app.get("/metrics")
+async def metrics_endpoint() -> Response:
+    return Response(render(), media_type=CONTENT_TYPE)
+
+
 if __name__ == "__main__":
     # Check for required environment variables
     if not os.getenv("OPENAI_API_KEY"):
@@ -1,11 +1,16 @@
 import os
-from typing import Dict
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Literal
 
 import uvicorn
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Response
+from fastapi.responses import StreamingResponse
 from fastapi.routing import APIRouter
 from pydantic import BaseModel
-from rest.main import MultiAgentSystem
+from rest.code_service import STREAM_HEADERS, CodeService
+from rest.metrics import CONTENT_TYPE, install_metrics, render
+from rest.profiling import install_profiling
+from rest.worker_pool import OverloadError
 
 import traceroot
 from traceroot.integrations.fastapi import connect_fastapi
@@ -16,45 +21,156 @@ logger = get_logger()
 
 
 # Dependency functions
-async def get_system():
-    """Dependency to provide the MultiAgentSystem"""
-    return system
+async def get_service():
+    """Dependency to provide the CodeService"""
+    return service
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Build the agents in the background so the server binds right away"""
+    service.start()
+    yield
+    service.stop()
 
 
 # Initialize FastAPI app
-app = FastAPI(title="TraceRoot Multi-Agent Code Server V2")
+app = FastAPI(title="TraceRoot Multi-Agent Code Server V2", lifespan=lifespan)
 connect_fastapi(app)
-system = MultiAgentSystem()
+# Profiles requests only when enabled, see rest/profiling.py
+install_profiling(app)
+# Request counts and latencies by route, served on GET /metrics
+install_metrics(app)
+# The agents are built by service.start(); poll /ready until they are
+service = CodeService()
+
+# Create router with dependencies (applied to all routes)
+router = APIRouter(dependencies=[Depends(get_service)])
+
+
+class AdmissionHints(BaseModel):
+    """Optional client hints used to schedule the request"""
+    tenant: str | None = None
+    priority: Literal["interactive", "batch"] | None = None
+    # Expected cost in LLM calls, if the client knows better than us
+    cost_hint: float | None = None
 
-# Create router with dependencies
-router = APIRouter(
-    dependencies=[Depends(get_system)]  # Apply system dependency to all routes
-)
+
+class JobRequest(AdmissionHints):
+    query: str
 
 
-class CodeRequest(BaseModel):
+class CodeRequest(AdmissionHints):
     query: str
+    # Resubmitting with the same request_id resumes the checkpointed run
+    # (e.g. after a client disconnect or a worker restart). Requests with a
+    # request_id are only coalesced with requests of the same request_id.
+    request_id: str | None = None
 
 
 # Route handler (replaces the decorated function)
 @traceroot.trace()
 async def code_endpoint(
-    request: CodeRequest, system: MultiAgentSystem = Depends(get_system)
+    request: CodeRequest, service: CodeService = Depends(get_service)
 ) -> Dict[str, str]:
     """Process code generation requests"""
     logger.info(f"Code endpoint called with query: {request.query}")
     try:
-        result = system.process_query(request.query)
+        ticket = service.ticket(request.query, request.tenant,
+                                request.priority, request.cost_hint)
+        # Concurrent duplicates of this query share a single pipeline run
+        result = await service.process(request.query, request.request_id,
+                                       ticket)
         logger.info("Query processing completed successfully")
         return {"status": "success", "response": result}
+    except OverloadError as e:
+        logger.warning(f"Rejecting query: {str(e)}")
+        raise HTTPException(status_code=e.status_code,
+                            detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}")
         raise HTTPException(status_code=500,
                             detail=f"Query processing failed: {str(e)}")
 
 
-# Add the single route to router
+async def code_stream_endpoint(
+    request: CodeRequest, service: CodeService = Depends(get_service)
+) -> StreamingResponse:
+    """Process a query, streaming its progress as server-sent events"""
+    logger.info(f"Stream endpoint called with query: {request.query}")
+    try:
+        ticket = service.ticket(request.query, request.tenant,
+                                request.priority, request.cost_hint)
+    except OverloadError as e:
+        logger.warning(f"Rejecting query: {str(e)}")
+        raise HTTPException(status_code=e.status_code,
+                            detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
+    return StreamingResponse(service.stream(request.query, request.request_id,
+                                            ticket),
+                             media_type="text/event-stream",
+                             headers=STREAM_HEADERS)
+
+
+async def submit_job_endpoint(
+    request: JobRequest, service: CodeService = Depends(get_service)
+) -> Dict[str, str]:
+    """Queue a query and return the id to poll for its result"""
+    logger.info(f"Job submitted with query: {request.query}")
+    try:
+        # Jobs are not interactive unless the client says otherwise
+        ticket = service.ticket(request.query, request.tenant, request.priority
+                                or "batch", request.cost_hint)
+        job = service.jobs.submit(request.query, ticket)
+    except OverloadError as e:
+        logger.warning(f"Rejecting job: {str(e)}")
+        raise HTTPException(status_code=e.status_code,
+                            detail=str(e),
+                            headers={"Retry-After": str(e.retry_after)})
+    return {"job_id": job.id, "status": job.status}
+
+
+async def get_job_endpoint(
+        job_id: str,
+        service: CodeService = Depends(get_service),
+) -> Dict[str, Any]:
+    """Report the status, progress and result of a job"""
+    job = await service.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.to_dict()
+
+
+async def ready_endpoint(service: CodeService = Depends(get_service)) -> dict:
+    """Report whether the agents are built and requests can be served"""
+    readiness = service.readiness()
+    if not service.ready:
+        raise HTTPException(status_code=503, detail=readiness)
+    return readiness
+
+
+async def stats_endpoint(service: CodeService = Depends(get_service)) -> dict:
+    """Report coalescing, admission and worker pool statistics"""
+    return service.stats()
+
+
+async def metrics_endpoint() -> Response:
+    """Report the metrics of the process in the Prometheus text format"""
+    return Response(render(), media_type=CONTENT_TYPE)
+
+
+# Add the routes to router
 router.add_api_route("/code", code_endpoint, methods=["POST"])
+router.add_api_route("/code/stream", code_stream_endpoint, methods=["POST"])
+router.add_api_route("/jobs",
+                     submit_job_endpoint,
+                     methods=["POST"],
+                     status_code=202)
+router.add_api_route("/jobs/{job_id}", get_job_endpoint, methods=["GET"])
+router.add_api_route("/ready", ready_endpoint, methods=["GET"])
+router.add_api_route("/stats", stats_endpoint, methods=["GET"])
+router.add_api_route("/metrics", metrics_endpoint, methods=["GET"])
 
 # Include the router in the main app
 app.include_router(router)
@@ -1,6 +1,50 @@
 import { NextRequest, NextResponse } from 'next/server';
 import * as traceroot from 'traceroot-sdk-ts';
-import { request } from 'undici';
+import { Dispatcher, Pool } from 'undici';
+
+const CODE_AGENT_URL = process.env.CODE_AGENT_URL || 'http://localhost:9999';
+
+// One keep-alive connection pool to the code agent for the whole process,
+// instead of a new connection per browser call. It is kept on globalThis so
+// that hot reloads in development reuse it rather than leak a pool each.
+const globalForPool = globalThis as unknown as { codeAgentPool?: Pool };
+const codeAgentPool = globalForPool.codeAgentPool ??= new Pool(CODE_AGENT_URL, {
+  connections: 32,
+  keepAliveTimeout: 30_000,
+  keepAliveMaxTimeout: 600_000,
+});
+
+// Headers of a streamed reply; proxies in between must not buffer it
+const STREAM_HEADERS = {
+  'Content-Type': 'text/event-stream',
+  'Cache-Control': 'no-cache, no-transform',
+  'X-Accel-Buffering': 'no',
+};
+
+// Pass an undici response body on to the browser chunk by chunk, reading
+// the next chunk only when the browser has taken the previous one, so the
+// response is never held in memory as a whole
+function toWebStream(body: Dispatcher.ResponseData['body']): ReadableStream<Uint8Array> {
+  const chunks = body[Symbol.asyncIterator]();
+  return new ReadableStream<Uint8Array>({
+    async pull(controller) {
+      try {
+        const { value, done } = await chunks.next();
+        if (done) {
+          controller.close();
+        } else {
+          controller.enqueue(value);
+        }
+      } catch (error) {
+        controller.error(error);
+      }
+    },
+    cancel() {
+      // The browser went away; stop reading from the code agent
+      body.destroy();
+    },
+  });
+}
 
 // Initialize traceroot with robust error handling
 let tracerootInitialized = false;
@@ -25,10 +69,15 @@ async function initializeTraceRoot() {
   }
 }
 
-// Create a traced version of the request function
-const makeTracedCodeRequest = async (query: string): Promise<any> => {
+// Create a traced version of the request function. It resolves once the
+// response headers arrive; the body is streamed on by the caller.
+const makeTracedCodeRequest = async (
+  query: string,
+  stream: boolean,
+  signal: AbortSignal
+): Promise<Dispatcher.ResponseData> => {
   try {
-    console.log('📡 Making request to code agent:', { query });
+    console.log('📡 Making request to code agent:', { query, stream });
 
     // Log with traceroot if available
     if (tracerootLogger) {
@@ -59,54 +108,43 @@ const makeTracedCodeRequest = async (query: string): Promise<any> => {
       }
     }
 
-    // Use undici instead of fetch to avoid Next.js automatic instrumentation
-    const { statusCode, headers: responseHeaders, body } = await request('http://localhost:9999/code', {
+    // Use undici instead of fetch to avoid Next.js automatic instrumentation.
+    // Aborting the signal (the browser disconnected) closes the request, which
+    // cancels the run on the code agent.
+    const response = await codeAgentPool.request({
+      path: stream ? '/code/stream' : '/code',
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
         ...traceHeaders, // Spread trace headers if available
       },
       body: JSON.stringify({ query }),
+      signal,
     });
 
-    // Convert undici response to fetch-like response
-    const response = {
-      ok: statusCode >= 200 && statusCode < 300,
-      status: statusCode,
-      json: async () => JSON.parse(await body.text()),
-      text: async () => body.text(),
-    };
-
-    console.log('📡 Response status:', response.status);
+    console.log('📡 Response status:', response.statusCode);
 
-    if (!response.ok) {
-      const errorText = await response.text();
+    if (response.statusCode < 200 || response.statusCode >= 300) {
+      const errorText = await response.body.text();
       console.error('❌ Response error:', errorText);
 
       if (tracerootLogger) {
         tracerootLogger.error('❌ Code agent request failed', {
-          status: response.status,
+          status: response.statusCode,
           error: errorText
         });
       }
 
-      throw new Error(`HTTP error! status: ${response.status}, body: ${errorText}`);
+      throw new Error(`HTTP error! status: ${response.statusCode}, body: ${errorText}`);
     }
 
-    const result = await response.json();
-    console.log('✅ Code agent request completed:', {
-      hasResponse: !!result.response,
-      hasError: !!result.error
-    });
+    console.log('✅ Code agent responded, streaming the body through');
 
     if (tracerootLogger) {
-      tracerootLogger.info('✅ Code agent request completed', {
-        hasResponse: !!result.response,
-        hasError: !!result.error
-      });
+      tracerootLogger.info('✅ Code agent responded', { stream });
     }
 
-    return result;
+    return response;
   } catch (error: any) {
     console.error('❌ Code agent request failed:', error.message);
 
@@ -119,7 +157,11 @@ const makeTracedCodeRequest = async (query: string): Promise<any> => {
 };
 
 // Use traceFunction if traceroot is available, otherwise use regular function
-function makeCodeRequest(query: string): Promise<any> {
+function makeCodeRequest(
+  query: string,
+  stream: boolean,
+  signal: AbortSignal
+): Promise<Dispatcher.ResponseData> {
   if (tracerootInitialized) {
     try {
       // Use traceFunction for proper span creation
@@ -127,13 +169,13 @@ function makeCodeRequest(query: string): Promise<any> {
         makeTracedCodeRequest,
         { spanName: 'code_agent_request' }
       );
-      return tracedFunction(query);
+      return tracedFunction(query, stream, signal);
     } catch (traceError) {
       console.warn('⚠️ traceFunction failed, falling back to regular function:', traceError);
-      return makeTracedCodeRequest(query);
+      return makeTracedCodeRequest(query, stream, signal);
     }
   }
-  return makeTracedCodeRequest(query);
+  return makeTracedCodeRequest(query, stream, signal);
 }
 
 export async function POST(request: NextRequest) {
@@ -144,6 +186,9 @@ export async function POST(request: NextRequest) {
     console.log('📄 Request body:', body);
 
     const { query } = body;
+    // Stream progress events when asked to, in the body or the Accept header
+    const stream = body.stream === true
+      || (request.headers.get('accept') || '').includes('text/event-stream');
 
     if (!query) {
       console.log('❌ No query provided');
@@ -153,17 +198,21 @@ export async function POST(request: NextRequest) {
       );
     }
 
-    console.log('🤖 Processing code generation request:', { query });
+    console.log('🤖 Processing code generation request:', { query, stream });
 
     if (tracerootLogger) {
       tracerootLogger.info('🤖 Received code generation request', { query });
     }
 
     // Make request to the code agent (with tracing if available)
-    const result = await makeCodeRequest(query);
+    const response = await makeCodeRequest(query, stream, request.signal);
 
+    // Pass the body through as it arrives instead of buffering it
     console.log('✅ Returning result');
-    return NextResponse.json(result);
+    return new Response(toWebStream(response.body), {
+      status: response.statusCode,
+      headers: stream ? STREAM_HEADERS : { 'Content-Type': 'application/json' },
+    });
   } catch (error: any) {
     console.error('❌ API route error:', error.message, error.stack);
 
@@ -184,14 +233,14 @@ export async function GET() {
     // Initialize traceroot for status check
     await initializeTraceRoot();
 
-    // Test connectivity to the code agent using undici (no Next.js instrumentation)
-    const { statusCode } = await request('http://localhost:9999/code', {
-      method: 'POST',
-      headers: {
-        'Content-Type': 'application/json',
-      },
-      body: JSON.stringify({ query: 'test connection' }),
+    // Test connectivity to the code agent using undici (no Next.js
+    // instrumentation); its readiness probe does not run the agents
+    const { statusCode, body } = await codeAgentPool.request({
+      path: '/ready',
+      method: 'GET',
     });
+    // Drain the body so the connection goes back to the pool
+    await body.dump();
 
     const testResponse = {
       ok: statusCode >= 200 && statusCode < 300,
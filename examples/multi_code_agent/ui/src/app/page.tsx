@@ -1,13 +1,38 @@
 'use client';
 
 import { useState, useEffect, useRef } from 'react';
-import { Message, ChatState } from '@/types/api';
+import { Message, ChatState, CodeStreamEvent } from '@/types/api';
+
+// What the agents have done once a graph node finishes
+const NODE_PROGRESS: Record<string, string> = {
+  planning: 'Planned the solution',
+  coding: 'Wrote the code',
+  execute: 'Ran the code',
+  summarize: 'Summarized the results',
+};
+
+// Parse one server-sent event; comments (heartbeats) have no data
+function parseStreamEvent(raw: string): CodeStreamEvent | null {
+  let event = '';
+  let data = '';
+  for (const line of raw.split('\n')) {
+    if (line.startsWith('event:')) {
+      event = line.slice(6).trim();
+    } else if (line.startsWith('data:')) {
+      data += line.slice(5).trim();
+    }
+  }
+  if (!event || !data) return null;
+  return { event, ...JSON.parse(data) } as CodeStreamEvent;
+}
 
 export default function ChatbotPage() {
   const [messages, setMessages] = useState<Message[]>([]);
   const [inputText, setInputText] = useState('');
   const [isLoading, setIsLoading] = useState(false);
   const [isTracerootInitialized, setIsTracerootInitialized] = useState(false);
+  // Steps the agents finished for the request in progress
+  const [progress, setProgress] = useState<string[]>([]);
   const messagesEndRef = useRef<HTMLDivElement>(null);
 
   // Initialize traceroot when component mounts
@@ -19,7 +44,7 @@ export default function ChatbotPage() {
   // Auto-scroll to bottom when new messages are added
   useEffect(() => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
-  }, [messages]);
+  }, [messages, progress]);
 
   const sendCodeRequest = async (query: string): Promise<string> => {
     try {
@@ -29,18 +54,39 @@ export default function ChatbotPage() {
         method: 'POST',
         headers: {
           'Content-Type': 'application/json',
+          'Accept': 'text/event-stream',
         },
-        body: JSON.stringify({ query }),
+        body: JSON.stringify({ query, stream: true }),
       });
 
-      if (!response.ok) {
+      if (!response.ok || !response.body) {
         throw new Error(`HTTP error! status: ${response.status}`);
       }
 
-      const result = await response.json();
-      console.log('✅ Code request completed:', result);
+      // Show each step as the agents finish it, until the result arrives
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let boundary: number;
+        while ((boundary = buffer.indexOf('\n\n')) >= 0) {
+          const event = parseStreamEvent(buffer.slice(0, boundary));
+          buffer = buffer.slice(boundary + 2);
+          if (event?.event === 'node') {
+            setProgress(prev => [...prev, NODE_PROGRESS[event.node] || event.node]);
+          } else if (event?.event === 'result') {
+            console.log('✅ Code request completed:', event);
+            return event.response || 'No response received';
+          } else if (event?.event === 'error') {
+            throw new Error(`${event.detail} (status ${event.status_code})`);
+          }
+        }
+      }
 
-      return result.response || result.error || 'No response received';
+      throw new Error('The response ended before the result');
     } catch (error: any) {
       console.error('❌ Code request failed:', error);
       throw error;
@@ -67,6 +113,7 @@ export default function ChatbotPage() {
     setMessages(prev => [...prev, userMessage]);
     setInputText('');
     setIsLoading(true);
+    setProgress([]);
 
     try {
       const response = await sendCodeRequest(userMessage.text);
@@ -164,6 +211,11 @@ export default function ChatbotPage() {
                   <div className="animate-spin rounded-full h-4 w-4 border-b-2 border-blue-500"></div>
                   <span>Generating code...</span>
                 </div>
+                {progress.map((step, index) => (
+                  <div key={index} className="text-sm text-gray-500 dark:text-gray-400 mt-1">
+                    ✓ {step}
+                  </div>
+                ))}
               </div>
             </div>
           )}
@@ -7,6 +7,8 @@ export interface Message {
 
 export interface CodeApiRequest {
   query: string;
+  // Ask for server-sent events instead of a single JSON response
+  stream?: boolean;
 }
 
 export interface CodeApiResponse {
@@ -14,6 +16,12 @@ export interface CodeApiResponse {
   error?: string;
 }
 
+// Server-sent events of a streamed code request
+export type CodeStreamEvent =
+  | { event: 'node'; node: string }
+  | { event: 'result'; status: string; response: string }
+  | { event: 'error'; status_code: number; detail: string; retry_after?: number };
+
 export interface ChatState {
   messages: Message[];
   isLoading: boolean;
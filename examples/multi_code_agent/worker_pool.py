@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Awaitable, Callable
+
+
+class OverloadError(Exception):
+    """Base class for requests refused to protect the server.
+
+    Carries the HTTP status to answer with and a Retry-After hint.
+    """
+    status_code = 503
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class QueueFullError(OverloadError):
+    """Raised when no more work can be queued"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Queue is full, retry after {retry_after}s",
+                         retry_after)
+
+
+class BoundedWorkerPool:
+    """Runs blocking calls on a fixed number of threads with a bounded queue.
+
+    At most ``max_workers`` calls run at once and at most ``max_queue`` more
+    wait for a thread. Further submissions fail fast with
+    :class:`QueueFullError`, so an overloaded server sheds load instead of
+    piling up requests it cannot serve in time.
+
+    Coroutines can be run under the same limits with :meth:`run_async`;
+    they wait on the event loop instead of holding a thread.
+    """
+
+    def __init__(self, max_workers: int, max_queue: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=max_workers,
+                                            thread_name_prefix="code-worker")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._running = 0
+        self.completed = 0
+        self.rejected = 0
+        self._waits: deque[float] = deque(maxlen=1000)
+        self._durations: deque[float] = deque(maxlen=100)
+        self._slots = asyncio.Semaphore(max_workers)
+
+    async def run(self, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        return await self.submit(fn, *args, **kwargs)
+
+    async def run_async(self, fn: Callable[..., Awaitable[Any]], *args,
+                        **kwargs) -> Any:
+        """Await ``fn`` once one of ``max_workers`` slots is free"""
+        self._reserve()
+        submitted = time.monotonic()
+        try:
+            async with self._slots:
+                started = time.monotonic()
+                with self._lock:
+                    self._running += 1
+                    self._waits.append(started - submitted)
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    with self._lock:
+                        self._running -= 1
+                        self._durations.append(time.monotonic() - started)
+        finally:
+            self._on_done(None)
+
+    def _reserve(self) -> None:
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise QueueFullError(self._retry_after())
+            self._pending += 1
+
+    def submit(self, fn: Callable[..., Any], *args,
+               **kwargs) -> asyncio.Future:
+        """Queue ``fn`` without waiting for it; fails fast when full"""
+        self._reserve()
+
+        submitted = time.monotonic()
+
+        def call():
+            started = time.monotonic()
+            with self._lock:
+                self._running += 1
+                self._waits.append(started - submitted)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._durations.append(time.monotonic() - started)
+
+        # Carry the caller's context (e.g. the active trace) into the thread
+        context = contextvars.copy_context()
+        future = self._executor.submit(context.run, call)
+        future.add_done_callback(self._on_done)
+        return asyncio.wrap_future(future)
+
+    def _on_done(self, future: Future | None) -> None:
+        # Also runs for calls cancelled before they got a thread
+        with self._lock:
+            self._pending -= 1
+            self.completed += 1
+
+    def _retry_after(self) -> int:
+        """Rough time until a queue slot frees up, in whole seconds"""
+        if not self._durations:
+            return 1
+        mean = sum(self._durations) / len(self._durations)
+        return max(1, math.ceil(mean * self.max_queue / self.max_workers))
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            waits = sorted(self._waits)
+            pending, running = self._pending, self._running
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "running": running,
+            "queued": pending - running,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "queue_wait_seconds": {
+                "p50": _percentile(waits, 0.50),
+                "p95": _percentile(waits, 0.95),
+                "max": waits[-1] if waits else 0.0,
+            },
+        }
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]